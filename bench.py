@@ -0,0 +1,261 @@
+import argparse
+import contextlib
+from http.server import ThreadingHTTPServer
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import file_server
+
+
+# percent of files : file size, picked per file
+SIZE_DISTRIBUTIONS = {
+    'small': [(90, 1024), (9, 16 * 1024), (1, 256 * 1024)],
+    'mixed': [(70, 4 * 1024), (25, 128 * 1024), (5, 2 * 1024 * 1024)],
+    'large': [(50, 1024 * 1024), (50, 8 * 1024 * 1024)],
+}
+FILES_PER_DIR = 50
+TRANSFER_SIZE = 64 * 1024 * 1024
+
+
+# TREE GENERATION
+
+def parse_size(size: str) -> int:
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    size = size.strip().upper()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def parse_distribution(spec: str):
+    # either a named distribution or 'percent:size,...' like '90:1K,10:1M'
+    if spec in SIZE_DISTRIBUTIONS:
+        return SIZE_DISTRIBUTIONS[spec]
+    distribution = []
+    for part in spec.split(','):
+        weight, size = part.split(':')
+        distribution.append((float(weight), parse_size(size)))
+    return distribution
+
+def pick_size(rng: random.Random, distribution) -> int:
+    weights = [weight for weight, size in distribution]
+    size = rng.choices([size for weight, size in distribution], weights)[0]
+    # spread sizes a little so files aren't all identical
+    return max(1, int(size * rng.uniform(0.5, 1.5)))
+
+def write_random_file(rng: random.Random, path: str, size: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(rng.randbytes(size))
+
+def make_tree(root: str, file_count: int, distribution, seed: int):
+    rng = random.Random(seed)
+    files = []
+    total = 0
+    for i in range(file_count):
+        # a few levels of nesting like a real project
+        dir_index = i // FILES_PER_DIR
+        rel_path = os.path.join('d' + str(dir_index % 10), 'd' + str(dir_index), 'f' + str(i) + '.bin')
+        size = pick_size(rng, distribution)
+        write_random_file(rng, os.path.join(root, rel_path), size)
+        files.append(rel_path)
+        total += size
+    return files, total
+
+def churn_tree(root: str, files, fraction: float, distribution, seed: int):
+    # rewrite a fraction of the files so the next run has something to do
+    rng = random.Random(seed)
+    changed = rng.sample(files, int(len(files) * fraction))
+    for rel_path in changed:
+        write_random_file(rng, os.path.join(root, rel_path), pick_size(rng, distribution))
+    # make sure mtimes move even on coarse filesystems
+    later = time.time() + 2
+    for rel_path in changed:
+        os.utime(os.path.join(root, rel_path), (later, later))
+    return changed
+
+
+# TIMING
+
+@contextlib.contextmanager
+def quiet():
+    # the per file prints would dominate the timings
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def timed(fn, repeat: int = 1, setup=None):
+    best = None
+    result = None
+    for i in range(repeat):
+        if setup:
+            setup()
+        with quiet():
+            start = time.perf_counter()
+            result = fn()
+            duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+def record(results: dict, name: str, seconds: float, files: int = None, total_bytes: int = None):
+    entry = {'seconds': round(seconds, 6)}
+    if files:
+        entry['files'] = files
+        entry['files_per_second'] = round(files / seconds, 1) if seconds else None
+    if total_bytes:
+        entry['bytes'] = total_bytes
+        entry['mb_per_second'] = round(total_bytes / seconds / (1024 * 1024), 2) if seconds else None
+    results[name] = entry
+    print(name.ljust(28) + f"{seconds:10.4f}s" + ('  ' + str(entry.get('mb_per_second')) + ' MB/s' if total_bytes else ''))
+
+
+# BENCHMARKS
+
+def hash_all(root: str, files):
+    return {rel_path: file_server.hash(root + '/' + rel_path) for rel_path in files}
+
+def manifest_for(root: str, files):
+    return {
+        rel_path: {
+            'hash': file_server.hash(root + '/' + rel_path),
+            'date': file_server.get_file_last_modified(root + '/' + rel_path).strftime(file_server.DATE_FORMAT),
+        }
+        for rel_path in files
+    }
+
+def bench_tree(args, results: dict, work_dir: str):
+    root = os.path.join(work_dir, 'tree')
+    distribution = parse_distribution(args.sizes)
+    files, total = make_tree(root, args.files, distribution, args.seed)
+    file_server.DIRECTORY = root
+    cache_dir = root + file_server.HASH_CACHE
+
+    seconds, listed = timed(lambda: file_server.get_all_files_relative(root), args.repeat)
+    record(results, 'scan', seconds, len(listed))
+
+    seconds, hashes = timed(lambda: hash_all(root, files), args.repeat, setup=lambda: shutil.rmtree(cache_dir, ignore_errors=True))
+    record(results, 'hash_cold', seconds, len(files), total)
+
+    seconds, hashes = timed(lambda: hash_all(root, files), args.repeat)
+    record(results, 'hash_warm', seconds, len(files))
+
+    # an up to date client, the common case for a sync
+    with quiet():
+        manifest = manifest_for(root, files)
+    seconds, (status, response) = timed(lambda: file_server.SYNC(manifest), args.repeat)
+    record(results, 'sync_up_to_date', seconds, len(files))
+
+    changed = churn_tree(root, files, args.churn, distribution, args.seed + 1)
+    seconds, hashes = timed(lambda: hash_all(root, files))
+    record(results, 'hash_after_churn', seconds, len(files))
+
+    # the client still has the old manifest so the changed files come back
+    seconds, (status, response) = timed(lambda: file_server.SYNC(manifest), args.repeat)
+    record(results, 'sync_after_churn', seconds, len(files))
+    results['sync_after_churn']['changed'] = len(changed)
+
+def start_server(directory: str):
+    file_server.DIRECTORY = directory
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), file_server.Server)
+    # the handler logs every request to stderr
+    file_server.Server.log_message = lambda *args: None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, '127.0.0.1:' + str(httpd.server_address[1])
+
+def bench_transfer(args, results: dict, work_dir: str):
+    server_dir = os.path.join(work_dir, 'server')
+    os.makedirs(server_dir, exist_ok=True)
+    source = os.path.join(work_dir, 'upload.bin')
+    size = parse_size(args.transfer_size)
+    write_random_file(random.Random(args.seed), source, size)
+
+    httpd, url = start_server(server_dir)
+    try:
+        headers = lambda: {'password': file_server.PASSWORD, 'file_path': 'upload.bin'}
+        seconds, response = timed(lambda: file_server.chunked_file_upload(url + '/upload', source, 'POST', headers=headers()), args.repeat)
+        record(results, 'upload', seconds, 1, size)
+
+        # a copy already there would just get a 304
+        seconds, response = timed(lambda: file_server.chunked_file_download(url + '/download', headers=headers(), dest_file='download.bin'), args.repeat, setup=lambda: file_server.remove_quietly(os.path.join(server_dir, 'download.bin')))
+        record(results, 'download', seconds, 1, size)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+# RESULTS
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(results: dict, previous_path: str):
+    with open(previous_path, 'r') as f:
+        previous = json.load(f)['results']
+
+    print()
+    file_server.print_rainbow('--Compared to ' + previous_path + '--')
+    for name, entry in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]['seconds']
+        after = entry['seconds']
+        change = 100 * (after - before) / before if before else 0
+        color = file_server.RED if change > 10 else file_server.GREEN if change < -10 else ''
+        print(name.ljust(28) + f"{before:10.4f}s -> {after:10.4f}s  " + color + f"{change:+.1f}%" + file_server.ANSII_RESET)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks for hashing, scanning, sync and transfers")
+    parser.add_argument('--files', type=int, default=2000, help='number of files in the synthetic tree')
+    parser.add_argument('--sizes', type=str, default='small', help='size distribution, one of ' + ', '.join(SIZE_DISTRIBUTIONS) + " or 'percent:size,...' like '90:1K,10:1M'")
+    parser.add_argument('--churn', type=float, default=0.05, help='fraction of files rewritten between runs')
+    parser.add_argument('--transfer-size', type=str, default=str(TRANSFER_SIZE // (1024 * 1024)) + 'M', help='size of the file used for upload and download throughput')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best is kept')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', choices=['tree', 'transfer'], help='run just one group')
+    parser.add_argument('--out', type=str, default='bench_output.json', help='where to write the results')
+    parser.add_argument('--compare', type=str, help='earlier results file to compare against')
+    parser.add_argument('--keep', action='store_true', help="don't delete the generated files")
+    args = parser.parse_args()
+
+    # time the work, not the per file console output
+    file_server.VERBOSE = False
+    work_dir = tempfile.mkdtemp(prefix='file_server_bench_')
+    results = {}
+    try:
+        if args.only in (None, 'tree'):
+            bench_tree(args, results, work_dir)
+        if args.only in (None, 'transfer'):
+            bench_transfer(args, results, work_dir)
+    finally:
+        if args.keep:
+            print('generated files kept in ' + work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': vars(args),
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('results written to ' + args.out)
+
+    if args.compare:
+        compare(results, args.compare)
@@ -1,33 +1,80 @@
-import argparse
-import base64
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
-import hashlib
-import http
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import ipaddress
+import contextlib
+import fnmatch
 import json
 import os
-import socket
-from typing import Dict, List
-from urllib.parse import urlparse
+import re
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from urllib.parse import parse_qs, urlencode, urlparse
 
-import concurrent
-import random
+# everything else is imported where it's used, so a quick --la or drop doesn't pay
+# for http.server, hashlib and friends (python -X importtime file_server.py shows it)
 
 
 
 DIRECTORY = 'files'
 PASSWORD = ''
 HASH_CACHE = '/.hash_cache'
+META_DIR = '/.file_server' # a server's node id and relay queues, kept in the synced directory but never synced
+TEMP_SUFFIX = '.partial'
+TEMP_NAME = re.compile(r'\..+\.[0-9a-f]{8}' + re.escape(TEMP_SUFFIX)) # what temp_path_for makes, not any user's .partial file
+HASH_TRAILER = 'file_hash'
+SYNC_IGNORE = '.syncignore'
 
 URL = None
+VERBOSE = True # per file console output, slows down big syncs
+TRACE_REQUESTS = False
+PROFILER = None
+SYNC_RULES = None
+CLIENT_ID = os.urandom(16).hex()
 PORT = 8000
+UPLOAD_LIMIT = None # TokenBucket pacing the default client's uploads
+DOWNLOAD_LIMIT = None # TokenBucket pacing the default client's downloads
+PEERS = [] # other servers holding the same files, the default client's big downloads are spread over them
+HASH_LIMIT = None # TokenBucket pacing reads while hashing, shared by everything in the process
 DROP_PORT = 8001
 
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 SIZE_LIMIT = 10000 * 64 # 10,000 lines of 64 chars
+LIST_PAGE_SIZE = 5000
+STREAM_FLUSH_BYTES = 64 * 1024
+STREAM_FLUSH_SECONDS = 0.2
+NDJSON = 'application/x-ndjson'
+KEEP_ALIVE_SECONDS = 60 # idle kept-alive connections are dropped after this
+POOL_SIZE = 4 # idle connections kept per server
+LONG_POLL_SECONDS = 25
+JOURNAL_SIZE = 10000 # changes remembered for /changes, older clients have to resync
+WATCH_INTERVAL = 0.5
+DEBOUNCE_SECONDS = 1.0
+MAX_BATCH_DELAY = 10.0 # push a busy directory at least this often
 FILE_TOO_LARGE = 'FILE_TOO_LARGE'
+QUARANTINED = 'failed a scrub and no peer had a good copy, not sent until it is fixed or replaced'
+GROUP_COMMIT_MIN = 8 # above this many files and folders a batch's fsyncs go out side by side on the hashing threads
+BATCH_TIMEOUT = 10 * 60 # seconds before an uncommitted upload batch is thrown away
+TRANSFER_WAIT_SECONDS = 30 # how long a transfer queues for a slot before getting a 503
+TRANSFER_RETRIES = 5
+HASH_WORKERS = 4 # files hashed at once by a SyncServer or SyncClient
+SCAN_SLOTS = 2 # directory walks running at once across the shares of a SyncHost
+MEMORY_BUDGET = 256 * 1024 * 1024 # file contents a SyncHost holds in sync responses at once
+RELAY_RETRY_SECONDS = 2 # first wait after a relay couldn't reach its peer, doubling up to RELAY_MAX_BACKOFF
+RELAY_MAX_BACKOFF = 60
+PIECE_SIZE = 4 * 1024 * 1024 # what a swarm download splits a file into, each piece is checked on its own
+SWARM_CONNECTIONS = 2 # pieces fetched at once from each peer
+SWARM_MAX_FAILURES = 3 # bad or failed pieces before a peer is left out of the rest of a download
+PIECE_CACHE_SIZE = 64 # files a server remembers the piece hashes of
+DROP_LANES = 4 # archive streams a folder drop is split over, only big drops use them all
+DROP_LANE_SIZE = 16 * 1024 * 1024 # bytes worth opening another lane for
+STREAM_BUFFER = 256 * 1024 # what an archive stream collects before it sends a chunk
+ESTIMATE_RATE = 10 * 1024 * 1024 # bytes per second --dry-run assumes without an --upload-limit or --download-limit
+CONTENT_CACHE_SIZE = 64 * 1024 * 1024 # small files a server keeps in memory, raw and base64, to send to the next client
+VALIDATOR_CACHE_SIZE = 8 * 1024 * 1024 # bytes of GET responses a ConnectionPool keeps with their ETag to ask If-None-Match next time
+ASYNC_TRANSFERS = 4 # uploads and downloads the asyncio client runs at once, each on its own connection
+PACK_FILE_LIMIT = 16 * 1024 # with --pack, files up to this size are kept in pack files instead of one file each
+PACK_SIZE = 256 * 1024 * 1024 # a pack file past this is left as it is and the next one started
+SCRUB_INTERVAL = 60 # seconds between the slices --scrub re-reads
+SCRUB_SLICE = 500 # files checked per slice
+SCRUB_RATE = 4 * 1024 * 1024 # bytes per second --scrub reads at without a rate
 
 RED = '\x1b[38;2;255;0;0m'
 ORANGE = '\x1b[38;2;230;76;0m'
@@ -48,27 +95,417 @@ PUT_TABLE_BACK = '┬─┬ ノ( ゜-゜ノ)'
 WAVING = '(°▽°)/'
 
 
-# UTIL FUNCTION
-def get_all_files_relative(directory: str) -> List[str]:
-    directory = os.path.expanduser(directory)
-    files_list = []
-    for root, dirs, files in os.walk(directory):
-
-        # skip files in the hash cache directory
-        if root.startswith(DIRECTORY + HASH_CACHE):
-            continue
+# LIMITS
+
+def parse_rate(rate: str) -> float:
+    # bytes per second, '500K', '5M' or plain bytes like curl's --limit-rate
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    rate = rate.strip().upper()
+    if rate[-1] in units:
+        return float(rate[:-1]) * units[rate[-1]]
+    return float(rate)
+
+class TokenBucket:
+    # Paces a stream of bytes to a rate, letting up to a second's worth through in a burst.
+    # A read bigger than what's left puts the bucket in debt and its caller sleeps it off,
+    # so concurrent callers queue up behind each other and share the rate
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class ClientBuckets:
+    # A TokenBucket per client and direction. Every connection from one client shares
+    # its bucket, so opening more doesn't get more, and the shares of a SyncHost share
+    # the buckets too so a client doesn't get the rate again for each share it syncs.
+
+    def __init__(self, rates: dict = None):
+        self.rates = dict(rates or {}) # client ip -> bytes per second each way, '' for everyone else
+        self.buckets = {} # (client ip, direction) -> TokenBucket
+        self.lock = threading.Lock()
+
+    def get(self, client_ip: str, direction: str) -> TokenBucket:
+        rate = self.rates.get(client_ip, self.rates.get(''))
+        if not rate:
+            return None
+        with self.lock:
+            bucket = self.buckets.get((client_ip, direction))
+            if bucket is None:
+                bucket = self.buckets[(client_ip, direction)] = TokenBucket(rate)
+            return bucket
+
+def throttle(bucket: TokenBucket, amount: int, direction: str):
+    if bucket is None:
+        return
+    waited = bucket.consume(amount)
+    if waited:
+        METRICS.inc('file_server_throttled_seconds_total', waited, direction=direction)
+
+def chunk_size_for(bucket: TokenBucket, chunk_size: int = 1024 * 1024) -> int:
+    # smaller reads when paced so the bytes trickle out instead of arriving in 1MB lumps
+    if bucket is None:
+        return chunk_size
+    return max(16 * 1024, min(chunk_size, int(bucket.rate / 8)))
+
+def retry_after(response) -> float:
+    # spread out so a crowd of clients turned away together doesn't come back together
+    try:
+        seconds = float(response.getheader('Retry-After', 1))
+    except ValueError:
+        seconds = 1
+    import random
+    return seconds * random.uniform(1, 1.5)
+
+def transfer_busy(response, attempt: int) -> bool:
+    # the server is at --max-transfers, come back after retry_after() a few times
+    return response.status == 503 and attempt < TRANSFER_RETRIES
+
+class MemoryBudget:
+    # Bytes of file contents that responses in flight may hold at once. A file that
+    # doesn't fit is sent as FILE_TOO_LARGE instead, and the client streams it
+    # through /download, so a burst of syncs slows down rather than running out of memory.
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self, size: int) -> bool:
+        with self.lock:
+            if self.used + size > self.limit:
+                METRICS.inc('file_server_memory_deferred_total')
+                return False
+            self.used += size
+        METRICS.inc('file_server_memory_held_bytes', size)
+        return True
+
+    def give(self, size: int):
+        with self.lock:
+            self.used -= size
+        METRICS.inc('file_server_memory_held_bytes', -size)
+
+    @contextlib.contextmanager
+    def reserve(self):
+        # yields take() for one response, everything it took comes back when it's sent
+        taken = 0
+        def take(size: int) -> bool:
+            nonlocal taken
+            if not self.take(size):
+                return False
+            taken += size
+            return True
+        try:
+            yield take
+        finally:
+            self.give(taken)
+
+class ContentCache:
+    # The last files sent that are small enough to go inline in a sync, raw and base64,
+    # so the same freshly changed notes going out to every client are read and encoded
+    # once. Entries are keyed by mtime and size so a file changed behind our back is
+    # never sent stale, the least recently used go once limit bytes are held.
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.entries = OrderedDict() # full path -> [(mtime_ns, size), raw, base64 or None]
+        self.lock = threading.Lock()
+
+    def get(self, full_path: str, encoded: bool = False):
+        # the file's bytes, or with encoded its base64, from disk on a miss
+        stat = os.stat(full_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(full_path)
+            if entry is not None and entry[0] != signature:
+                self.remove(full_path)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(full_path)
+                value = entry[2] if encoded else entry[1]
+                if value is not None:
+                    METRICS.inc('file_server_content_cache_hits_total')
+                    return value
+        METRICS.inc('file_server_content_cache_misses_total')
+
+        if entry is not None:
+            raw = entry[1]
+        else:
+            with span('read'), open(full_path, 'rb') as f:
+                raw = f.read()
+        value = raw
+        if encoded:
+            import base64
+            with span('encode'):
+                value = base64.b64encode(raw).decode('utf-8')
+
+        # not kept if a write landed during the read, the bytes could be half old and half new
+        stat = os.stat(full_path)
+        if stat.st_size <= SIZE_LIMIT and (stat.st_mtime_ns, stat.st_size) == signature:
+            self.put(full_path, signature, raw, value if encoded else None)
+        return value
+
+    def put(self, full_path: str, signature: tuple, raw: bytes, encoded: str = None):
+        with self.lock:
+            old = self.entries.get(full_path)
+            if encoded is None and old is not None and old[0] == signature:
+                encoded = old[2]
+            self.remove(full_path)
+            size = len(raw) + len(encoded or '')
+            if size > self.limit:
+                return
+            self.entries[full_path] = [signature, raw, encoded]
+            self.used += size
+            METRICS.inc('file_server_content_cache_bytes', size)
+            while self.used > self.limit:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, full_path: str):
+        # callers hold the lock
+        entry = self.entries.pop(full_path, None)
+        if entry is not None:
+            size = len(entry[1]) + len(entry[2] or '')
+            self.used -= size
+            METRICS.inc('file_server_content_cache_bytes', -size)
+
+    def forget(self, full_path: str):
+        with self.lock:
+            self.remove(full_path)
+
+def set_low_priority():
+    # background sync shouldn't compete with whatever else this machine is doing
+    if hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, 19)
+        except OSError:
+            pass
+    # there's no python api for io priority, ionice sets the idle class where it exists
+    import shutil
+    import subprocess
+    if shutil.which('ionice'):
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 
-        # Create absolute or relative path as needed
-        for file in files:
-            full_path = os.path.join(root, file)
-            relative_path = os.path.relpath(full_path, directory)
-            files_list.append(relative_path)
+# UTIL FUNCTION
+class SyncRules:
+    # Gitignore style rules deciding what takes part in a sync. Later rules win, '!'
+    # re-includes, a trailing '/' only matches directories and a '/' anywhere else
+    # anchors the pattern to the root. path limits the sync to one subtree.
+
+    def __init__(self, lines: list[str] = (), path: str = None):
+        self.lines = []
+        self.rules = [] # (regex, negate, dir_only)
+        self.path = path.strip('/') if path else None
+        self.path_parts = tuple(self.path.split('/')) if self.path else ()
+        for line in lines:
+            self.add(line)
+
+    def add(self, line: str):
+        pattern = line.rstrip('\n').rstrip()
+        if not pattern or pattern.startswith('#'):
+            return
+        self.lines.append(pattern)
+
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\'):
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+
+        regex = ('^' if anchored else '(?:^|.*/)') + glob_to_regex(pattern) + '$'
+        self.rules.append((re.compile(regex), negate, dir_only))
+
+    def excluded(self, parts: tuple, is_dir: bool) -> bool:
+        rel_path = '/'.join(parts)
+        result = False
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                result = not negate
+        return result
+
+    def in_scope(self, parts: tuple, is_dir: bool) -> bool:
+        if not self.path_parts:
+            return True
+        n = min(len(parts), len(self.path_parts))
+        if parts[:n] != self.path_parts[:n]:
+            return False
+        # directories above the scope still have to be walked into
+        return is_dir or len(parts) >= len(self.path_parts)
+
+    def wanted(self, rel_path: str) -> bool:
+        parts = tuple(rel_path.replace('\\', '/').split('/'))
+        if not self.in_scope(parts, False):
+            return False
+        # a file inside an excluded directory is excluded too
+        for i in range(1, len(parts)):
+            if self.excluded(parts[:i], True):
+                return False
+        return not self.excluded(parts, False)
 
+    def to_header(self) -> str:
+        return json.dumps({'path': self.path, 'rules': self.lines})
 
-    return files_list
+def glob_to_regex(pattern: str) -> str:
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            char_class = pattern[i + 1:end].replace('\\', '\\\\')
+            if char_class.startswith('!'):
+                char_class = '^' + char_class[1:]
+            regex += '[' + char_class + ']'
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
 
-def print_dir_structure(files_list: List[str]):
+def load_sync_rules(directory: str, extra_lines: list[str] = (), path: str = None) -> SyncRules:
+    lines = []
+    try:
+        with open(os.path.join(os.path.expanduser(directory), SYNC_IGNORE), 'r') as f:
+            lines = f.readlines()
+    except OSError:
+        pass
+    return SyncRules(list(lines) + list(extra_lines), path)
+
+def sync_rules_from_headers(headers, directory: str = None) -> SyncRules:
+    # the server's own .syncignore plus whatever the client scoped its sync to
+    client_rules = json.loads(headers.get('sync_rules') or '{}')
+    return load_sync_rules(directory or DIRECTORY, client_rules.get('rules', []), client_rules.get('path'))
+
+def scan_files(directory: str, prefix: str = '', pattern: str = None, max_depth: int = None, after: str = None, rules: SyncRules = None, pack: 'PackStore' = None, exact: bool = False):
+    # Walks the directory depth first in sorted order yielding (parts, entry, lasts) for
+    # every file. Sorted order lets a listing resume after a cursor path, and lasts says
+    # for each part of the path whether it's the last entry shown in its directory.
+    # Subtrees outside the prefix, depth, cursor or sync rules are never opened. With a
+    # pack its files come along as PackedEntry, sorted in with the ones on the disk.
+    # With exact the prefix is a whole file path and only that file is yielded.
+    directory = os.path.expanduser(directory)
+    internal_dirs = {os.path.join(directory, HASH_CACHE.strip('/')), os.path.join(directory, META_DIR.strip('/'))}
+    prefix = prefix.strip('/')
+    after_parts = tuple(after.split('/')) if after else None
+    match_name = pattern is not None and '/' not in pattern
+
+    def wanted_dir(parts):
+        if rules is not None and (not rules.in_scope(parts, True) or rules.excluded(parts, True)):
+            return False
+        rel_dir = '/'.join(parts) + '/'
+        if prefix and not (rel_dir.startswith(prefix) or prefix.startswith(rel_dir)):
+            return False
+        return max_depth is None or len(parts) < max_depth
+
+    def wanted_file(parts):
+        if rules is not None and (not rules.in_scope(parts, False) or rules.excluded(parts, False)):
+            return False
+        rel_path = '/'.join(parts)
+        if prefix and not (rel_path == prefix if exact else rel_path.startswith(prefix)):
+            return False
+        if pattern is not None and not fnmatch.fnmatchcase(parts[-1] if match_name else rel_path, pattern):
+            return False
+        return max_depth is None or len(parts) <= max_depth
+
+    def walk(dir_path, parent_parts):
+        # lasts come back from the folder's own level down, the caller puts its own in front
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            # could be a folder only the pack has
+            if pack is None:
+                return
+            entries = []
+        if pack is not None:
+            # the pack's copy of a path is the current one
+            packed = pack.entries(parent_parts, dir_path)
+            names = {entry.name for entry in packed}
+            entries = [entry for entry in entries if entry.name not in names] + packed
+        entries.sort(key=lambda e: e.name)
+
+        visible = []
+        for entry in entries:
+            parts = parent_parts + (entry.name,)
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                # skip the hash cache and the server's own state
+                if entry.path in internal_dirs or entry.is_symlink():
+                    continue
+                if wanted_dir(parts):
+                    visible.append((entry, parts, True))
+            # skip half written files from an unfinished transfer
+            elif not is_temp_file(entry.name) and wanted_file(parts):
+                visible.append((entry, parts, False))
+
+        def shown():
+            # (first file, the rest) for each entry with anything to list, a folder
+            # whose files were all filtered out isn't shown at all
+            for entry, parts, is_dir in visible:
+                if is_dir:
+                    # the whole subtree sorts before the cursor
+                    if after_parts and parts < after_parts[:len(parts)]:
+                        continue
+                    files = walk(entry.path, parts)
+                    first = next(files, None)
+                    if first is not None:
+                        yield first, files
+                elif not after_parts or parts > after_parts:
+                    yield (parts, entry, ()), ()
+
+        # an entry is the last one shown once the next one turns out to have nothing
+        entries = shown()
+        current = next(entries, None)
+        while current is not None:
+            following = next(entries, None)
+            (parts, entry, lasts), rest = current
+            last = (following is None,)
+            yield parts, entry, last + lasts
+            for parts, entry, lasts in rest:
+                yield parts, entry, last + lasts
+            current = following
+
+    yield from walk(directory, ())
+
+def get_all_files_relative(directory: str, rules: SyncRules = None, pack: 'PackStore' = None) -> list[str]:
+    return [os.sep.join(parts) for parts, entry, lasts in scan_files(directory, rules=rules, pack=pack)]
+
+def print_dir_structure(files_list: list[str]):
     tree = {}
     for path in files_list:
         parts = path.split(os.sep)
@@ -87,84 +524,728 @@ def print_dir_structure(files_list: List[str]):
 
     print_tree(tree)
 
-def load_cached_hash(file_path: str) -> str:
+def print_dir_stream(entries):
+    # entries arrive depth first with a last flag per path part, so each line can be
+    # printed as soon as it's received without building the whole tree
+    previous = ()
+    for entry in entries:
+        parts = tuple(entry['path'].split('/'))
+        lasts = entry['last']
+
+        # directories already printed for the previous file
+        common = 0
+        while common < min(len(previous), len(parts)) - 1 and previous[common] == parts[common]:
+            common += 1
+
+        for depth in range(common, len(parts)):
+            indent = ''.join("    " if lasts[d] else "│   " for d in range(depth))
+            connector = "└── " if lasts[depth] else "├── "
+            line = indent + connector + parts[depth]
+            if depth == len(parts) - 1:
+                line += format_file_fields(entry)
+            print(line)
+        previous = parts
+
+def format_file_fields(entry: dict) -> str:
+    fields = []
+    if 'size' in entry:
+        fields.append(format_size(entry['size']))
+    if 'mtime' in entry:
+        from datetime import datetime
+        fields.append(datetime.fromtimestamp(entry['mtime']).strftime(DATE_FORMAT))
+    if 'hash' in entry:
+        fields.append(entry['hash'][:12])
+    return (BLUE + '  ' + '  '.join(fields) + ANSII_RESET) if fields else ''
+
+def format_size(size: int) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return (str(size) if unit == 'B' else f"{size:.1f}") + ' ' + unit
+        size /= 1024
+
+class HashCache:
+    # Hashes of the files under one root, kept in root/.hash_cache next to the mtime they
+    # were taken at, so only files that changed since get read again
+
+    def __init__(self, root: str):
+        self.root = root
+        self.dir = root + HASH_CACHE
+
+    def path(self, file_path: str) -> str:
+        file_mod = file_path.replace("\\", '#').replace(" ", "#").replace("/", "#")
+        return self.dir + "/" + file_mod
 
-    try:
+    def load(self, file_path: str) -> str:
 
-        file_mod = file_path.replace("\\", '#').replace(" ", "#").replace("/", "#")
+        try:
 
-        with open(DIRECTORY + HASH_CACHE + "/" + file_mod, "r") as f:
-            lines = f.readlines()
-            time_stamp = float(lines[0].strip())
-            hash = lines[1].strip()
+            with open(self.path(file_path), "r") as f:
+                lines = f.readlines()
+                time_stamp = float(lines[0].strip())
+                hash = lines[1].strip()
 
-            last_mod = os.path.getmtime(file_path)
-            if last_mod == time_stamp:
-               return hash
-    except BaseException as e:
-        pass
+                last_mod = os.path.getmtime(file_path)
+                # an entry can hold just a version vector
+                if last_mod == time_stamp and hash:
+                   return hash
+        except BaseException:
+            pass
 
-    return None
+        return None
 
-def cache_hash(file_path: str, hash: str):
-    os.makedirs(DIRECTORY + HASH_CACHE, exist_ok=True)
+    def store(self, file_path: str, hash: str, version: dict[str, int] = None):
+        # the version vector stays as it was unless a new one is given
+        version_line = self.read_entry(file_path)[2] if version is None else version_line_for(version, os.path.getmtime(file_path))
+        self.write_entry(file_path, hash, os.path.getmtime(file_path), version_line)
+
+    def read_entry(self, file_path: str) -> list[str]:
+        # [mtime, hash, version line] with blanks for whatever isn't there
+        try:
+            with open(self.path(file_path), "r") as f:
+                lines = [line.strip() for line in f.readlines()]
+        except OSError:
+            lines = []
+        return (lines + ['', '', ''])[:3]
+
+    def write_entry(self, file_path: str, hash: str, mtime: float, version_line: str = ''):
+        os.makedirs(self.dir, exist_ok=True)
+
+        # write to a temp file and rename so a crash never leaves a torn entry
+        cache_path = self.path(file_path)
+        temp_path = temp_path_for(cache_path)
+        write_hash_cache_entry(temp_path, hash, mtime, version_line)
+        os.replace(temp_path, cache_path)
+
+    def version(self, file_path: str, node_id: str) -> dict[str, int]:
+        # The file's version vector, node id -> how many edits it has seen from there.
+        # It's stamped with the mtime it was true at, a file changed since then gets one
+        # more edit from this node. Nothing is read but the cache entry.
+        time_stamp, hash, version_line = self.read_entry(file_path)
+        mtime = os.path.getmtime(file_path)
+        stamped, version = parse_version_line(version_line)
+        if stamped == mtime:
+            return version
+
+        version[node_id] = version.get(node_id, 0) + 1
+        self.write_entry(file_path, hash, float(time_stamp or 0), version_line_for(version, mtime))
+        return version
+
+    def unsynced_edit(self, file_path: str) -> bool:
+        # changed since its version vector was last written down, by the mtime and, if
+        # the cache still has the hash from then, by the content
+        time_stamp, hash, version_line = self.read_entry(file_path)
+        stamped = parse_version_line(version_line)[0]
+        if stamped == os.path.getmtime(file_path):
+            return False
+        if hash and stamped == float(time_stamp or 0):
+            return self.hash(file_path) != hash
+        return True
+
+    def base_version(self, file_path: str) -> dict[str, int]:
+        # the vector as last written down, without counting a local edit since then
+        return parse_version_line(self.read_entry(file_path)[2])[1]
+
+    def set_version(self, file_path: str, version: dict[str, int]):
+        time_stamp, hash, version_line = self.read_entry(file_path)
+        self.write_entry(file_path, hash, float(time_stamp or 0), version_line_for(version, os.path.getmtime(file_path)))
+
+    def hash(self, file_path: str, algorithm: str = 'sha256', chunk_size: int = 1024 * 1024) -> str:
+
+        # check if we have a cached hash
+        start = time.perf_counter()
+        hash_res = self.load(file_path)
+        if hash_res == None:
+            METRICS.inc('file_server_hash_cache_misses_total')
+            if VERBOSE:
+                print("HASHING: ", file_path, '○')
+            # otherwise hash the whole file
+            with span('hash'):
+                import hashlib
+                hash_func = hashlib.new(algorithm)
+                chunk_size = chunk_size_for(HASH_LIMIT, chunk_size)
+                with open(file_path, 'rb') as f:
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if not chunk:
+                            break
+                        hash_func.update(chunk)
+                        throttle(HASH_LIMIT, len(chunk), 'hash')
+
+
+                hash_res = hash_func.hexdigest()
+
+            # save hash in hash cache
+            self.store(file_path, hash_res)
+            profile_file('hash', file_path, time.perf_counter() - start, os.path.getsize(file_path))
+        else:
+            METRICS.inc('file_server_hash_cache_hits_total')
+            if VERBOSE:
+                print("CACHED HASH: ", file_path, '●')
+
+        return hash_res
+
+    def cleanup(self, limit=20):
+        # drops entries for files that are gone, a random few at a time so syncs stay quick
+        if not os.path.exists(self.dir):
+            return
 
-    file_mod = file_path.replace("\\", '#').replace(" ", "#").replace("/", "#")
-    with open(DIRECTORY + HASH_CACHE + "/" + file_mod, "w") as f:
-        f.write(str(os.path.getmtime(file_path)))
+        try:
+            cache_files = os.listdir(self.dir)
+        except OSError:
+            return
+
+        if not cache_files:
+            return
+
+        import random
+        to_check = cache_files if len(cache_files) <= limit else random.sample(cache_files, limit)
+
+        for cache_file in to_check:
+            cache_path = os.path.join(self.dir, cache_file)
+
+            # entries waiting on a commit, or left behind by a crash once they're old
+            if is_temp_file(cache_file):
+                try:
+                    if time.time() - os.path.getmtime(cache_path) > BATCH_TIMEOUT:
+                        os.remove(cache_path)
+                except OSError:
+                    pass
+                continue
+
+            orig_path = cache_file.replace('#', '/')
+            if not os.path.exists(orig_path):
+                try:
+                    os.remove(cache_path)
+                except OSError:
+                    pass
+
+def write_hash_cache_entry(cache_path: str, hash: str, mtime: float, version_line: str = ''):
+    with open(cache_path, "w") as f:
+        f.write(str(mtime))
         f.write('\n')
         f.write(hash)
         f.write('\n')
+        f.write(version_line)
         f.write('\n')
 
+def body_etag(body: bytes) -> str:
+    import hashlib
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
 
-def hash(file_path: str, algorithm: str = 'sha256', chunk_size: int = 1024 * 1024) -> str:
-
-    # check if we have a cached hash
-    hash_res = load_cached_hash(file_path)
-    if hash_res == None:
-        print("HASHING: ", file_path, '○')
-        # otherwise hash the whole file
-        hash_func = hashlib.new(algorithm)
-        with open(file_path, 'rb') as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                hash_func.update(chunk)
+def version_line_for(version: dict[str, int], mtime: float) -> str:
+    return str(mtime) + ' ' + json.dumps(version, separators=(',', ':'), sort_keys=True)
 
+def parse_version_line(version_line: str) -> tuple[float, dict[str, int]]:
+    # (mtime the vector was stamped at, vector), (None, {}) for a file never versioned
+    stamped, _, vector = version_line.partition(' ')
+    try:
+        return float(stamped), json.loads(vector)
+    except ValueError:
+        return None, {}
+
+def compare_versions(mine: dict[str, int], theirs: dict[str, int]) -> int:
+    # 1 if mine has seen every edit theirs has and more, -1 the other way round, 0 for
+    # the same version and None when each has an edit the other hasn't seen
+    mine_ahead = any(count > theirs.get(node, 0) for node, count in mine.items())
+    theirs_ahead = any(count > mine.get(node, 0) for node, count in theirs.items())
+    if mine_ahead and theirs_ahead:
+        return None
+    return 1 if mine_ahead else -1 if theirs_ahead else 0
+
+def versions_related(mine: dict[str, int], theirs: dict[str, int]) -> bool:
+    # copies that were never synced have no node in common, their vectors can't say
+    # which is newer
+    return bool(mine) and bool(theirs) and not set(mine).isdisjoint(theirs)
+
+def merge_versions(*versions: dict[str, int]) -> dict[str, int]:
+    merged = {}
+    for version in versions:
+        for node, count in version.items():
+            merged[node] = max(merged.get(node, 0), count)
+    return merged
+
+def make_executor(workers: int):
+    # on a single core the threads only add switching, so hash in the caller
+    workers = min(workers, os.cpu_count() or 1)
+    if workers <= 1:
+        return None
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+def hash_files(cache: HashCache, rel_paths: list[str], executor=None) -> dict[str, str]:
+    # reading is mostly waiting on the disk and hashlib lets go of the GIL, so a few files
+    # hash faster side by side
+    full_paths = [cache.root + '/' + rel_path for rel_path in rel_paths]
+    if executor is not None and len(full_paths) > 1:
+        hashes = executor.map(cache.hash, full_paths)
+    else:
+        hashes = map(cache.hash, full_paths)
+    return dict(zip(rel_paths, hashes))
 
-        hash_res = hash_func.hexdigest()
+# the module level versions work on DIRECTORY
+def load_cached_hash(file_path: str) -> str:
+    return HashCache(DIRECTORY).load(file_path)
 
-        # save hash in hash cache
-        cache_hash(file_path, hash_res)
-    else:
-        print("CACHED HASH: ", file_path, '●')
+def hash_cache_path(file_path: str) -> str:
+    return HashCache(DIRECTORY).path(file_path)
 
-    return hash_res
+def cache_hash(file_path: str, hash: str):
+    HashCache(DIRECTORY).store(file_path, hash)
 
+def hash(file_path: str, algorithm: str = 'sha256', chunk_size: int = 1024 * 1024) -> str:
+    return HashCache(DIRECTORY).hash(file_path, algorithm, chunk_size)
 
 def read(file_path: str) -> str:
     file_path = os.path.expanduser(file_path)
-    with open(file_path, 'rb') as file:
-        return base64.b64encode(file.read()).decode('utf-8')
+    with span('encode'):
+        with open(file_path, 'rb') as file:
+            import base64
+            return base64.b64encode(file.read()).decode('utf-8')
     
-def get_file_last_modified(file_path: str) -> datetime:
+def get_file_last_modified(file_path: str):
+    from datetime import datetime
     # Get the timestamp of last modification
     timestamp = os.path.getmtime(file_path)
     # Convert timestamp to a datetime object
     return datetime.fromtimestamp(timestamp)
 
-def write_file_with_dirs(file_path, binary_data, open_arg='wb'):
+def temp_path_for(file_path: str) -> str:
+    # temp files live next to their target so the final rename is atomic
+    dir_name, base_name = os.path.split(file_path)
+    return os.path.join(dir_name, '.' + base_name + '.' + os.urandom(4).hex() + TEMP_SUFFIX)
+
+def is_temp_file(name: str) -> bool:
+    return TEMP_NAME.fullmatch(name) is not None
+
+def remove_stale_temps(directory: str):
+    # temp files a crash left next to their targets, once no transfer could still own them
+    now = time.time()
+    for dir_path, dir_names, file_names in os.walk(directory):
+        for name in file_names:
+            if not is_temp_file(name):
+                continue
+            path = os.path.join(dir_path, name)
+            try:
+                if now - os.path.getmtime(path) > BATCH_TIMEOUT:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def fsync_path(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # directories can't be opened on windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def load_node_id(directory: str) -> str:
+    # names this copy of the directory for as long as it's around, made up on first use
+    path = os.path.expanduser(directory) + META_DIR + '/node_id'
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        node_id = os.urandom(8).hex()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(node_id)
+        return node_id
+
+def last_chunk(file_hash: str) -> bytes:
+    return b"0\r\n" + HASH_TRAILER.encode('utf-8') + b": " + file_hash.encode('utf-8') + b"\r\n\r\n"
+
+def read_trailers(fp) -> dict[str, str]:
+    # trailer lines after the zero-length chunk, up to the blank line
+    trailers = {}
+    while True:
+        line = fp.readline().strip()
+        if not line:
+            break
+        name, _, value = line.decode('utf-8', errors='ignore').partition(':')
+        trailers[name.strip().lower()] = value.strip()
+    return trailers
+
+def advertised_hash_matches(advertised: str, file_hash: str) -> bool:
+    # older senders don't advertise anything
+    return not advertised or advertised == file_hash
+
+# where a packed file's bytes are, with what its hash cache entry would otherwise hold
+PackedFile = namedtuple('PackedFile', ['pack', 'offset', 'size', 'hash', 'mtime_ns', 'version'])
+
+class PackedEntry:
+    # What scan_files yields for a file or folder that's only in a pack, it answers
+    # the few things asked of an os.DirEntry
+
+    def __init__(self, name: str, path: str, packed: PackedFile = None):
+        self.name = name
+        self.path = path
+        self.packed = packed
+
+    def is_dir(self) -> bool:
+        return self.packed is None
+
+    def is_symlink(self) -> bool:
+        return False
+
+    def stat(self):
+        import types
+        return types.SimpleNamespace(st_size=self.packed.size, st_mtime=self.packed.mtime_ns / 1e9, st_mtime_ns=self.packed.mtime_ns)
+
+class PackStore:
+    # Small files kept back to back in a few big append-only pack files, like git's
+    # packfiles, with an index saying where each one is along with its hash and version
+    # vector. A share of a few hundred thousand notes is then a few big files to read
+    # rather than a few hundred thousand to open and stat, and a batch of uploads is one
+    # append and one fsync. Paths don't change, scan_files and the endpoints look here
+    # as well as on the disk, and where both have a path the pack's copy is the one.
+    #   root/.file_server/packs/pack-N.dat   file contents, only ever appended to
+    #   root/.file_server/packs/index.jsonl  a line per change, replayed on startup
+
+    def __init__(self, root: str, limit: int = PACK_FILE_LIMIT):
+        self.root = os.path.expanduser(root)
+        self.dir = self.root + META_DIR + '/packs'
+        self.index_path = self.dir + '/index.jsonl'
+        self.limit = limit # biggest file that goes in, 0 to only read what's already packed
+        self.files: dict[str, PackedFile] = {}
+        self.children: dict[tuple, set] = {(): set()} # folder parts -> names in it, files and folders
+        self.lock = threading.Lock()
+        self.readers = {} # pack number -> open file
+        self.readers_lock = threading.Lock()
+        self.current = 0
+        self.load()
+
+    @staticmethod
+    def present(root: str) -> bool:
+        return os.path.isfile(os.path.expanduser(root) + META_DIR + '/packs/index.jsonl')
+
+    def pack_path(self, number: int) -> str:
+        return self.dir + '/pack-' + str(number) + '.dat'
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                change = json.loads(line)
+            except ValueError:
+                # the end of a write a crash cut short
+                continue
+            self.apply(change)
+
+        numbers = [int(name[5:-4]) for name in os.listdir(self.dir) if name.startswith('pack-') and name.endswith('.dat')]
+        self.current = max(numbers, default=0)
+        # packs mostly full of deleted and replaced files, or an index mostly of old lines
+        live = sum(packed.size for packed in self.files.values())
+        total = sum(os.path.getsize(self.pack_path(number)) for number in numbers)
+        if total - live > max(live, PACK_FILE_LIMIT) or len(lines) > 2 * len(self.files) + 1000:
+            self.repack()
+
+    def apply(self, change: dict):
+        path = change['path']
+        old = self.files.pop(path, None)
+        if change.get('deleted'):
+            if old is not None:
+                self.unlink(path)
+            return
+        self.files[path] = PackedFile(change['pack'], change['offset'], change['size'], change['hash'], change['mtime_ns'], change.get('version') or {})
+        if old is None:
+            self.link(path)
+
+    def link(self, path: str):
+        # adds the path to its folder, and each folder to the one above until one was there
+        parts = tuple(path.split('/'))
+        for i in range(len(parts) - 1, -1, -1):
+            names = self.children.setdefault(parts[:i], set())
+            if parts[i] in names:
+                break
+            names.add(parts[i])
+
+    def unlink(self, path: str):
+        # and folders left empty go too
+        parts = tuple(path.split('/'))
+        for i in range(len(parts) - 1, -1, -1):
+            names = self.children[parts[:i]]
+            names.discard(parts[i])
+            if names or i == 0:
+                break
+            del self.children[parts[:i]]
+
+    def record(self, changes: list[dict]):
+        # durable before anyone sees them, the caller holds the lock
+        os.makedirs(self.dir, exist_ok=True)
+        with open(self.index_path, 'a') as f:
+            f.write(''.join(json.dumps(change, separators=(',', ':')) + '\n' for change in changes))
+            f.flush()
+            os.fsync(f.fileno())
+        for change in changes:
+            self.apply(change)
+
+    def wants(self, size: int) -> bool:
+        return size <= self.limit
+
+    def get(self, rel_path: str) -> PackedFile:
+        return self.files.get(rel_path.replace('\\', '/'))
+
+    def entries(self, parts: tuple, dir_path: str) -> list[PackedEntry]:
+        with self.lock:
+            return [
+                PackedEntry(name, os.path.join(dir_path, name), self.files.get('/'.join(parts + (name,))))
+                for name in self.children.get(parts, ())
+            ]
+
+    def read(self, packed: PackedFile) -> bytes:
+        with self.readers_lock:
+            f = self.readers.get(packed.pack)
+            if f is None:
+                f = self.readers[packed.pack] = open(self.pack_path(packed.pack), 'rb')
+            if not hasattr(os, 'pread'):
+                f.seek(packed.offset)
+                return f.read(packed.size)
+        return os.pread(f.fileno(), packed.size, packed.offset)
+
+    def add(self, files: list[tuple]):
+        # (source path, rel path, hash, version) for each file, appended to the current
+        # pack in one go and fsynced once before the index points at any of them
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            changes = []
+            with open(self.pack_path(self.current), 'ab') as pack:
+                offset = pack.tell()
+                for source_path, rel_path, file_hash, version in files:
+                    with open(source_path, 'rb') as f:
+                        data = f.read()
+                    pack.write(data)
+                    changes.append({'path': rel_path, 'pack': self.current, 'offset': offset, 'size': len(data), 'hash': file_hash, 'mtime_ns': os.stat(source_path).st_mtime_ns, 'version': version})
+                    offset += len(data)
+                pack.flush()
+                os.fsync(pack.fileno())
+            self.record(changes)
+            if offset > PACK_SIZE:
+                self.current += 1
+
+    def remove(self, rel_paths: list[str]):
+        with self.lock:
+            changes = [{'path': rel_path, 'deleted': True} for rel_path in rel_paths if rel_path in self.files]
+            if changes:
+                self.record(changes)
+
+    def move(self, source: str, dest: str):
+        # the bytes stay where they are, only the index changes
+        with self.lock:
+            self.record([dict(self.files[source]._asdict(), path=dest), {'path': source, 'deleted': True}])
+
+    def set_version(self, rel_path: str, version: dict[str, int]):
+        with self.lock:
+            self.record([dict(self.files[rel_path]._asdict(), path=rel_path, version=version)])
+
+    def repack(self):
+        # Copies the files still in the index into fresh packs, in path order like a
+        # sync reads them, and starts the index over. The old packs go once the new
+        # index is in place, a crash before that leaves the old index pointing at them.
+        with self.lock:
+            old_numbers = range(self.current + 1)
+            self.current += 1
+            changes = []
+            pack = open(self.pack_path(self.current), 'wb')
+            try:
+                offset = 0
+                for rel_path in sorted(self.files):
+                    packed = self.files[rel_path]
+                    if offset > PACK_SIZE:
+                        os.fsync(pack.fileno())
+                        pack.close()
+                        self.current += 1
+                        pack = open(self.pack_path(self.current), 'wb')
+                        offset = 0
+                    pack.write(self.read(packed))
+                    changes.append(dict(packed._asdict(), path=rel_path, pack=self.current, offset=offset))
+                    offset += packed.size
+                pack.flush()
+                os.fsync(pack.fileno())
+            finally:
+                pack.close()
+
+            temp_path = temp_path_for(self.index_path)
+            with open(temp_path, 'w') as f:
+                f.write(''.join(json.dumps(change, separators=(',', ':')) + '\n' for change in changes))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.index_path)
+            fsync_path(self.dir)
+
+            self.close()
+            for number in old_numbers:
+                remove_quietly(self.pack_path(number))
+            self.files = {}
+            self.children = {(): set()}
+            for change in changes:
+                self.apply(change)
+
+    def close(self):
+        with self.readers_lock:
+            for f in self.readers.values():
+                f.close()
+            self.readers = {}
+
+    def edited(self, rel_path: str, cache: HashCache) -> dict[str, int]:
+        # a write that came without a version vector, one more edit from this node on
+        # top of whichever copy it replaces
+        packed = self.get(rel_path)
+        version = dict(packed.version) if packed is not None else parse_version_line(cache.read_entry(self.root + '/' + rel_path)[2])[1]
+        node_id = load_node_id(self.root)
+        version[node_id] = version.get(node_id, 0) + 1
+        return version
+
+class WriteBatch:
+    # Finished temp files wait here until commit(), which makes the whole batch
+    # durable with one group commit and then renames everything into place
+    # together with its hash cache entry. Until then the old files are untouched.
+    # With a pack, the small files go into it instead, in one append. Without a
+    # cache, like for a drop, only the files are written.
+
+    def __init__(self, cache: HashCache = None, pack: PackStore = None, executor=None):
+        self.cache = cache
+        self.pack = pack
+        self.executor = executor
+        self.pending = [] # (temp_path, file_path, cache_temp_path, cache_path, file_hash)
+        self.packed = [] # (temp_path, rel_path, file_hash, version)
+        self.created = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def add(self, temp_path: str, file_path: str, file_hash: str, version: dict[str, int] = None):
+        # the rename keeps the temp file's mtime so the cache entry can be written now.
+        # Without a version vector the old one is kept, stamped before this write it
+        # counts the write as a local edit.
+        if self.pack is not None and self.pack.wants(os.path.getsize(temp_path)):
+            rel_path = os.path.relpath(file_path, self.pack.root).replace(os.sep, '/')
+            self.packed.append((temp_path, rel_path, file_hash, self.pack.edited(rel_path, self.cache) if version is None else version))
+            return
+        if self.cache is None:
+            self.pending.append((temp_path, file_path, None, None, file_hash))
+            return
+        os.makedirs(self.cache.dir, exist_ok=True)
+        cache_path = self.cache.path(file_path)
+        cache_temp_path = temp_path_for(cache_path)
+        mtime = os.path.getmtime(temp_path)
+        version_line = self.cache.read_entry(file_path)[2] if version is None else version_line_for(version, mtime)
+        write_hash_cache_entry(cache_temp_path, file_hash, mtime, version_line)
+        self.pending.append((temp_path, file_path, cache_temp_path, cache_path, file_hash))
+
+    def commit(self) -> list[tuple]:
+        if not self.pending and not self.packed:
+            return []
+        with span('commit'):
+            return self.commit_packed() + self.commit_pending()
+
+    def commit_packed(self) -> list[tuple]:
+        if not self.packed:
+            return []
+        self.pack.add(self.packed)
+        committed = []
+        for temp_path, rel_path, file_hash, version in self.packed:
+            remove_quietly(temp_path)
+            # the pack has the file now, an older copy on the disk would only take space
+            file_path = self.pack.root + '/' + rel_path
+            remove_quietly(file_path)
+            remove_quietly(self.cache.path(file_path))
+            committed.append((file_path, file_hash))
+        self.packed = []
+        return committed
+
+    def fsync_all(self, paths):
+        # only these files, a global sync() would stall every other writer on the machine.
+        # A big batch hands them to the disk together so it can order the flushes itself
+        paths = list(paths)
+        if self.executor is not None and len(paths) > GROUP_COMMIT_MIN:
+            list(self.executor.map(fsync_path, paths))
+        else:
+            for path in paths:
+                fsync_path(path)
+
+    def commit_pending(self) -> list[tuple]:
+        if not self.pending:
+            return []
+        # make the data durable before anything becomes visible
+        self.fsync_all([path for temp_path, _, cache_temp_path, _, _ in self.pending for path in (temp_path, cache_temp_path) if path is not None])
+
+        dirs = set()
+        for temp_path, file_path, cache_temp_path, cache_path, _ in self.pending:
+            os.replace(temp_path, file_path)
+            dirs.add(os.path.dirname(file_path) or '.')
+            if cache_path is not None:
+                os.replace(cache_temp_path, cache_path)
+                dirs.add(os.path.dirname(cache_path))
+
+        # and make the renames themselves durable
+        self.fsync_all(dirs)
+
+        committed = [(file_path, file_hash) for _, file_path, _, _, file_hash in self.pending]
+        # files that grew out of the pack, the disk has the current copy now
+        if self.pack is not None:
+            self.pack.remove([os.path.relpath(file_path, self.pack.root).replace(os.sep, '/') for file_path, _ in committed])
+        self.pending = []
+        return committed
+
+    def abort(self):
+        for temp_path, _, cache_temp_path, _, _ in self.pending:
+            remove_quietly(temp_path)
+            if cache_temp_path is not None:
+                remove_quietly(cache_temp_path)
+        for temp_path, _, _, _ in self.packed:
+            remove_quietly(temp_path)
+        self.pending = []
+        self.packed = []
+
+def commit_single(temp_path: str, file_path: str, file_hash: str, batch: WriteBatch = None, cache: HashCache = None, version: dict[str, int] = None):
+    if batch is not None:
+        batch.add(temp_path, file_path, file_hash, version)
+        return
+
+    single = WriteBatch(cache or HashCache(DIRECTORY))
+    single.add(temp_path, file_path, file_hash, version)
+    single.commit()
+
+def write_file_with_dirs(file_path, binary_data, open_arg='wb', batch: WriteBatch = None, cache: HashCache = None, version: dict[str, int] = None):
     # Ensure parent directories exist
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    # Write content to the file
-    with open(file_path, open_arg) as file:
+    # Write content to a temp file, it's renamed into place on commit
+    temp_path = temp_path_for(file_path)
+    with open(temp_path, open_arg) as file:
         file.write(binary_data)
+    import hashlib
+    file_hash = hashlib.sha256(binary_data).hexdigest()
+    commit_single(temp_path, file_path, file_hash, batch, cache, version)
 
-def read_chunked_upload(handler, file_path):
+def read_chunked_upload(handler, file_path, batch: WriteBatch = None, limit: TokenBucket = None, cache: HashCache = None, version: dict[str, int] = None):
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, 'wb') as f:
+    temp_path = temp_path_for(file_path)
+    import hashlib
+    hash_func = hashlib.sha256()
+    complete = False
+    with open(temp_path, 'wb') as f:
         while True:
             chunk_size_line = handler.rfile.readline().strip()
             if not chunk_size_line:
@@ -172,13 +1253,125 @@ def read_chunked_upload(handler, file_path):
             try:
                 chunk_size = int(chunk_size_line, 16)
             except ValueError:
-                return False
+                break
             if chunk_size == 0:
+                advertised = read_trailers(handler.rfile).get(HASH_TRAILER, handler.headers.get(HASH_TRAILER))
+                complete = advertised_hash_matches(advertised, hash_func.hexdigest())
                 break
             chunk_data = handler.rfile.read(chunk_size)
             handler.rfile.read(2)
+            if len(chunk_data) != chunk_size:
+                break
             f.write(chunk_data)
-    return True
+            hash_func.update(chunk_data)
+            throttle(limit, chunk_size, 'receive')
+
+    # a cancelled, broken or corrupted upload never replaces the existing file
+    if not complete:
+        remove_quietly(temp_path)
+        return False
+
+    file_hash = hash_func.hexdigest()
+    commit_single(temp_path, file_path, file_hash, batch, cache, version)
+    return file_hash
+
+class ChunkedReader:
+    # A chunked request body read like a file, for things that want a stream like tarfile
+
+    def __init__(self, fp, limit: TokenBucket = None):
+        self.fp = fp
+        self.limit = limit
+        self.left = 0 # of the current chunk
+        self.done = False
+        self.trailers = {}
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while size != 0 and not self.done:
+            if self.left == 0:
+                line = self.fp.readline().strip()
+                if not line:
+                    raise OSError('upload cut off')
+                self.left = int(line.split(b';')[0], 16)
+                if self.left == 0:
+                    self.trailers = read_trailers(self.fp)
+                    self.done = True
+                    break
+            data = self.fp.read(self.left if size < 0 else min(size, self.left))
+            if not data:
+                raise OSError('upload cut off')
+            self.left -= len(data)
+            if self.left == 0:
+                self.fp.read(2)
+            if size > 0:
+                size -= len(data)
+            throttle(self.limit, len(data), 'receive')
+            parts.append(data)
+        return b''.join(parts)
+
+    def lines(self):
+        # the body a line at a time, each as soon as the chunk it's in has arrived
+        pending = b''
+        while True:
+            data = self.read(1)
+            if not data:
+                break
+            pending += data + self.read(self.left)
+            *lines, pending = pending.split(b'\n')
+            yield from lines
+        if pending:
+            yield pending
+
+class ChunkedWriter:
+    # What's written goes out as http chunks, collected up to STREAM_BUFFER first so
+    # tar's 512 byte headers don't each become a packet
+
+    def __init__(self, conn, limit: TokenBucket = None):
+        self.conn = conn
+        self.limit = limit
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data: bytes) -> int:
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= STREAM_BUFFER:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffered:
+            self.conn.send(f"{self.buffered:X}\r\n".encode('utf-8') + b''.join(self.buffer) + b"\r\n")
+            throttle(self.limit, self.buffered, 'send')
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.conn.send(b"0\r\n\r\n")
+
+class HashingReader:
+    # hashes a file as something else reads it, so it's only read once
+
+    def __init__(self, f):
+        import hashlib
+        self.f = f
+        self.hash_func = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.hash_func.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self.hash_func.hexdigest()
+
+def safe_join(root: str, name: str) -> str:
+    # names in an archive are whatever the sender picked, None for any that would land outside root
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or name.startswith(('/', '\\')) or re.match(r'[A-Za-z]:', parts[0]):
+        return None
+    return os.path.join(root, *parts)
 
 def parse_url(url: str):
     # parsed_url = urlparse(url)
@@ -203,13 +1396,93 @@ def parse_url(url: str):
     
     path = url[i:]
 
+    import http.client
     conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
     if port is None:
         port = 443 if scheme == 'https' else 80
 
     return host, port, path, conn_class
 
-def call(url: str, method: str, body: any, headers={'Content-type': 'application/json'}, timeout=5000) -> list[int, any]:
+class ConnectionPool:
+    # Idle kept-alive connections per server, so a sync doesn't reconnect for every request
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = size
+        self.idle = {} # (conn_class, host, port) -> idle connections
+        self.lock = threading.Lock()
+        self.validators = OrderedDict() # url -> (etag, response body, size in bytes) of recent GETs
+        self.validator_bytes = 0
+
+    def validator(self, url: str):
+        with self.lock:
+            if url in self.validators:
+                self.validators.move_to_end(url)
+            return self.validators.get(url)
+
+    def remember(self, url: str, etag: str, body: any, size: int):
+        # size is the response's length, one that would push out most of the rest isn't kept
+        with self.lock:
+            old = self.validators.pop(url, None)
+            if old is not None:
+                self.validator_bytes -= old[2]
+            if etag and body is not None and size <= VALIDATOR_CACHE_SIZE // 4:
+                self.validators[url] = (etag, body, size)
+                self.validator_bytes += size
+            while self.validator_bytes > VALIDATOR_CACHE_SIZE:
+                self.validator_bytes -= self.validators.popitem(last=False)[1][2]
+
+    def take(self, host, port, conn_class, timeout):
+        with self.lock:
+            idle = self.idle.get((conn_class, host, port))
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return conn_class(host, port, timeout=timeout), False
+
+    def release(self, conn, response):
+        # only a connection whose response was read to the end can carry another request
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+
+        with self.lock:
+            idle = self.idle.setdefault((type(conn), conn.host, conn.port), [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url: str, send, timeout=5000):
+        # sends on a kept-alive connection when there's one, if the server dropped it
+        # in the meantime the request is retried once on a fresh connection
+        host, port, path, conn_class = parse_url(url)
+        conn, reused = self.take(host, port, conn_class, timeout)
+        try:
+            send(conn, path)
+            return conn, conn.getresponse()
+        except ConnectionError:
+            conn.close()
+            if not reused:
+                raise
+
+        conn = conn_class(host, port, timeout=timeout)
+        send(conn, path)
+        return conn, conn.getresponse()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+CONNECTION_POOL = ConnectionPool() # for the module level helpers when they aren't given one
+
+def call(url: str, method: str, body: any, headers={'Content-type': 'application/json'}, timeout=5000, pool: ConnectionPool = None) -> list[int, any]:
+    pool = pool or CONNECTION_POOL
 
     if headers is None:
         headers = {}
@@ -219,19 +1492,26 @@ def call(url: str, method: str, body: any, headers={'Content-type': 'application
     redirect_count = 0
     current_url = url
 
+    # a request sent before goes with the ETag it got, a 304 means the last answer still
+    # stands. POSTs are told apart by their body, only the server decides what gets one.
+    payload = json.dumps(body) if body != None else None
+    key = url
+    if payload is not None:
+        import hashlib
+        key += '#' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    validator = pool.validator(key) if method in ('GET', 'POST') else None
+    request_headers = dict(headers, **{'If-None-Match': validator[0]}) if validator else headers
+
+    def send(conn, path):
+        if payload != None:
+            conn.request(method, path, body=payload, headers=request_headers)
+        else:
+            conn.request(method, path, headers=request_headers)
+
     while redirect_count < 10:
         
         # parse host and make request
-        host, port, path, conn_class = parse_url(current_url)
-        conn = conn_class(host, port, timeout=timeout)
-
-        if body != None:
-            payload = json.dumps(body)
-            conn.request(method, path, body=payload, headers=headers)
-        else:
-            conn.request(method, path, headers=headers)
-
-        response = conn.getresponse()
+        conn, response = pool.request(current_url, send, timeout=timeout)
 
         # handle redirects
         if response.status in (301, 302, 303, 307, 308):
@@ -245,75 +1525,511 @@ def call(url: str, method: str, body: any, headers={'Content-type': 'application
         else:
             # process response
             res_body = response.read().decode()
-            conn.close()
-            return response.status, json.loads(res_body) if res_body else {}
+            pool.release(conn, response)
+            if response.status == 304 and validator:
+                return 200, validator[1]
+            result = json.loads(res_body) if res_body else {}
+            if method in ('GET', 'POST') and response.status == 200:
+                pool.remember(key, response.getheader('ETag'), result, len(res_body))
+            return response.status, result
     # Too many redirects
     raise Exception("Too many redirects")
 
 
-def get(url: str, headers={}, timeout=5000) -> list[int, any]:
-    return call(url, 'GET', None, headers, timeout=timeout)
+def get(url: str, headers={}, timeout=5000, pool: ConnectionPool = None) -> list[int, any]:
+    return call(url, 'GET', None, headers, timeout=timeout, pool=pool)
+
+def get_lines(url: str, headers={}, timeout=5000, pool: ConnectionPool = None):
+    # streams a newline delimited json response one object at a time
+    pool = pool or CONNECTION_POOL
+    request_headers = dict(headers)
+    request_headers['Accept'] = NDJSON
+    validator = pool.validator(url)
+    if validator:
+        request_headers['If-None-Match'] = validator[0]
+    conn, response = pool.request(url, lambda conn, path: conn.request('GET', path, headers=request_headers), timeout=timeout)
+    etag = response.getheader('ETag')
+    items = [] if etag else None
+    size = 0
+    try:
+        if response.status == 304 and validator:
+            response.read()
+            yield from validator[1]
+            return
+        if response.status != 200:
+            res_body = response.read().decode()
+            raise Exception(json.loads(res_body).get('error', res_body) if res_body else str(response.status))
+        while True:
+            line = response.readline()
+            if not line:
+                break
+            size += len(line)
+            # a listing too big to keep stops being collected
+            if size > VALIDATOR_CACHE_SIZE // 4:
+                items = None
+            if line.strip():
+                item = json.loads(line)
+                if 'error' in item:
+                    raise Exception(item['error'])
+                if items is not None:
+                    items.append(item)
+                yield item
+        # kept for next time only once the whole stream is in
+        pool.remember(url, etag, items, size)
+    finally:
+        pool.release(conn, response)
+
+def list_remote_files(url: str, headers={}, page_size=LIST_PAGE_SIZE, pool: ConnectionPool = None, **params):
+    # follows the cursor page by page so neither side holds the whole listing
+    cursor = None
+    while True:
+        query = {k: v for k, v in params.items() if v is not None}
+        query['limit'] = page_size
+        if cursor:
+            query['cursor'] = cursor
+        cursor = None
+        for item in get_lines(url + '/list_files?' + urlencode(query), headers=headers, pool=pool):
+            if 'cursor' in item:
+                cursor = item['cursor']
+            else:
+                yield item
+        if not cursor:
+            return
+
+def post(url: str, body: any, headers={'Content-type': 'application/json'}, timeout=5000, pool: ConnectionPool = None) -> list[int, any]:
+    return call(url, 'POST', body, headers, timeout=timeout, pool=pool)
 
-def post(url: str, body: any, headers={'Content-type': 'application/json'}, timeout=5000) -> list[int, any]:
-    return call(url, 'POST', body, headers, timeout=timeout)
+def delete(url: str, body: any, headers={'Content-type': 'application/json'}, timeout=5000, pool: ConnectionPool = None) -> list[int, any]:
+    return call(url, 'DELETE', body, headers, timeout=timeout, pool=pool)
 
-def delete(url: str, body: any, headers={'Content-type': 'application/json'}, timeout=5000) -> list[int, any]:
-    return call(url, 'DELETE', body, headers, timeout=timeout)
+def chunked_file_upload(url: str, file_path: str, method: str, headers={'Content-type': 'application/octet-stream', 'Transfer-Encoding': 'chunked'}, timeout=5000, pool: ConnectionPool = None, limit: TokenBucket = None):
+    pool = pool or CONNECTION_POOL
 
-def chunked_file_upload(url: str, file_path: str, method: str, headers={'Content-type': 'application/octet-stream', 'Transfer-Encoding': 'chunked'}, timeout=5000):
-    
-    host, port, path, conn_class = parse_url(url)
-    conn = conn_class(host, port, timeout=timeout)
-    conn.putrequest(method, path)
     headers['Content-type'] = 'application/octet-stream'
     headers['Transfer-Encoding'] = 'chunked'
-    for key, value in headers.items():
-        conn.putheader(key, value)
-    conn.endheaders()
-
-    file_size = os.path.getsize(file_path)
-    i_sent = 0
-    file_dir = os.path.dirname(file_path)
-    if file_dir:
-        os.makedirs(file_dir, exist_ok=True)
-    with open(file_path, 'rb') as f:
-        while True:
-            chunk = f.read(1024*1024)  # 1MB chunks
-            if not chunk:
-                break
-            # Send chunk size in hex
-            conn.send(f"{len(chunk):X}\r\n".encode('utf-8'))
-            # Send chunk data
-            conn.send(chunk)
-            conn.send(b"\r\n")
-
-            i_sent += 1024*1024
-            print(START_OF_LINE_AND_CLEAR + file_path + ' --> ' + str(int(100 * i_sent / file_size)) + '%', end='')
-    print(START_OF_LINE_AND_CLEAR, end='')
 
-    # Send zero-length chunk to indicate end
-    conn.send(b"0\r\n\r\n")
+    def send(conn, path):
+        conn.putrequest(method, path)
+        for key, value in headers.items():
+            conn.putheader(key, value)
+        conn.endheaders()
+
+        file_size = os.path.getsize(file_path)
+        i_sent = 0
+        file_dir = os.path.dirname(file_path)
+        if file_dir:
+            os.makedirs(file_dir, exist_ok=True)
+        import hashlib
+        hash_func = hashlib.sha256()
+        chunk_size = chunk_size_for(limit)
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                hash_func.update(chunk)
+                # size line, data and CRLF in one send, separate small sends cost a round trip
+                conn.send(f"{len(chunk):X}\r\n".encode('utf-8') + chunk + b"\r\n")
+                throttle(limit, len(chunk), 'send')
+
+                i_sent += len(chunk)
+                print(START_OF_LINE_AND_CLEAR + file_path + ' --> ' + str(int(100 * i_sent / file_size)) + '%', end='')
+        print(START_OF_LINE_AND_CLEAR, end='')
+
+        # Send zero-length chunk to indicate end, the digest goes in a trailer so the
+        # receiver can verify what it got without reading the file again
+        conn.send(last_chunk(hash_func.hexdigest()))
 
-    response = conn.getresponse()
+    start = time.perf_counter()
+    with span('upload'):
+        for attempt in range(TRANSFER_RETRIES + 1):
+            conn, response = pool.request(url, send, timeout=timeout)
 
-    res_body = response.read().decode()
-    conn.close()
+            res_body = response.read().decode()
+            pool.release(conn, response)
+            if not transfer_busy(response, attempt):
+                break
+            time.sleep(retry_after(response))
+    profile_file('upload', file_path, time.perf_counter() - start, os.path.getsize(file_path))
     return response.status, json.loads(res_body) if res_body else {}
 
-def chunked_file_download(url: str, headers={}, dest_file: str = None, timeout=5000):
+class AsyncResponse:
+    # A response read off an asyncio stream, what AsyncHTTP.request() yields
+
+    def __init__(self, reader, status: int, headers: dict[str, str]):
+        self.reader = reader
+        self.status = status
+        self.headers = headers # names in lower case
+        self.trailers = {}
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        self.left = 0 if status in (204, 304) or self.chunked else int(headers.get('content-length', 0))
+        self.done = not self.chunked and self.left == 0
+
+    def getheader(self, name: str, default=None):
+        return self.headers.get(name.lower(), default)
+
+    async def chunks(self):
+        if not self.chunked:
+            while self.left > 0:
+                data = await self.reader.read(min(self.left, STREAM_BUFFER))
+                if not data:
+                    raise ConnectionError('response cut off')
+                self.left -= len(data)
+                yield data
+        else:
+            while True:
+                line = await self.reader.readline()
+                if not line.strip():
+                    raise ConnectionError('response cut off')
+                size = int(line.strip().split(b';')[0], 16)
+                if size == 0:
+                    # trailer lines up to the blank line
+                    while True:
+                        line = (await self.reader.readline()).strip()
+                        if not line:
+                            break
+                        name, _, value = line.decode('utf-8', errors='ignore').partition(':')
+                        self.trailers[name.strip().lower()] = value.strip()
+                    break
+                data = await self.reader.readexactly(size + 2)
+                yield data[:-2]
+        self.done = True
+
+    async def read(self) -> bytes:
+        return b''.join([chunk async for chunk in self.chunks()])
+
+    async def json(self) -> any:
+        body = await self.read()
+        return json.loads(body) if body else {}
+
+    async def lines(self):
+        # a json lines body an object at a time, as the chunks come in
+        pending = b''
+        async for chunk in self.chunks():
+            pending += chunk
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        if pending.strip():
+            yield json.loads(pending)
+
+class AsyncHTTP:
+    # Kept-alive HTTP/1.1 connections to one server on asyncio streams, for AsyncSync.
+    # Only what talking to a SyncServer takes: bodies fixed or chunked either way, and no
+    # more than size requests at once.
+
+    def __init__(self, url: str, size: int = ASYNC_TRANSFERS):
+        import asyncio
+        host, port, path, conn_class = parse_url(url)
+        self.ssl = url.startswith('https')
+        self.host = host
+        self.port = int(port) if port else 443 if self.ssl else 80
+        self.base = path.rstrip('/')
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def connect(self):
+        import asyncio
+        if self.idle:
+            return self.idle.pop() + (True,)
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=True if self.ssl else None)
+        return reader, writer, False
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, path: str, headers: dict, body=None):
+        # body is bytes, or an async iterator of bytes that's sent chunked while the
+        # response is already being read
+        import asyncio
+        headers = dict(headers)
+        if body is None or isinstance(body, bytes):
+            headers['Content-Length'] = str(len(body or b''))
+        else:
+            headers['Transfer-Encoding'] = 'chunked'
+        head = method + ' ' + self.base + path + ' HTTP/1.1\r\nHost: ' + self.host + '\r\n'
+        head += ''.join(key + ': ' + str(value) + '\r\n' for key, value in headers.items()) + '\r\n'
+
+        async with self.slots:
+            for attempt in range(2):
+                reader, writer, reused = await self.connect()
+                try:
+                    writer.write(head.encode('utf-8') + (body if isinstance(body, bytes) else b''))
+                    await writer.drain()
+                    status_line = await reader.readline() if isinstance(body, (bytes, type(None))) else None
+                    if status_line == b'':
+                        raise ConnectionError('connection closed')
+                    break
+                except (ConnectionError, OSError):
+                    writer.close()
+                    # a kept-alive connection the server had already dropped, once
+                    if not reused or attempt:
+                        raise
+
+            sending = None
+            if status_line is None:
+                sending = asyncio.ensure_future(self.send_chunks(writer, body))
+                status_line = await reader.readline()
+            try:
+                if not status_line:
+                    raise ConnectionError('connection closed')
+                status = int(status_line.split()[1])
+                response_headers = {}
+                while True:
+                    line = (await reader.readline()).strip()
+                    if not line:
+                        break
+                    name, _, value = line.decode('utf-8', errors='ignore').partition(':')
+                    response_headers[name.strip().lower()] = value.strip()
+                response = AsyncResponse(reader, status, response_headers)
+
+                yield response
+
+                if sending is not None:
+                    # turned away before the body was read, the rest isn't wanted
+                    if response.status >= 300 and not sending.done():
+                        sending.cancel()
+                    else:
+                        await sending
+                if response.done and not (sending and sending.cancelled()) and response.getheader('connection', '').lower() != 'close':
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+            except BaseException:
+                if sending is not None:
+                    sending.cancel()
+                writer.close()
+                raise
+
+    async def send_chunks(self, writer, body):
+        async for data in body:
+            if data:
+                writer.write(f"{len(data):X}\r\n".encode('utf-8') + data + b"\r\n")
+                await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def call(self, method: str, path: str, headers: dict, body: any = None) -> tuple[int, any]:
+        # a json request and response, like call() does on a ConnectionPool
+        headers = dict(headers, **{'Content-type': 'application/json'})
+        async with self.request(method, path, headers, json.dumps(body).encode('utf-8') if body is not None else None) as response:
+            return response.status, await response.json()
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+def split_lanes(files: list[tuple], lanes: int = DROP_LANES) -> list[list[tuple]]:
+    # (full_path, rel_path, size) spread over as many lanes as the drop is big enough for,
+    # biggest files first onto the emptiest lane so the lanes finish about together
+    total = sum(size for _, _, size in files)
+    lane_count = max(1, min(lanes, total // DROP_LANE_SIZE, len(files)))
+    split = [[] for i in range(lane_count)]
+    loads = [0] * lane_count
+    for file in sorted(files, key=lambda file: -file[2]):
+        emptiest = loads.index(min(loads))
+        split[emptiest].append(file)
+        loads[emptiest] += file[2]
+    # in path order each lane's reads stay close together on disk
+    return [sorted(lane, key=lambda file: file[1]) for lane in split]
+
+def send_archive(url: str, files: list[tuple], headers={}, compress: bool = False, timeout=5000, pool: ConnectionPool = None, limit: TokenBucket = None):
+    # Streams (full_path, rel_path, size) files as one tar in a chunked request, gzipped
+    # with compress. Returns the status, the server's answer and the hash of every file
+    # as it was read, for the manifest check at the end of the drop.
+    import tarfile
+    pool = pool or CONNECTION_POOL
+    headers = dict(headers)
+    headers['Content-type'] = 'application/x-tar'
+    headers['Transfer-Encoding'] = 'chunked'
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    hashes = {}
+
+    def send(conn, path):
+        conn.putrequest('POST', path)
+        for key, value in headers.items():
+            conn.putheader(key, value)
+        conn.endheaders()
+
+        writer = ChunkedWriter(conn, limit)
+        stream = writer
+        if compress:
+            import gzip
+            # level 1, the network is what's slow, not the disk
+            stream = gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=1)
+        with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            for full_path, rel_path, size in files:
+                with open(full_path, 'rb') as f:
+                    info = tar.gettarinfo(arcname=rel_path.replace(os.sep, '/'), fileobj=f)
+                    reader = HashingReader(f)
+                    tar.addfile(info, reader)
+                hashes[rel_path.replace(os.sep, '/')] = reader.hexdigest()
+                if VERBOSE:
+                    print(full_path + ' -> ' + url)
+        if compress:
+            stream.close()
+        writer.close()
+
+    with span('upload'):
+        conn, response = pool.request(url, send, timeout=timeout)
+        res_body = response.read().decode()
+        pool.release(conn, response)
+    try:
+        body = json.loads(res_body) if res_body else {}
+    except ValueError:
+        body = res_body
+    return response.status, body, hashes
+
+def chunked_file_download(url: str, headers={}, dest_file: str = None, timeout=5000, batch: WriteBatch = None, pool: ConnectionPool = None, limit: TokenBucket = None, root: str = None):
+    start = time.perf_counter()
+    with span('download'):
+        status, file_path, size = download_to_file(url, headers, dest_file, timeout, batch, pool, limit, root)
+    profile_file('download', file_path, time.perf_counter() - start, size)
+    return status, file_path
+
+def download_range(url: str, headers: dict, start: int, end: int, timeout=5000, pool: ConnectionPool = None, limit: TokenBucket = None) -> bytes:
+    # bytes start to end of the file, both included
+    pool = pool or CONNECTION_POOL
+    headers = dict(headers, Range='bytes=' + str(start) + '-' + str(end))
+    conn, response = pool.request(url, lambda conn, path: conn.request('GET', path, headers=headers), timeout=timeout)
+    data = response.read()
+    pool.release(conn, response)
+    if response.status != 206 or len(data) != end - start + 1:
+        raise Exception('range ' + str(start) + '-' + str(end) + ' failed (' + str(response.status) + ')')
+    throttle(limit, len(data), 'receive')
+    return data
+
+def swarm_download(urls: list[str], rel_path: str, headers={}, dest_file: str = None, timeout=5000, batch: WriteBatch = None, pool: ConnectionPool = None, limit: TokenBucket = None, root: str = None):
+    # Pulls one file from every server in urls that has the same version of it as the
+    # first, a few pieces from each at a time. Every piece is checked against its hash
+    # before it's written, so a peer with a bad disk or another version only costs that
+    # piece being fetched again from someone else. A file of one piece, or with nobody
+    # else having it, is just a normal download from the first server.
+    import hashlib
+    import queue
+    pool = pool or CONNECTION_POOL
+    root = root or DIRECTORY
+    dest_file = dest_file or rel_path
+    file_headers = dict(headers, file_path=rel_path)
+
+    def pieces_from(url):
+        try:
+            status, response = get(url + '/pieces', headers=dict(file_headers), timeout=timeout, pool=pool)
+        except Exception:
+            return None
+        return response if status == 200 and isinstance(response, dict) and 'pieces' in response else None
+
+    listing = pieces_from(urls[0])
+    if listing is None or len(listing['pieces']) < 2 or len(urls) < 2:
+        return chunked_file_download(urls[0] + '/download', file_headers, dest_file, timeout, batch, pool, limit, root)
+    # like a 304, the copy here is already this version
+    cache = HashCache(root)
+    if os.path.isfile(root + '/' + dest_file) and cache.load(root + '/' + dest_file) == listing['hash']:
+        if listing.get('version'):
+            cache.set_version(root + '/' + dest_file, listing['version'])
+        return 304, dest_file
+
+    # the other servers are asked all at once, only the ones with the same hash join in
+    with span('pieces'):
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls) - 1) as executor:
+            others = list(executor.map(pieces_from, urls[1:]))
+    peers = [urls[0]] + [url for url, other in zip(urls[1:], others) if other is not None and other['hash'] == listing['hash']]
+
+    start_time = time.perf_counter()
+    size = listing['size']
+    piece_size = listing['piece_size']
+    piece_hashes = listing['pieces']
+    full_dest = root + '/' + dest_file
+    os.makedirs(os.path.dirname(full_dest), exist_ok=True)
+    temp_path = temp_path_for(full_dest)
+
+    todo = queue.Queue()
+    for index in range(len(piece_hashes)):
+        todo.put(index)
+    lock = threading.Lock()
+    finished = threading.Event()
+    failures = {url: 0 for url in peers}
+    received = 0
+    pieces_done = 0
+
+    def fetch(f, url):
+        nonlocal received, pieces_done
+        while not finished.is_set():
+            try:
+                index = todo.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            start = index * piece_size
+            end = min(start + piece_size, size) - 1
+            try:
+                data = download_range(url + '/download', file_headers, start, end, timeout, pool, limit)
+                if hashlib.sha256(data).hexdigest() != piece_hashes[index]:
+                    raise Exception('piece ' + str(index) + ' from ' + url + ' is corrupt')
+            except Exception:
+                # somebody else gets this piece
+                todo.put(index)
+                with lock:
+                    failures[url] += 1
+                    if failures[url] >= SWARM_MAX_FAILURES:
+                        return
+                continue
+            with lock:
+                f.seek(start)
+                f.write(data)
+                received += len(data)
+                pieces_done += 1
+                print(START_OF_LINE_AND_CLEAR + rel_path + ' --> ' + str(int(100 * received / size)) + '% from ' + str(len(peers)) + ' servers', end='')
+                if pieces_done == len(piece_hashes):
+                    finished.set()
+
+    with span('download'):
+        with open(temp_path, 'wb') as f:
+            f.truncate(size)
+            threads = [threading.Thread(target=fetch, args=(f, url), daemon=True) for url in peers for i in range(SWARM_CONNECTIONS)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    print(START_OF_LINE_AND_CLEAR, end='')
+
+    if not finished.is_set():
+        remove_quietly(temp_path)
+        raise Exception('download of ' + rel_path + ' failed, no server left to get the missing pieces from')
+
+    # every piece checked out, this catches a piece list that doesn't add up to the file hash
+    with span('hash'):
+        hash_func = hashlib.sha256()
+        with open(temp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hash_func.update(chunk)
+    if hash_func.hexdigest() != listing['hash']:
+        remove_quietly(temp_path)
+        raise Exception('download of ' + rel_path + ' is corrupt, hash mismatch')
+    commit_single(temp_path, full_dest, listing['hash'], batch, cache, listing.get('version'))
+    profile_file('download', rel_path, time.perf_counter() - start_time, size, peers=len(peers))
+    return 200, rel_path
+
+def download_to_file(url: str, headers={}, dest_file: str = None, timeout=5000, batch: WriteBatch = None, pool: ConnectionPool = None, limit: TokenBucket = None, root: str = None):
+    pool = pool or CONNECTION_POOL
+    root = root or DIRECTORY
 
     redirect_count = 0
+    busy_count = 0
     current_url = url
 
+    # the copy already here is offered by its hash, the server skips sending it if it's the same
+    cache = HashCache(root)
+    local_path = root + '/' + (dest_file or headers.get('file_path', ''))
+    local_hash = cache.load(local_path) if os.path.isfile(local_path) else None
+    if local_hash:
+        headers = dict(headers, **{'If-None-Match': '"' + local_hash + '"'})
+
     while redirect_count < 10:
         
         # parse host and make request
-        host, port, path, conn_class = parse_url(current_url)
-        conn = conn_class(host, port, timeout=timeout)
-
-        conn.request('GET', path, headers=headers)
-
-        response = conn.getresponse()
+        conn, response = pool.request(current_url, lambda conn, path: conn.request('GET', path, headers=headers), timeout=timeout)
 
         # handle redirects
         if response.status in (301, 302, 303, 307, 308):
@@ -324,14 +2040,36 @@ def chunked_file_download(url: str, headers={}, dest_file: str = None, timeout=5
             conn.close()
             redirect_count += 1
             continue
+        elif response.status == 304:
+            response.read()
+            pool.release(conn, response)
+            version = response.getheader('version')
+            if version:
+                cache.set_version(local_path, json.loads(version))
+            return response.status, dest_file or headers.get('file_path', ''), 0
+        elif transfer_busy(response, busy_count):
+            response.read()
+            pool.release(conn, response)
+            busy_count += 1
+            time.sleep(retry_after(response))
+            continue
+        elif response.status != 200:
+            res_body = response.read().decode(errors='ignore')
+            pool.release(conn, response)
+            raise Exception('download failed (' + str(response.status) + '): ' + res_body)
         else:
             # process response
             file_path = response.getheader('file_path', '')
             if dest_file == None: dest_file = file_path
             file_size = int(response.getheader('file_size', ''))
             i_recieved = 0
-            os.makedirs(os.path.dirname(DIRECTORY + '/' + dest_file), exist_ok=True)
-            with open(DIRECTORY + '/' + dest_file, 'wb') as f:
+            full_dest = root + '/' + dest_file
+            os.makedirs(os.path.dirname(full_dest), exist_ok=True)
+            temp_path = temp_path_for(full_dest)
+            import hashlib
+            hash_func = hashlib.sha256()
+            complete = False
+            with open(temp_path, 'wb') as f:
                 while True:
                     # Read the chunk size line
                     chunk_size_line = response.fp.readline().strip()
@@ -343,20 +2081,42 @@ def chunked_file_download(url: str, headers={}, dest_file: str = None, timeout=5
                         # Invalid chunk size
                         break
                     if size == 0:
-                        # Last chunk
+                        # Last chunk, check it against what the server says it sent
+                        advertised = read_trailers(response.fp).get(HASH_TRAILER, response.getheader(HASH_TRAILER))
+                        if not advertised_hash_matches(advertised, hash_func.hexdigest()):
+                            remove_quietly(temp_path)
+                            conn.close()
+                            raise Exception('download of ' + file_path + ' is corrupt, hash mismatch')
+                        complete = True
                         break
                     # Read the chunk data
                     chunk_data = response.fp.read(size)
                     # Read the trailing CRLF
                     response.fp.read(2)
+                    if len(chunk_data) != size:
+                        break
                     # Write chunk to file
                     f.write(chunk_data)
+                    hash_func.update(chunk_data)
+                    throttle(limit, size, 'receive')
 
                     i_recieved += size
                     print(START_OF_LINE_AND_CLEAR + file_path + ' --> ' + str(int(100 * i_recieved / file_size)) + '%', end='')
             print(START_OF_LINE_AND_CLEAR, end='')
 
-            return response.status, file_path
+            # never leave a half downloaded file where the real one should be
+            if not complete:
+                conn.close()
+                remove_quietly(temp_path)
+                raise Exception('download of ' + file_path + ' was cut off')
+
+            # the body was read by hand up to its very end so the connection can be reused
+            response.close()
+            pool.release(conn, response)
+
+            version = response.getheader('version')
+            commit_single(temp_path, full_dest, hash_func.hexdigest(), batch, cache, json.loads(version) if version else None)
+            return response.status, file_path, i_recieved
         
     # Too many redirects
     raise Exception("Too many redirects")
@@ -416,31 +2176,48 @@ def print_rainbow(str: str, end='\n'):
         print(color, c, sep='', end='')
     print(ANSII_RESET, end=end)
 
-def cleanup_hash_cache(limit=20):
-    cache_dir = DIRECTORY + HASH_CACHE
-    if not os.path.exists(cache_dir):
-        return
-
-    try:
-        cache_files = os.listdir(cache_dir)
-    except OSError:
-        return
-
-    if not cache_files:
-        return
+class DirectoryWatcher:
+    # Polls a directory for changes since there's nothing in the standard library to
+    # get notified. A poll only stats files, nothing gets read or hashed.
 
-    to_check = cache_files if len(cache_files) <= limit else random.sample(cache_files, limit)
+    def __init__(self, directory: str, rules: SyncRules = None):
+        self.directory = directory
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.snapshot = self.scan()
 
-    for cache_file in to_check:
-        cache_path = os.path.join(cache_dir, cache_file)
-        orig_path = cache_file.replace('#', '/')
-        if not os.path.exists(orig_path):
+    def scan(self) -> dict[str, tuple]:
+        snapshot = {}
+        for parts, entry, lasts in scan_files(self.directory, rules=self.rules):
             try:
-                os.remove(cache_path)
+                stat = entry.stat()
             except OSError:
-                pass
+                continue
+            snapshot['/'.join(parts)] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def poll(self):
+        with self.lock:
+            current = self.scan()
+            changed = [path for path, signature in current.items() if self.snapshot.get(path) != signature]
+            deleted = [path for path in self.snapshot if path not in current]
+            self.snapshot = current
+        return changed, deleted
+
+    def remember(self, rel_path: str):
+        # a change we made ourselves, so the next poll doesn't report it back
+        with self.lock:
+            try:
+                stat = os.stat(os.path.join(os.path.expanduser(self.directory), rel_path))
+                self.snapshot[rel_path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                self.snapshot.pop(rel_path, None)
+
+def cleanup_hash_cache(limit=20):
+    HashCache(DIRECTORY).cleanup(limit)
 
 def get_local_ip():
+    import socket
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         # This doesn't need to be reachable
@@ -460,89 +2237,570 @@ def get_network_ip():
     
     return local_ip[:i] + ".0/24"
 
+ACTION_UPLOAD, ACTION_DOWNLOAD, ACTION_CONFLICT, ACTION_DELETE, ACTION_MOVE = 'upload', 'download', 'conflict', 'delete', 'move'
+# one thing a sync has to do, source is where a move takes the file from
+SyncAction = namedtuple('SyncAction', ['kind', 'path', 'size', 'source'], defaults=[0, None])
+
+def plan_sync(local: dict[str, dict], remote: dict[str, dict], overwrite: bool = False) -> list[SyncAction]:
+    # Joins the client's manifest with the server's, both path -> {'hash', 'date', 'size',
+    # 'version'}. Syncing, the side whose version vector has seen every edit the other
+    # has wins, vectors that each saw an edit the other didn't are a conflict unless the
+    # hashes say both ended up the same. Files without related vectors fall back to the
+    # newer date and hashes. A file only the client has is an upload (or a server delete it
+    # has to decide about). Overwriting, the client wins and what only the server has
+    # goes. A file one side is missing that the other side has under another name is a
+    # move, nothing has to be sent for it.
+    actions = []
+    local_only = []
+    for path, mine in local.items():
+        theirs = remote.get(path)
+        if theirs is None:
+            local_only.append(path)
+            continue
+        versioned = versions_related(mine.get('version'), theirs.get('version'))
+        order = compare_versions(mine['version'], theirs['version']) if versioned else None
+        if order == 0 or (order is None and mine.get('hash') is not None and mine.get('hash') == theirs.get('hash')):
+            continue
+        if overwrite or order == 1 or (not versioned and mine['date'] > theirs['date']):
+            actions.append(SyncAction(ACTION_UPLOAD, path, mine.get('size') or 0))
+        elif order == -1 or (not versioned and mine['date'] < theirs['date']):
+            actions.append(SyncAction(ACTION_DOWNLOAD, path, theirs.get('size') or 0))
+        else:
+            actions.append(SyncAction(ACTION_CONFLICT, path, theirs.get('size') or 0))
+    remote_only = [path for path in remote if path not in local]
+
+    # moves come from the side that already has the content. Overwriting the server
+    # renames its copy, syncing the client copies its own and still decides about it.
+    sources, targets = (remote_only, local_only) if overwrite else (local_only, remote_only)
+    source_manifest, target_manifest = (remote, local) if overwrite else (local, remote)
+    by_hash = {}
+    for path in sources:
+        if source_manifest[path].get('hash'):
+            by_hash.setdefault(source_manifest[path]['hash'], []).append(path)
+    moved = set()
+    for path in targets:
+        candidates = [source for source in by_hash.get(target_manifest[path].get('hash'), []) if source not in moved]
+        if candidates:
+            if overwrite:
+                moved.add(candidates[0])
+            actions.append(SyncAction(ACTION_MOVE, path, target_manifest[path].get('size') or 0, candidates[0]))
+        else:
+            actions.append(SyncAction(ACTION_UPLOAD if overwrite else ACTION_DOWNLOAD, path, target_manifest[path].get('size') or 0))
+    for path in sources:
+        if path not in moved:
+            actions.append(SyncAction(ACTION_DELETE if overwrite else ACTION_UPLOAD, path, 0 if overwrite else source_manifest[path].get('size') or 0))
+
+    return sorted(actions, key=lambda action: action.path)
+
+def hash_needed(theirs: dict, version: dict[str, int]) -> bool:
+    # whether plan_sync needs this side's hash of a file the other side has too
+    if not versions_related(theirs.get('version'), version):
+        return True
+    return theirs.get('hash') is not None and compare_versions(theirs['version'], version) is None
+
+def manifest_entry(stat, version: dict[str, int], file_hash: str = None) -> dict:
+    from datetime import datetime
+    return {
+        'hash': file_hash,
+        'date': datetime.fromtimestamp(stat.st_mtime).strftime(DATE_FORMAT),
+        'size': stat.st_size,
+        'version': version,
+    }
+
+def print_plan(actions: list[SyncAction], rate: float, round_trip: float):
+    colors = {ACTION_UPLOAD: GREEN, ACTION_DOWNLOAD: BLUE, ACTION_CONFLICT: YELLOW, ACTION_DELETE: RED, ACTION_MOVE: VIOLET}
+    for action in actions:
+        line = colors[action.kind] + action.kind.ljust(9) + ANSII_RESET + action.path
+        if action.kind == ACTION_MOVE:
+            line += ' <- ' + action.source
+        elif action.kind != ACTION_DELETE:
+            line += '  ' + format_size(action.size)
+        print(line)
+
+    # conflicts get looked at, which means downloading the server's version
+    transfers = [action for action in actions if action.kind in (ACTION_UPLOAD, ACTION_DOWNLOAD, ACTION_CONFLICT)]
+    total = sum(action.size for action in transfers)
+    counts = {kind: sum(1 for action in actions if action.kind == kind) for kind in colors}
+    print()
+    print(', '.join(str(count) + ' ' + kind + ('s' if count != 1 else '') for kind, count in counts.items()))
+    seconds = total / rate + round_trip * len(transfers)
+    print(format_size(total) + ' to transfer, about ' + f"{seconds:.1f}" + 's at ' + format_size(int(rate)) + '/s')
+
+
+
+
+# METRICS
+
+METRIC_HELP = {
+    'file_server_requests_total': ('counter', 'Requests handled by route, method and status.'),
+    'file_server_request_duration_seconds': ('histogram', 'Time from reading the request line to finishing the response.'),
+    'file_server_received_bytes_total': ('counter', 'Bytes read from clients.'),
+    'file_server_sent_bytes_total': ('counter', 'Bytes written to clients.'),
+    'file_server_hash_cache_hits_total': ('counter', 'hash() calls answered from the hash cache.'),
+    'file_server_hash_cache_misses_total': ('counter', 'hash() calls that had to read the file.'),
+    'file_server_hash_cache_hit_ratio': ('gauge', 'Share of hash() calls answered from the hash cache.'),
+    'file_server_active_transfers': ('gauge', 'Uploads and downloads in progress.'),
+    'file_server_phase_seconds_total': ('counter', 'Time spent per request phase, only counted with --trace.'),
+    'file_server_throttled_seconds_total': ('counter', 'Time spent waiting on a rate limit, by direction (send, receive, hash or scrub).'),
+    'file_server_transfers_rejected_total': ('counter', 'Transfers turned away with a 503 because --max-transfers were running.'),
+    'file_server_memory_held_bytes': ('gauge', 'File contents held in sync responses being built or sent, counted against --memory-budget.'),
+    'file_server_memory_deferred_total': ('counter', 'Files left out of a sync response for the client to download because --memory-budget was used up.'),
+    'file_server_relay_pending': ('gauge', 'Changed paths queued for a --relay peer.'),
+    'file_server_relay_sent_total': ('counter', 'Uploads and deletes forwarded to a --relay peer.'),
+    'file_server_relay_conflicts_total': ('counter', 'Files a --relay peer had changed too, its copy kept as a conflict file.'),
+    'file_server_relay_errors_total': ('counter', 'Times a --relay peer could not be reached or refused a change.'),
+    'file_server_not_modified_total': ('counter', 'Requests answered with a 304 because the client already had the response.'),
+    'file_server_content_cache_hits_total': ('counter', 'Small files sent from the in memory content cache.'),
+    'file_server_content_cache_misses_total': ('counter', 'Small files that had to be read from disk to be sent.'),
+    'file_server_content_cache_hit_ratio': ('gauge', 'Share of small files sent from the in memory content cache.'),
+    'file_server_content_cache_bytes': ('gauge', 'Raw and base64 file contents held by the content cache, up to --content-cache.'),
+    'file_server_scrub_files_total': ('counter', 'Files --scrub read back and checked against their stored hash.'),
+    'file_server_scrub_bytes_total': ('counter', 'Bytes read by --scrub.'),
+    'file_server_scrub_mismatches_total': ('counter', "Files --scrub found didn't match their stored hash."),
+    'file_server_scrub_repaired_total': ('counter', 'Mismatched files --scrub fetched again from a peer.'),
+    'file_server_scrub_unrepaired': ('gauge', 'Mismatched files no peer had a good copy of yet.'),
+}
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ROUTES = {'/ping', '/sync', '/plan', '/plan_stream', '/move', '/commit', '/upload', '/download', '/pieces', '/delete', '/list_files', '/changes', '/scrub', '/metrics'}
+
+class Metrics:
+    # Counters, gauges and latency histograms rendered in the Prometheus text format
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [count per bucket..., sum, count]
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def get(self, name: str, **labels) -> float:
+        with self.lock:
+            return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    @contextlib.contextmanager
+    def transfer(self):
+        self.inc('file_server_active_transfers')
+        try:
+            yield
+        finally:
+            self.inc('file_server_active_transfers', -1)
+
+    def render(self) -> str:
+        hits = self.get('file_server_hash_cache_hits_total')
+        misses = self.get('file_server_hash_cache_misses_total')
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+        values[('file_server_hash_cache_hit_ratio', ())] = hits / (hits + misses) if hits + misses else 0
+        content_hits = values.get(('file_server_content_cache_hits_total', ()), 0)
+        content_misses = values.get(('file_server_content_cache_misses_total', ()), 0)
+        values[('file_server_content_cache_hit_ratio', ())] = content_hits / (content_hits + content_misses) if content_hits + content_misses else 0
+        values.setdefault(('file_server_active_transfers', ()), 0)
+
+        lines = []
+        for name, (kind, help) in METRIC_HELP.items():
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            if kind == 'histogram':
+                for (metric, labels), histogram in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], histogram[:len(LATENCY_BUCKETS)] + [histogram[-1]]):
+                        lines.append(name + '_bucket' + format_labels(labels + (('le', str(bound)),)) + ' ' + str(count))
+                    lines.append(name + '_sum' + format_labels(labels) + ' ' + str(histogram[-2]))
+                    lines.append(name + '_count' + format_labels(labels) + ' ' + str(histogram[-1]))
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(name + format_labels(labels) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
 
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels) + '}'
 
+class Trace:
+    # phase timings of one request, only collected with --trace
 
-# CLIENT METHODS
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
 
-def RUN_CLIENT(args):
-    
-    try:
-        if args.drop:
-            if not URL:
-                print_rainbow(SHRUG)
-                print("no server found for drop")
-                return
-            CLIENT_DROP()
-        elif args.la:
-            CLIENT_LIST_FILES()
-        elif args.overwrite:
-            CLIENT_OVERWRITE()
-        else:
-            CLIENT_SYNC()
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0) + seconds
 
-    except Exception as e:
-        print(RED + str(e) + ANSII_RESET)
-    
-def CLIENT_PING(host):
+    def header(self) -> str:
+        # Server-Timing so browsers and curl -v show it too
+        return ', '.join(name + ';dur=' + f"{seconds * 1000:.1f}" for name, seconds in self.phases.items())
+
+    def summary(self) -> str:
+        return ' '.join(name + '=' + f"{seconds * 1000:.1f}ms" for name, seconds in self.phases.items())
 
+TRACE_LOCAL = threading.local()
+
+@contextlib.contextmanager
+def span(name: str):
+    trace = getattr(TRACE_LOCAL, 'trace', None)
+    profiler = PROFILER
+    if trace is None and profiler is None:
+        yield
+        return
+    if profiler is not None and not profiler.enter(name):
+        # already inside this phase, the outer span counts the time
+        profiler = None
+    start = time.perf_counter()
+    start_cpu = time.process_time()
     try:
-        status, response = get(host + '/ping', timeout=1, headers={'password' : PASSWORD})
-        return status == 200 and response == 'up'
-    except Exception as e:
-        return False
-        
-def CLIENT_SYNC():
-    print()
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if trace is not None:
+            trace.add(name, seconds)
+        if profiler is not None:
+            profiler.leave(name, seconds, time.process_time() - start_cpu)
+
+def profile_file(op: str, file_path: str, seconds: float, size: int, **extra):
+    if PROFILER is not None:
+        PROFILER.file_event(op, file_path, seconds, size, **extra)
+
+class Profiler:
+    # Wall and CPU time per phase of a client run plus timings for every file hashed
+    # or transferred, written out as a JSON report with --profile. Optionally wraps
+    # the run in cProfile and tracemalloc as well.
+
+    def __init__(self, report_path: str, top: int = 10, use_cprofile: bool = False, use_tracemalloc: bool = False):
+        self.report_path = report_path
+        self.top = top
+        self.lock = threading.Lock()
+        self.active = set()
+        self.phases = {} # name -> {'wall', 'cpu', 'count'}
+        self.files = []
+        self.cprofile = None
+        self.use_tracemalloc = use_tracemalloc
+
+        if use_cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        if use_tracemalloc:
+            import tracemalloc
+            tracemalloc.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def enter(self, name: str) -> bool:
+        with self.lock:
+            if name in self.active:
+                return False
+            self.active.add(name)
+            return True
+
+    def leave(self, name: str, wall: float, cpu: float):
+        with self.lock:
+            self.active.discard(name)
+            phase = self.phases.setdefault(name, {'wall': 0, 'cpu': 0, 'count': 0})
+            phase['wall'] += wall
+            phase['cpu'] += cpu
+            phase['count'] += 1
+
+    def file_event(self, op: str, file_path: str, seconds: float, size: int, **extra):
+        event = {'op': op, 'path': file_path, 'seconds': seconds, 'bytes': size}
+        event.update(extra)
+        with self.lock:
+            self.files.append(event)
+
+    def finish(self) -> dict:
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+        report = {
+            'wall': time.perf_counter() - self.start_wall,
+            'cpu': time.process_time() - self.start_cpu,
+            'phases': self.phases,
+            'files': self.files,
+            'slowest_files': sorted(self.files, key=lambda event: event['seconds'], reverse=True)[:self.top],
+        }
 
-    while True:
-        files = get_all_files_relative(DIRECTORY)
-        file_path_to_file_hash = {}
-        print_rainbow("--Hashing files to compare with server--")
-        for file in files:
-            file_hash = hash(DIRECTORY + "/" + file)
-            file_path_to_file_hash[file] = {
-                'hash': file_hash,
-                'date': get_file_last_modified(DIRECTORY + "/" + file).strftime(DATE_FORMAT)
+        if self.use_tracemalloc:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report['memory'] = {
+                'current': current,
+                'peak': peak,
+                'top': [str(stat) for stat in snapshot.statistics('lineno')[:self.top]],
             }
-        print("\n\n", end="")
 
+        if self.cprofile is not None:
+            import io
+            import pstats
+            # the raw profile can be opened with snakeviz or pstats later
+            self.cprofile.dump_stats(self.report_path + '.prof')
+            out = io.StringIO()
+            pstats.Stats(self.cprofile, stream=out).sort_stats('cumulative').print_stats(self.top)
+            report['cprofile'] = out.getvalue()
 
-        print_rainbow("--Waiting for server to hash--")
-        status, response = post(URL + '/sync', file_path_to_file_hash, headers={'password' : PASSWORD})
-        print("done\n\n")
+        with open(self.report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
 
-        if status == 409:
-            file_path_to_file_contents = response['file_path_to_file_contents']
-            for file_path, file_contents in file_path_to_file_contents.items():
+    def print_summary(self, report: dict):
+        print()
+        print_rainbow('--Profile--')
+        print(f"total {report['wall']:.3f}s wall {report['cpu']:.3f}s cpu")
+        for name, phase in sorted(report['phases'].items(), key=lambda item: item[1]['wall'], reverse=True):
+            print('  ' + name.ljust(12) + f"{phase['wall']:9.3f}s wall {phase['cpu']:9.3f}s cpu  x{phase['count']}")
+        if report['slowest_files']:
+            print('slowest files:')
+            for event in report['slowest_files']:
+                print('  ' + event['op'].ljust(9) + f"{event['seconds']:8.3f}s " + format_size(event['bytes']).rjust(10) + '  ' + event['path'])
+        if 'memory' in report:
+            print('peak memory ' + format_size(report['memory']['peak']))
+        print('report written to ' + self.report_path)
 
-                is_large = file_contents == FILE_TOO_LARGE or os.path.getsize(DIRECTORY+ "/" + file_path) > SIZE_LIMIT
-                if not is_large:
-                    decoded_contents = base64.b64decode(file_contents).decode('utf-8', errors='ignore')
-                    local_contents = base64.b64decode(read(DIRECTORY+ "/" + file_path)).decode('utf-8', errors='ignore')
-                    print()
-                    print(BLUE + '```' + file_path + ANSII_RESET)
-                    display_diff(local_contents, decoded_contents)
-                    print(BLUE + '```' + file_path + ANSII_RESET)
-                    print()
-                else:
-                    print()
-                    print(BLUE + file_path + ANSII_RESET + ' (too large to display)')
-                    print()
-                    
+class CountingStream:
+    # wraps the handler's rfile/wfile to count bytes in and out
+
+    def __init__(self, stream, metric: str):
+        self.stream = stream
+        self.metric = metric
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        METRICS.inc(self.metric, len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        METRICS.inc(self.metric, len(data))
+        return data
 
-                print("*********************")
-                print_rainbow('CHANGE ' + TABLE_FLIP)
-                print("*********************")
+    def write(self, data):
+        METRICS.inc(self.metric, len(data))
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+METRICS = Metrics()
+
+
+# CLIENT METHODS
+
+class SyncClient:
+    # One local directory synced with one server. Its connections, hash cache, limits
+    # and hashing threads live here rather than in module globals, so a script can run
+    # syncs against several servers side by side:
+    #   with SyncClient('192.168.0.10:8000', '~/notes', password='...') as client:
+    #       client.SYNC()
+
+    def __init__(self, url: str, directory: str, password: str = '', rules: SyncRules = None, client_id: str = None, upload_limit: TokenBucket = None, download_limit: TokenBucket = None, workers: int = HASH_WORKERS, pool: ConnectionPool = None, peers: list[str] = None):
+        self.url = url
+        self.peers = list(peers or []) # other servers with the same files, downloads are spread over them
+        self.directory = os.path.expanduser(directory)
+        self.password = password
+        self.rules = rules
+        self.client_id = client_id or os.urandom(16).hex()
+        self.cache = HashCache(self.directory)
+        remove_stale_temps(self.directory)
+        self.upload_limit = upload_limit
+        self.download_limit = download_limit
+        self.workers = workers
+        self.executor = None
+        self.owns_pool = pool is None
+        self.pool = pool or ConnectionPool()
+        self.saved_node_id = None
+
+    @property
+    def node_id(self) -> str:
+        # names this copy in the version vectors, kept in META_DIR like a server's
+        if self.saved_node_id is None:
+            self.saved_node_id = load_node_id(self.directory)
+        return self.saved_node_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.owns_pool:
+            self.pool.close()
+
+    def headers(self, **extra) -> dict:
+        headers = {'password' : self.password, 'client_id' : self.client_id}
+        headers.update(extra)
+        return headers
+
+    def sync_headers(self, **extra) -> dict:
+        headers = self.headers(**extra)
+        if self.rules is not None:
+            headers['sync_rules'] = self.rules.to_header()
+        return headers
+
+    def get(self, path: str, timeout=5000):
+        return get(self.url + path, headers=self.headers(), timeout=timeout, pool=self.pool)
+
+    def post(self, path: str, body: any, headers: dict = None):
+        return post(self.url + path, body, headers=headers or self.headers(), pool=self.pool)
+
+    def delete(self, path: str, body: any, headers: dict = None):
+        return delete(self.url + path, body, headers=headers or self.headers(), pool=self.pool)
+
+    def upload(self, rel_path: str, batch_id: str = None, source: str = None, base: dict[str, int] = None):
+        # with a base the server takes the upload only if its copy hasn't moved on from it
+        headers = self.headers(file_path=rel_path)
+        if batch_id:
+            headers['batch'] = batch_id
+        if base is not None:
+            headers['base_version'] = json.dumps(base)
+        if source is None:
+            headers['version'] = json.dumps(self.cache.version(self.directory + "/" + rel_path, self.node_id))
+        status, response = chunked_file_upload(self.url + '/upload', source or self.directory + "/" + rel_path, 'POST', headers=headers, pool=self.pool, limit=self.upload_limit)
+        # the server's copy may have seen edits ours hasn't, now ours has too
+        if source is None and isinstance(response, dict) and response.get('version'):
+            self.cache.set_version(self.directory + "/" + rel_path, response['version'])
+        return status, response
+
+    def download(self, rel_path: str, dest_file: str = None, batch: WriteBatch = None):
+        if self.peers:
+            return swarm_download([self.url] + self.peers, rel_path, self.headers(), dest_file, batch=batch, pool=self.pool, limit=self.download_limit, root=self.directory)
+        return chunked_file_download(self.url + '/download', headers=self.headers(file_path=rel_path), dest_file=dest_file, batch=batch, pool=self.pool, limit=self.download_limit, root=self.directory)
+
+    def copy_local(self, source: str, rel_path: str, file_hash: str, batch: WriteBatch, version: dict[str, int] = None) -> bool:
+        # the server has a copy of one of our files here, no need to send it. False if
+        # the source isn't one of ours, the caller downloads the file instead
+        source_path = safe_join(self.directory, source)
+        if source_path is None or file_hash is None or not os.path.isfile(source_path):
+            return False
+        import shutil
+        full_path = self.directory + "/" + rel_path
+        temp_path = temp_path_for(full_path)
+        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+        shutil.copy2(source_path, temp_path)
+        batch.add(temp_path, full_path, file_hash, version)
+        return True
+
+    def catch_up(self, rel_path: str, version: dict[str, int]):
+        # same content on both sides, only the version vectors catch up
+        self.cache.set_version(self.directory + "/" + rel_path, version)
+
+    def write_contents(self, rel_path: str, contents: str, batch: WriteBatch, version: dict[str, int] = None):
+        # a file the server sent inline with the plan, base64 encoded
+        import base64
+        start = time.perf_counter()
+        with span('decode'):
+            data = base64.b64decode(contents)
+        with span('write'):
+            write_file_with_dirs(self.directory + "/" + rel_path, data, batch=batch, version=version)
+        profile_file('write', rel_path, time.perf_counter() - start, len(data))
+
+    def hash_files(self, rel_paths: list[str]) -> dict[str, str]:
+        if self.executor is None:
+            self.executor = make_executor(self.workers)
+        return hash_files(self.cache, rel_paths, self.executor)
+
+    def manifest(self) -> dict[str, dict[str, str]]:
+        # Path -> hash, modified date, size and version vector for everything this sync
+        # covers. A file edited here since it was last synced isn't hashed, its vector
+        # already says it's newer, unless the server's copy changed too.
+        with span('scan'):
+            stats = self.scan()
+        with span('version'):
+            versions = {file: self.cache.version(self.directory + "/" + file, self.node_id) for file in stats}
+        to_hash = [file for file in stats if self.wants_hash(file, versions[file])]
+        with span('hash'):
+            hashes = self.hash_files(to_hash)
+        return {file: manifest_entry(stat, versions[file], hashes.get(file)) for file, stat in stats.items()}
+
+    def scan(self) -> dict:
+        return {os.sep.join(parts): entry.stat() for parts, entry, lasts in scan_files(self.directory, rules=self.rules)}
+
+    def wants_hash(self, file: str, version: dict[str, int]) -> bool:
+        # never synced files might be a move, so they're hashed too
+        return set(version) == {self.node_id} or self.cache.load(self.directory + "/" + file) is not None
+
+    def manifest_entry(self, file: str, stat) -> dict:
+        # manifest() for one file, what the asyncio engine hashes a file at a time
+        version = self.cache.version(self.directory + "/" + file, self.node_id)
+        file_hash = self.cache.hash(self.directory + "/" + file) if self.wants_hash(file, version) else None
+        return dict(manifest_entry(stat, version, file_hash), path=file)
+
+    def plan(self, overwrite: bool = False) -> tuple[dict[str, dict], list[SyncAction]]:
+        # the server works out what a sync would do, nothing is read past the hashes
+        file_path_to_file_hash = self.manifest()
+        with span('server'):
+            status, response = self.post('/plan?overwrite=' + ('1' if overwrite else '0'), file_path_to_file_hash, headers=self.sync_headers())
+        if status != 200:
+            raise Exception('plan failed: ' + str(status) + ' ' + str(response))
+        return file_path_to_file_hash, [SyncAction(**action) for action in response['actions']]
+
+    def PING(self) -> bool:
+        return CLIENT_PING(self.url, self.password)
+
+    def unhashed(self, manifest: dict[str, dict], paths) -> list[str]:
+        # the paths whose manifest entries went out without a hash
+        return [path for path in paths if path in manifest and manifest[path].get('hash') is None]
+
+    def resolve(self, file_path_to_file_contents: dict[str, str]) -> bool:
+        # SYNC's prompts for files we have a newer or different copy of, a file at a
+        # time. False if the sync was cancelled. Contents are None when unknown.
+        import base64
+        for file_path, file_contents in file_path_to_file_contents.items():
+
+            is_large = file_contents in (None, FILE_TOO_LARGE) or os.path.getsize(self.directory + "/" + file_path) > SIZE_LIMIT
+            if not is_large:
+                decoded_contents = base64.b64decode(file_contents).decode('utf-8', errors='ignore')
+                local_contents = base64.b64decode(read(self.directory + "/" + file_path)).decode('utf-8', errors='ignore')
                 print()
-                print('You have a new file or a newer version of a file or a file that was deleted.')
+                print(BLUE + '```' + file_path + ANSII_RESET)
+                display_diff(local_contents, decoded_contents)
+                print(BLUE + '```' + file_path + ANSII_RESET)
+                print()
+            else:
                 print()
-                print_rainbow('Files Not On Server:')
-                for file, file_contents in file_path_to_file_contents.items():
-                    print(file)
+                print(BLUE + file_path + ANSII_RESET + (' (changed on the server while syncing)' if file_contents is None else ' (too large to display)'))
                 print()
 
-                print('''
+
+            print("*********************")
+            print_rainbow('CHANGE ' + TABLE_FLIP)
+            print("*********************")
+            print()
+            print('You have a new file or a newer version of a file or a file that was deleted.')
+            print()
+            print_rainbow('Files Not On Server:')
+            for file, file_contents in file_path_to_file_contents.items():
+                print(file)
+            print()
+
+            print('''
 Above is a diff of the first file with the server's version of the file. You can do the following:
 - '' -> (upload your version for all the files above)
 - 'up' -> (upload your version to the server for the first file. * you can also make changes before doing this)
@@ -550,362 +2808,2172 @@ Above is a diff of the first file with the server's version of the file. You can
 - 'pull' -> (replaces the first file with the server's version)
 - 'pull' <new_path> -> (copies the server's file to a new file)
 - <anything else> -> (cancel the sync)
-                ''')
+            ''')
 
+            with span('prompt'):
                 cmd = input()
-                print_rainbow(PUT_TABLE_BACK)
-                print()
-                if cmd == '':
-
-                    print("--", end='')
-                    print_rainbow('Uploaded', end='')
-                    print("--")
-
-                    for file_path, file_contents in file_path_to_file_contents.items():
-                        up_status, response = chunked_file_upload(
-                            URL + '/upload', 
-                            DIRECTORY + "/" + file_path, 
-                            'POST',
-                            headers={'password' : PASSWORD, 'file_path' : file_path}
-                        )
-                        print(file_path)
-                    break
+            print_rainbow(PUT_TABLE_BACK)
+            print()
+            if cmd == '':
+
+                print("--", end='')
+                print_rainbow('Uploaded', end='')
+                print("--")
 
-                elif cmd == 'up':
-                    up_status, response = chunked_file_upload(
-                        URL + '/upload', 
-                        DIRECTORY + "/" + file_path, 
-                        'POST',
-                        headers={'password' : PASSWORD, 'file_path' : file_path}
-                    )
-                    print("--", end='')
-                    print_rainbow('Uploaded', end='')
-                    print("--")
+                # the server holds the files back and makes them durable together on commit
+                batch_id = os.urandom(16).hex()
+                for file_path, file_contents in file_path_to_file_contents.items():
+                    up_status, response = self.upload(file_path, batch_id)
                     print(file_path)
+                self.post('/commit', batch_id)
+                return True
+
+            elif cmd == 'up':
+                up_status, response = self.upload(file_path)
+                print("--", end='')
+                print_rainbow('Uploaded', end='')
+                print("--")
+                print(file_path)
+                print()
+            elif cmd == 'del':
+                os.remove(self.directory + "/" + file_path)
+                print()
+                print_rainbow('Deleted ', end='')
+                print(file_path)
+                print()
+                continue
+            elif cmd.startswith('pull'):
+                splits = cmd.split(' ')
+                if len(splits) > 1:
+                    dest_file = splits[1]
+                    self.download(file_path, dest_file=dest_file)
                     print()
-                elif cmd == 'del':
-                    os.remove(DIRECTORY + "/" + file_path)
-                    print()
-                    print_rainbow('Deleted ', end='')
-                    print(file_path)
+                    print_rainbow('Copied to -> ', end='')
+                    print(dest_file)
                     print()
                     continue
-                elif cmd.startswith('pull'):
-                    splits = cmd.split(' ')
-                    if len(splits) > 1:
-                        dest_file = splits[1]
-                        chunked_file_download(URL + '/download', dest_file=dest_file, headers={'password' : PASSWORD, 'file_path' : file_path})
-                        print()
-                        print_rainbow('Copied to -> ', end='')
-                        print(dest_file)
-                        print()
-                        continue
-                    
-                    else:
-                        chunked_file_download(URL + '/download', headers={'password' : PASSWORD, 'file_path' : file_path})
-                    
+
                 else:
-                    print("*********")
-                    print_rainbow('CANCELLED')
-                    print("*********")
+                    self.download(file_path)
+
+            else:
+                print("*********")
+                print_rainbow('CANCELLED')
+                print("*********")
+                return False
+        return True
+
+    def SYNC(self):
+        print()
+
+        while True:
+            print_rainbow("--Hashing files to compare with server--")
+            file_path_to_file_hash = self.manifest()
+            print("\n\n", end="")
+
+
+            print_rainbow("--Waiting for server to hash--")
+            with span('server'):
+                status, response = self.post('/sync', file_path_to_file_hash, headers=self.sync_headers(moves='1', versions='1'))
+            print("done\n\n")
+
+            if status == 409:
+                # a file changed on both sides may have come out the same, which only its
+                # hash can tell, so any sent without one is hashed and asked about again
+                unhashed = self.unhashed(file_path_to_file_hash, response['file_path_to_file_contents'])
+                if unhashed:
+                    self.hash_files(unhashed)
+                    continue
+                if not self.resolve(response['file_path_to_file_contents']):
                     return
+                continue # call server again
+
+
+            file_path_to_file_contents = response
+            print("--", end='')
+            print_rainbow('Server Updates', end='')
+            print("--")
+            with WriteBatch(self.cache, executor=self.executor) as batch:
+                for file_path, entry in file_path_to_file_contents.items():
+                    contents = entry.get('contents') if isinstance(entry, dict) else entry
+                    version = entry.get('version') if isinstance(entry, dict) else None
+                    if contents is None and isinstance(entry, dict) and 'move' not in entry:
+                        self.catch_up(file_path, version)
+                        continue
+                    elif isinstance(entry, dict) and 'move' in entry:
+                        if not self.copy_local(entry['move'], file_path, file_path_to_file_hash.get(entry['move'], {}).get('hash'), batch, version):
+                            self.download(file_path, batch=batch)
+                    elif contents == FILE_TOO_LARGE:
+                        self.download(file_path, batch=batch)
+                    else:
+                        self.write_contents(file_path, contents, batch, version)
 
-            continue # call server again
+                    if file_path in file_path_to_file_hash:
+                        print(BLUE + file_path + ANSII_RESET)
+                    else:
+                        print(GREEN + file_path + ANSII_RESET)
 
+            break
 
-        file_path_to_file_contents = response
-        print("--", end='')
-        print_rainbow('Server Updates', end='')
-        print("--")
-        for file_path, contents in file_path_to_file_contents.items():
-            if contents == FILE_TOO_LARGE:
-                chunked_file_download(URL + '/download', headers={'password' : PASSWORD, 'file_path' : file_path})
-            else:
-                binary_data = base64.b64decode(contents)
-                write_file_with_dirs(DIRECTORY + "/" + file_path, binary_data)
+        print()
+        print("*************")
+        print_rainbow('SYNCED ' + WAVING)
+        print("*************")
+        self.cache.cleanup()
+        return file_path_to_file_contents
+
+    def LIST_FILES(self, prefix: str = None, glob: str = None, depth: int = None, fields: str = None):
+        entries = list_remote_files(
+            self.url,
+            headers=self.headers(),
+            pool=self.pool,
+            prefix=prefix,
+            glob=glob,
+            depth=depth,
+            fields=fields,
+            tree=1,
+        )
+        print()
+        print_dir_stream(entries)
 
-            if file_path in file_path_to_file_hash:
-                print(BLUE + file_path + ANSII_RESET)
-            else:
-                print(GREEN + file_path + ANSII_RESET)
+    def OVERWRITE(self):
+        print()
+        file_path_to_file_hash, actions = self.plan(overwrite=True)
 
-        break
+        if len(actions) > 0:
+            print("*********************")
+            print_rainbow('CHANGE ' + TABLE_FLIP)
+            print("*********************")
+            print()
 
-    print()
-    print("*************")
-    print_rainbow('SYNCED ' + WAVING)
-    print("*************")
-    cleanup_hash_cache()
-    return file_path_to_file_contents
-
-def CLIENT_LIST_FILES():
-    status, response = get(URL + '/list_files', timeout=5000, headers={'password' : PASSWORD})
-    print()
-    print_dir_structure(response)
+            print("--", end='')
+            print_rainbow('Applied Changes', end='')
+            print("--")
 
-def CLIENT_OVERWRITE():
-    print()
-    files = get_all_files_relative(DIRECTORY)
-    file_path_to_file_hash = {}
-    for file in files:
-        file_hash = hash(DIRECTORY + "/" + file)
-        file_path_to_file_hash[file] = {
-            'hash': file_hash,
-            'date': get_file_last_modified(DIRECTORY + "/" + file).strftime(DATE_FORMAT)
-        }
+        # renames first, an upload can land where a file was moved away from
+        batch_id = os.urandom(16).hex()
+        for action in sorted(actions, key=lambda action: action.kind != ACTION_MOVE):
+            if action.kind == ACTION_MOVE:
+                self.post('/move', {'from': action.source, 'to': action.path})
+                print(VIOLET + action.path + ' <- ' + action.source + ANSII_RESET)
+            elif action.kind == ACTION_UPLOAD:
+                up_status, response = self.upload(action.path, batch_id)
+                print(GREEN + action.path + ANSII_RESET)
+            elif action.kind == ACTION_DELETE:
+                del_status, response = self.delete('/delete', action.path)
+                print(RED + action.path + ANSII_RESET)
+        # the server only knows a batch once something was uploaded into it
+        if any(action.kind == ACTION_UPLOAD for action in actions):
+            self.post('/commit', batch_id)
 
 
-    status, response = post(URL + '/sync', file_path_to_file_hash, headers={'password' : PASSWORD})
 
+        print()
+        print("*************")
+        print_rainbow('SYNCED ' + WAVING)
+        print("*************")
+        return actions
+
+    def PIPELINED(self, overwrite: bool = False):
+        # SYNC or OVERWRITE on the asyncio engine, the phased way for a server without
+        # /plan_stream. Files changed on both sides get SYNC's prompts afterwards.
+        print()
+        print_rainbow('--Syncing--')
+        engine = AsyncSync(self, overwrite)
+        actions = engine.run()
+        if actions is None:
+            return self.OVERWRITE() if overwrite else self.SYNC()
+        # like SYNC, conflicts sent without a hash might be the same on both sides
+        unhashed = self.unhashed(engine.local, engine.conflicts)
+        if unhashed:
+            self.hash_files(unhashed)
+            return actions + self.PIPELINED(overwrite)
+        if engine.conflicts and not self.resolve(engine.conflicts):
+            return actions
 
-    if status == 409:
-        file_path_to_file_contents = response['file_path_to_file_contents']
-    else:
-        file_path_to_file_contents = response
+        print()
+        print("*************")
+        print_rainbow('SYNCED ' + WAVING)
+        print("*************")
+        self.cache.cleanup()
+        return actions
+
+    def DRY_RUN(self, overwrite: bool = False):
+        # prints what a sync or overwrite would do and roughly how long it would take
+        print()
+        start = time.perf_counter()
+        self.PING()
+        round_trip = time.perf_counter() - start
+        file_path_to_file_hash, actions = self.plan(overwrite)
+
+        limit = self.upload_limit if overwrite else self.download_limit
+        rate = limit.rate if limit is not None else ESTIMATE_RATE
+        print_rainbow('--Dry run, nothing was changed--')
+        print_plan(actions, rate, round_trip)
+        return actions
+
+
+    def WATCH(self, interval: float = WATCH_INTERVAL, debounce: float = DEBOUNCE_SECONDS):
+        # Syncs once, then keeps pushing local edits in debounced batches and pulling
+        # whatever the server announces on /changes until interrupted.
+
+        # ask where the journal is before syncing so nothing in between gets missed
+        status, position = self.get('/changes?since=-1')
+        self.SYNC()
+
+        watcher = DirectoryWatcher(self.directory, self.rules)
+        pending_changed = set()
+        pending_deleted = set()
+        resync = threading.Event()
+
+        def pull(change):
+            rel_path = change['path']
+            if self.rules is not None and not self.rules.wanted(rel_path):
+                return
+            local_path = self.directory + '/' + rel_path
+
+            with watcher.lock:
+                # an edit we haven't pushed yet wins, it goes up with the next batch
+                if rel_path in pending_changed or rel_path in pending_deleted:
+                    print(YELLOW + 'kept local ' + rel_path + ANSII_RESET)
+                    return
+            exists = os.path.exists(local_path)
+            # and so does one made since the last poll, that the watcher hasn't seen yet
+            edited = exists and self.cache.unsynced_edit(local_path)
+            if exists and change['op'] != 'delete' and change.get('hash') and self.cache.hash(local_path) == change['hash']:
+                watcher.remember(rel_path)
+                return
+            if edited:
+                print(YELLOW + 'kept local ' + rel_path + ANSII_RESET)
+                return
+            if change['op'] == 'delete':
+                if exists:
+                    os.remove(local_path)
+                    print(RED + '<- ' + rel_path + ANSII_RESET)
+            else:
+                self.download(rel_path, dest_file=rel_path)
+                print(BLUE + '<- ' + rel_path + ANSII_RESET)
+            watcher.remember(rel_path)
+
+        def listen():
+            generation = position['generation']
+            epoch = position['epoch']
+            while True:
+                try:
+                    query = urlencode({'since': generation, 'epoch': epoch, 'timeout': LONG_POLL_SECONDS})
+                    status, response = self.get('/changes?' + query, timeout=LONG_POLL_SECONDS + 30)
+                    if status != 200:
+                        raise Exception(response.get('error', status) if isinstance(response, dict) else status)
+                except Exception as e:
+                    print(RED + 'lost the server: ' + str(e) + ANSII_RESET)
+                    time.sleep(5)
+                    continue
 
-    if len(file_path_to_file_contents) > 0:
-        print("*********************")
-        print_rainbow('CHANGE ' + TABLE_FLIP)
-        print("*********************")
+                if response['reset']:
+                    # the server restarted or we fell too far behind
+                    resync.set()
+                for change in response['changes']:
+                    try:
+                        pull(change)
+                    except Exception as e:
+                        print(RED + str(e) + ANSII_RESET)
+                generation = response['generation']
+                epoch = response['epoch']
+
+        def push(changed, deleted) -> list[str]:
+            # returns the files the server had edits to that we haven't seen
+            batch_id = os.urandom(16).hex()
+            conflicts = []
+            for rel_path in changed:
+                local_path = self.directory + '/' + rel_path
+                if not os.path.exists(local_path):
+                    continue
+                status, response = self.upload(rel_path, batch_id, base=self.cache.base_version(local_path))
+                if status == 409:
+                    conflicts.append(rel_path)
+                    print(YELLOW + 'changed on both sides ' + rel_path + ANSII_RESET)
+                    continue
+                print(GREEN + '-> ' + rel_path + ANSII_RESET)
+            if changed:
+                self.post('/commit', batch_id)
+            for rel_path in deleted:
+                # like an upload, a delete only goes through over the copy we last synced
+                base = self.cache.base_version(self.directory + '/' + rel_path)
+                status, response = self.delete('/delete', rel_path, self.headers(base_version=json.dumps(base)) if base else None)
+                if status == 409:
+                    conflicts.append(rel_path)
+                    print(YELLOW + 'changed on the server, not deleted ' + rel_path + ANSII_RESET)
+                    continue
+                print(RED + '-> ' + rel_path + ANSII_RESET)
+            return conflicts
+
+        threading.Thread(target=listen, daemon=True).start()
         print()
-        
-        print("--", end='')
-        print_rainbow('Applied Changes', end='')
-        print("--")
-
-    for file_path, file_contents in file_path_to_file_contents.items():
-
-        if file_path in file_path_to_file_hash:
-            up_status, response = chunked_file_upload(
-                URL + '/upload', 
-                DIRECTORY + "/" + file_path, 
-                'POST',
-                headers={'password' : PASSWORD, 'file_path' : file_path}
-            )
-            print(GREEN + file_path + ANSII_RESET)
+        print_rainbow('--Watching ' + self.directory + '--')
+
+        first_change = None
+        last_change = None
+        try:
+            while True:
+                time.sleep(interval)
+                if resync.is_set():
+                    resync.clear()
+                    self.SYNC()
+                    with watcher.lock:
+                        watcher.snapshot = watcher.scan()
+
+                changed, deleted = watcher.poll()
+                now = time.time()
+                if changed or deleted:
+                    with watcher.lock:
+                        pending_changed.update(changed)
+                        pending_changed.difference_update(deleted)
+                        pending_deleted.update(deleted)
+                        pending_deleted.difference_update(changed)
+                    first_change = first_change or now
+                    last_change = now
+
+                # wait for a burst of edits to settle, but not forever
+                if first_change and (now - last_change >= debounce or now - first_change >= MAX_BATCH_DELAY):
+                    with watcher.lock:
+                        changed, deleted = sorted(pending_changed), sorted(pending_deleted)
+                    try:
+                        conflicts = push(changed, deleted)
+                    except Exception as e:
+                        # leave them pending and try again next round
+                        print(RED + str(e) + ANSII_RESET)
+                        continue
+                    with watcher.lock:
+                        pending_changed.difference_update(changed)
+                        pending_deleted.difference_update(deleted)
+                    first_change = None
+                    last_change = None
+                    if conflicts:
+                        # edits on both sides get the same prompts as a sync
+                        self.SYNC()
+                        with watcher.lock:
+                            watcher.snapshot = watcher.scan()
+        except KeyboardInterrupt:
+            print()
+            print_rainbow('stopped watching ' + WAVING)
+
+    def DROP(self, compress: bool = False, lanes: int = DROP_LANES):
+        path = self.directory
+        if not os.path.exists(path):
+            print(RED + f"Drop path not found: {path}" + ANSII_RESET)
+            return
+
+        if os.path.isfile(path):
+            rel_path = os.path.basename(path)
+            files_to_upload = [(path, rel_path, os.path.getsize(path))]
+            print_rainbow("--Sending file--")
         else:
-            del_status, response = delete(
-                URL + '/delete',
-                file_path,
-                headers={'password' : PASSWORD}
-            )
-            print(RED + file_path + ANSII_RESET)
+            base_dir = os.path.dirname(path.rstrip('/').rstrip('\\'))
+            files_to_upload = []
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    full_path = os.path.join(root, f)
+                    rel_path = os.path.relpath(full_path, base_dir)
+                    files_to_upload.append((full_path, rel_path, os.path.getsize(full_path)))
+            print_rainbow("--Sending folder--")
+
+        status, response = self.post('/drop_start', {})
+        if status == 404:
+            # an older receiver, one request per file
+            for full_path, rel_path, size in files_to_upload:
+                status, response = self.upload(rel_path, source=full_path)
+                print(full_path + ' -> ' + self.url)
+        elif status != 200 or not isinstance(response, dict) or 'drop' not in response:
+            print(RED + 'drop refused: ' + str(response) + ANSII_RESET)
+            return
+        elif not self.drop_archives(response['drop'], files_to_upload, compress, lanes):
+            return
 
+        print()
+        print("*************")
+        print_rainbow('SENT ' + WAVING)
+        print("*************")
+
+    def drop_archives(self, drop_id: str, files: list[tuple], compress: bool, lanes: int) -> bool:
+        # every lane is its own tar stream on its own connection, then one request checks
+        # that everything arrived with the hash it had when it was read here
+        split = split_lanes(files, lanes)
+        headers = self.headers(drop=drop_id)
+        send = lambda lane: send_archive(self.url + '/drop_archive', lane, headers, compress, pool=self.pool, limit=self.upload_limit)
+        # threads even on one core, the lanes mostly wait on the network
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(split)) as executor:
+            results = list(executor.map(send, split))
+
+        hashes = {}
+        for status, response, lane_hashes in results:
+            if status != 200:
+                print(RED + 'drop failed: ' + str(response) + ANSII_RESET)
+                return False
+            hashes.update(lane_hashes)
+
+        status, response = self.post('/drop_done', {'drop': drop_id, 'files': hashes})
+        if status != 200:
+            print(RED + 'drop incomplete, missing: ' + str(response.get('missing')) + ' mismatched: ' + str(response.get('mismatched')) + ANSII_RESET)
+            return False
+        return True
+
+class AsyncSync:
+    # SYNC and OVERWRITE as one pipeline on asyncio: manifest entries go to /plan_stream
+    # as they're hashed, and each action the server sends back starts a transfer right
+    # away, up to `transfers` at once. Hashing runs on the client's threads so it keeps
+    # going while the transfers wait on the network.
+
+    def __init__(self, client: SyncClient, overwrite: bool = False, transfers: int = ASYNC_TRANSFERS):
+        self.client = client
+        self.overwrite = overwrite
+        self.transfers = transfers
+        self.local = {} # path -> manifest entry, as sent
+        self.actions = []
+        self.conflicts = {} # path -> the server's contents, for SyncClient.resolve()
+        self.batch = WriteBatch(client.cache, executor=client.executor)
+        self.batch_id = os.urandom(16).hex()
+        self.uploads = 0
+
+    def run(self) -> list[SyncAction]:
+        # None if the server has no /plan_stream
+        import asyncio
+        return asyncio.run(self.main())
+
+    async def main(self):
+        import asyncio
+        # one more connection than transfers, the plan stream holds one the whole time
+        self.http = AsyncHTTP(self.client.url, self.transfers + 1)
+        self.slots = asyncio.Semaphore(self.transfers)
+        queue = asyncio.Queue()
+        producer = asyncio.ensure_future(self.produce(queue))
+        tasks = []
+        try:
+            query = urlencode({'overwrite': int(self.overwrite), 'contents': int(not self.overwrite)})
+            async with self.http.request('POST', '/plan_stream?' + query, self.client.sync_headers(), self.manifest_lines(queue)) as response:
+                if response.status == 404:
+                    # an older server, the caller goes the phased way instead
+                    await response.read()
+                    producer.cancel()
+                    return None
+                if response.status != 200:
+                    raise Exception('plan failed (' + str(response.status) + '): ' + (await response.read()).decode(errors='ignore'))
+                async for item in response.lines():
+                    if 'error' in item:
+                        raise Exception(item['error'])
+                    tasks.append(asyncio.ensure_future(self.apply(item)))
+            await producer
+            await asyncio.gather(*tasks)
+            if self.uploads:
+                await self.call('POST', '/commit', self.batch_id)
+        except BaseException:
+            producer.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(producer, *tasks, return_exceptions=True)
+            self.batch.abort()
+            raise
+        finally:
+            self.http.close()
+        self.batch.commit()
+        return self.actions
+
+    async def produce(self, queue):
+        # the scan and then every file's manifest entry, in whatever order they finish
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if self.client.executor is None:
+            self.client.executor = make_executor(self.client.workers)
+        self.batch.executor = self.client.executor
+        stats = await loop.run_in_executor(self.client.executor, self.client.scan)
+        futures = [loop.run_in_executor(self.client.executor, self.client.manifest_entry, file, stat) for file, stat in stats.items()]
+        for future in asyncio.as_completed(futures):
+            entry = await future
+            self.local[entry['path']] = entry
+            queue.put_nowait(json.dumps(entry) + '\n')
+        queue.put_nowait(None)
+
+    async def manifest_lines(self, queue):
+        # whatever was hashed since the last chunk goes out in the next one
+        while True:
+            lines = [await queue.get()]
+            while not queue.empty():
+                lines.append(queue.get_nowait())
+            done = lines[-1] is None
+            if done:
+                lines.pop()
+            if lines:
+                yield ''.join(lines).encode('utf-8')
+            if done:
+                return
 
+    async def call(self, method: str, path: str, body: any) -> tuple[int, any]:
+        status, response = await self.http.call(method, path, self.client.headers(), body)
+        if status >= 300:
+            raise Exception(path[1:] + ' failed (' + str(status) + '): ' + str(response))
+        return status, response
+
+    async def apply(self, item: dict):
+        if 'kind' not in item:
+            self.client.catch_up(item['path'], item['version'])
+            return
+        action = SyncAction(item['kind'], item['path'], item.get('size', 0), item.get('source'))
+        self.actions.append(action)
+        if action.kind == ACTION_CONFLICT or (action.kind == ACTION_UPLOAD and 'contents' in item):
+            # changed on both sides, or a file the server doesn't have that might have
+            # been deleted there, SyncClient.resolve() asks about them afterwards
+            self.conflicts[action.path] = item.get('contents')
+            return
+        async with self.slots:
+            if action.kind == ACTION_DOWNLOAD:
+                await self.download(action.path, item)
+                print((BLUE if action.path in self.local else GREEN) + action.path + ANSII_RESET)
+            elif action.kind == ACTION_MOVE and not self.overwrite:
+                await self.copy(action, item.get('version'))
+                print(GREEN + action.path + ANSII_RESET)
+            elif action.kind == ACTION_MOVE:
+                await self.call('POST', '/move', {'from': action.source, 'to': action.path})
+                print(VIOLET + action.path + ' <- ' + action.source + ANSII_RESET)
+            elif action.kind == ACTION_UPLOAD:
+                # a sync's upload only goes in over the copy the plan saw, an edit there
+                # since makes it a conflict
+                if not await self.upload(action.path, base=not self.overwrite):
+                    self.conflicts[action.path] = None
+                    return
+                print(GREEN + action.path + ANSII_RESET)
+            elif action.kind == ACTION_DELETE:
+                await self.call('DELETE', '/delete', action.path)
+                print(RED + action.path + ANSII_RESET)
+
+    async def in_thread(self, func, *args):
+        # the transfers are SyncClient's own, they block so they get a thread each
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def copy(self, action: SyncAction, version: dict[str, int]):
+        if not await self.in_thread(self.client.copy_local, action.source, action.path, self.local[action.source].get('hash'), self.batch, version):
+            await self.in_thread(self.client.download, action.path, None, self.batch)
+
+    async def download(self, rel_path: str, item: dict):
+        contents = item.get('contents')
+        if contents is None or contents == FILE_TOO_LARGE:
+            await self.in_thread(self.client.download, rel_path, None, self.batch)
+        else:
+            await self.in_thread(self.client.write_contents, rel_path, contents, self.batch, item.get('version'))
 
-    print()
-    print("*************")
-    print_rainbow('SYNCED ' + WAVING)
-    print("*************")
-    return file_path_to_file_contents
+    async def upload(self, rel_path: str, base: bool = False) -> bool:
+        # held by the server until the batch commits. False if the server's copy moved
+        # on from the base
+        full_path = self.client.directory + "/" + rel_path
+        status, response = await self.in_thread(self.client.upload, rel_path, self.batch_id, None, self.client.cache.base_version(full_path) if base else None)
+        if status == 409:
+            return False
+        if status != 200:
+            raise Exception('upload failed (' + str(status) + '): ' + str(response))
+        self.uploads += 1
+        return True
 
+def default_client() -> SyncClient:
+    # the client the command line and the module level CLIENT_ functions run, from URL, DIRECTORY and friends
+    return SyncClient(URL, DIRECTORY, PASSWORD, SYNC_RULES, CLIENT_ID, UPLOAD_LIMIT, DOWNLOAD_LIMIT, pool=CONNECTION_POOL, peers=PEERS)
 
-def CLIENT_DROP():
-    path = DIRECTORY
-    if not os.path.exists(path):
-        print(RED + f"Drop path not found: {path}" + ANSII_RESET)
-        return
+def RUN_CLIENT(args):
+    global PROFILER
 
-    if os.path.isfile(path):
-        rel_path = os.path.basename(path)
-        files_to_upload = [(path, rel_path)]
-        print_rainbow("--Sending file--")
-    else:
-        base_dir = os.path.dirname(path.rstrip('/').rstrip('\\'))
-        files_to_upload = []
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                full_path = os.path.join(root, f)
-                rel_path = os.path.relpath(full_path, base_dir)
-                files_to_upload.append((full_path, rel_path))
-        print_rainbow("--Sending folder--")
-
-    for full_path, rel_path in files_to_upload:
-        status, response = chunked_file_upload(
-            URL + '/upload',
-            full_path,
-            'POST',
-            headers={'file_path': rel_path}
-        )
-        print(full_path + ' -> ' + URL)
+    if getattr(args, 'profile', None):
+        PROFILER = Profiler(args.profile, args.profile_top, args.cprofile, args.tracemalloc)
+    client = default_client()
+    try:
+        if args.drop:
+            if not URL:
+                print_rainbow(SHRUG)
+                print("no server found for drop")
+                return
+            client.DROP(getattr(args, 'compress', False))
+        elif args.la:
+            client.LIST_FILES(getattr(args, 'prefix', None), getattr(args, 'glob', None), getattr(args, 'depth', None), getattr(args, 'fields', None))
+        elif getattr(args, 'dry_run', False):
+            client.DRY_RUN(args.overwrite)
+        elif args.overwrite:
+            client.OVERWRITE() if getattr(args, 'phased', False) else client.PIPELINED(overwrite=True)
+        elif args.watch:
+            client.WATCH(args.watch_interval or WATCH_INTERVAL, args.debounce or DEBOUNCE_SECONDS)
+        else:
+            client.SYNC() if getattr(args, 'phased', False) else client.PIPELINED()
 
-    print()
-    print("*************")
-    print_rainbow('SENT ' + WAVING)
-    print("*************")
+    except Exception as e:
+        print(RED + str(e) + ANSII_RESET)
+    finally:
+        client.close()
+        if PROFILER is not None:
+            profiler = PROFILER
+            PROFILER = None
+            profiler.print_summary(profiler.finish())
 
+def CLIENT_PING(host, password: str = None):
 
-# ENDPOINTS
+    try:
+        status, response = get(host + '/ping', timeout=1, headers={'password' : PASSWORD if password is None else password})
+        return status == 200 and response == 'up'
+    except Exception:
+        return False
 
-def SYNC(file_path_to_file_hash: Dict[str, Dict[str, str]]):
-    # print('made it')
-    files = get_all_files_relative(DIRECTORY)
+def CLIENT_SYNC():
+    with default_client() as client:
+        return client.SYNC()
 
+def CLIENT_LIST_FILES(args=None):
+    with default_client() as client:
+        client.LIST_FILES(getattr(args, 'prefix', None), getattr(args, 'glob', None), getattr(args, 'depth', None), getattr(args, 'fields', None))
 
-    # check if user has sent any new files
-    server_files = set(files)
-    new_user_files = {}
-    for file_path, file_hash_and_date in file_path_to_file_hash.items():
-        if file_path not in server_files:
-            new_user_files[file_path] = ''
-        else:
-            file_hash = hash(DIRECTORY + "/" + file_path)
-            client_modified_date = datetime.strptime(
-                file_path_to_file_hash[file_path]['date'], 
-                DATE_FORMAT
-            )
-            modified_date = get_file_last_modified(DIRECTORY + "/" + file_path)
+def CLIENT_OVERWRITE():
+    with default_client() as client:
+        return client.OVERWRITE()
+
+def CLIENT_WATCH(args):
+    with default_client() as client:
+        client.WATCH(args.watch_interval or WATCH_INTERVAL, args.debounce or DEBOUNCE_SECONDS)
+
+def CLIENT_DROP():
+    with default_client() as client:
+        client.DROP()
 
-            if file_hash != file_path_to_file_hash[file_path]['hash']:
-                if client_modified_date > modified_date:
-                    file_contents = None
-                    if os.path.getsize(DIRECTORY + "/" + file_path) > SIZE_LIMIT:
-                        file_contents = FILE_TOO_LARGE
-                    else:
-                        file_contents = read(DIRECTORY + "/" + file_path)
-                    new_user_files[file_path] = file_contents
 
+# ENDPOINTS
 
-    if len(new_user_files) > 0:
-        content = {
-            "error": "You have a newer file version", 
-            "file_path_to_file_contents": new_user_files
+class ChangeJournal:
+    # Recent uploads and deletes with a generation number each, so watching clients
+    # can long-poll for what changed since the last generation they saw. The epoch
+    # changes every time the server starts, a client seeing a new one resyncs.
+
+    def __init__(self):
+        self.epoch = os.urandom(16).hex()
+        self.generation = 0
+        self.changes = deque(maxlen=JOURNAL_SIZE)
+        self.condition = threading.Condition()
+        self.watcher = None
+        self.listeners = [] # called with every change, the relays queue them
+
+    def record(self, path: str, op: str, file_hash: str = None, origin: str = None, via: list[str] = ()):
+        # via is the node ids a relayed change has already been through
+        change = {'generation': 0, 'path': path, 'op': op, 'hash': file_hash, 'origin': origin, 'via': list(via)}
+        with self.condition:
+            self.generation += 1
+            change['generation'] = self.generation
+            self.changes.append(change)
+            self.condition.notify_all()
+
+        # our own writes aren't news to the directory watcher
+        if self.watcher is not None:
+            self.watcher.remember(path)
+        for listener in self.listeners:
+            listener(change)
+
+    def since(self, generation: int, epoch: str, origin: str = None, timeout: float = 0):
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                oldest = self.changes[0]['generation'] if self.changes else self.generation + 1
+                if epoch != self.epoch or generation > self.generation or generation < oldest - 1:
+                    return {'epoch': self.epoch, 'generation': self.generation, 'reset': True, 'changes': []}
+
+                changes = [
+                    {'path': change['path'], 'op': change['op'], 'hash': change['hash']}
+                    for change in self.changes
+                    if change['generation'] > generation and change['origin'] != origin
+                ]
+                remaining = deadline - time.time()
+                if changes or remaining <= 0:
+                    return {'epoch': self.epoch, 'generation': self.generation, 'reset': False, 'changes': changes}
+                self.condition.wait(remaining)
+
+def list_files_query(query: dict[str, list[str]]):
+    # filters shared by the plain and streamed listing
+    depth = query.get('depth', [None])[0]
+    path = query.get('path', [None])[0]
+    return {
+        'prefix': path or query.get('prefix', [''])[0],
+        'exact': bool(path),
+        'pattern': query.get('glob', [None])[0],
+        'max_depth': int(depth) if depth else None,
+        'after': query.get('cursor', [None])[0],
+    }
+
+class Listener:
+    # The http side of a SyncServer or SyncHost. The handler finds its way back
+    # through self.server.sync_server and asks route() which share a request is for.
+
+    def listen(self):
+        from http.server import ThreadingHTTPServer
+        # threaded so long-polling watchers don't hold up everyone else
+        self.httpd = ThreadingHTTPServer(self.address, handler_class('Server'))
+        self.httpd.sync_server = self
+        return self.httpd
+
+    def serve_forever(self):
+        if self.httpd is None:
+            self.listen()
+        self.httpd.serve_forever()
+
+    def start(self):
+        # serves from a background thread
+        if self.httpd is None:
+            self.listen()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop_listening(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    @property
+    def port(self) -> int:
+        # the real one once listening, port 0 picks a free port
+        return self.httpd.server_address[1] if self.httpd is not None else self.address[1]
+
+class SyncServer(Listener):
+    # One synced directory served over http. Its hash cache, change journal, upload
+    # batches, limits and hashing threads all live here rather than in module globals,
+    # so one process can serve several directories, each on its own port:
+    #   SyncServer('~/notes', port=8000).start()
+    #   SyncServer('~/photos', port=8002, password='...').serve_forever()
+    # or all on one port as the shares of a SyncHost, which hands in the executor,
+    # scan slots, memory budget, content cache, transfer slots and client buckets they
+    # have in common.
+
+    def __init__(self, directory: str, password: str = '', port: int = PORT, host: str = '', client_rates: dict = None, max_transfers: int = None, workers: int = HASH_WORKERS, executor=None, scan_slots: threading.Semaphore = None, memory: MemoryBudget = None, content: ContentCache = None, pack: bool = False, transfer_slots: threading.Semaphore = None, client_buckets: ClientBuckets = None):
+        self.directory = os.path.expanduser(directory)
+        self.password = password
+        self.address = (host, port)
+        self.cache = HashCache(self.directory)
+        remove_stale_temps(self.directory)
+        self.journal = ChangeJournal()
+        self.upload_batches: dict[str, WriteBatch] = {}
+        self.upload_batches_lock = threading.Lock()
+        self.versions_lock = threading.Lock()
+        self.client_buckets = client_buckets or ClientBuckets(client_rates)
+        self.transfer_slots = transfer_slots or (threading.BoundedSemaphore(max_transfers) if max_transfers else None)
+        self.workers = workers
+        self.executor = executor
+        self.owns_executor = executor is None
+        self.scan_slots = scan_slots
+        self.memory = memory
+        self.relays: list[Relay] = []
+        self.scrubber = None
+        self.saved_node_id = None
+        self.piece_lists = {} # (full path, piece size) -> ((mtime_ns, size), PIECES response), oldest first
+        self.piece_lists_lock = threading.Lock()
+        self.content = content or ContentCache(CONTENT_CACHE_SIZE)
+        # whatever changes here, through us or behind our back, doesn't need the memory anymore
+        self.journal.listeners.append(lambda change: self.content.forget(self.directory + '/' + change['path']))
+        # a share packed before keeps reading its packs, only with pack on do new files go in
+        self.pack = PackStore(self.directory, PACK_FILE_LIMIT if pack else 0) if pack or PackStore.present(self.directory) else None
+        self.httpd = None
+
+    @property
+    def node_id(self) -> str:
+        # only read or made once something asks, so a directory that's just being
+        # listed doesn't grow a META_DIR
+        if self.saved_node_id is None:
+            self.saved_node_id = load_node_id(self.directory)
+        return self.saved_node_id
+
+    def add_relay(self, url: str, password: str = None) -> 'Relay':
+        relay = Relay(self, url, self.password if password is None else password)
+        self.relays.append(relay)
+        self.journal.listeners.append(relay.enqueue)
+        return relay.start()
+
+    def start_scrubbing(self, rate: float = SCRUB_RATE, interval: float = SCRUB_INTERVAL, peers: list[tuple] = ()) -> 'Scrubber':
+        # relay peers hold the same files, so they're asked for good copies too
+        peers = list(peers) + [(relay.url, relay.password) for relay in self.relays]
+        self.scrubber = Scrubber(self, rate, interval, peers=peers)
+        self.journal.listeners.append(self.scrubber.changed)
+        return self.scrubber.start()
+
+    def quarantined(self, rel_path: str) -> bool:
+        # failed a scrub and no peer had a good copy, it isn't sent anywhere till it's fixed
+        return self.scrubber is not None and self.scrubber.unrepaired(rel_path.replace('\\', '/'))
+
+    def SCRUB(self):
+        if self.scrubber is None:
+            return 404, {'error': 'not scrubbing, start the server with --scrub'}
+        return 200, self.scrubber.status()
+
+    def seen(self, via: list[str]) -> bool:
+        # a relayed change that came round in a loop
+        return bool(via) and self.node_id in via
+
+    def shutdown(self):
+        self.stop_listening()
+        if self.executor is not None and self.owns_executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def route(self, path: str):
+        return self, path
+
+    def hashing_executor(self):
+        if self.executor is None and self.owns_executor:
+            self.executor = make_executor(self.workers)
+        return self.executor
+
+    def hash_files(self, rel_paths: list[str]) -> dict[str, str]:
+        self.hashing_executor()
+        # the pack's index has the hash of everything in it
+        packed = {rel_path: self.packed(rel_path) for rel_path in rel_paths} if self.pack is not None else {}
+        hashes = hash_files(self.cache, [rel_path for rel_path in rel_paths if packed.get(rel_path) is None], self.executor)
+        hashes.update((rel_path, entry.hash) for rel_path, entry in packed.items() if entry is not None)
+        return hashes
+
+    def packed(self, rel_path: str) -> PackedFile:
+        return self.pack.get(rel_path) if self.pack is not None else None
+
+    def exists(self, rel_path: str) -> bool:
+        return self.packed(rel_path) is not None or os.path.isfile(self.directory + '/' + rel_path)
+
+    def version(self, rel_path: str) -> dict[str, int]:
+        packed = self.packed(rel_path)
+        if packed is not None:
+            return packed.version
+        return self.cached_version(self.directory + '/' + rel_path)
+
+    def cached_version(self, full_path: str) -> dict[str, int]:
+        # counting an edit reads and rewrites the cache entry, two requests at once
+        # mustn't both count from the same old vector
+        with self.versions_lock:
+            return self.cache.version(full_path, self.node_id)
+
+    def set_version(self, rel_path: str, version: dict[str, int]):
+        if self.packed(rel_path) is not None:
+            self.pack.set_version(rel_path.replace('\\', '/'), version)
+        else:
+            with self.versions_lock:
+                self.cache.set_version(self.directory + '/' + rel_path, version)
+
+    def new_batch(self) -> WriteBatch:
+        return WriteBatch(self.cache, self.pack, self.hashing_executor())
+
+    @contextlib.contextmanager
+    def on_disk(self, rel_path: str):
+        # a path to read the file from, a packed one is copied out for as long as it's needed
+        packed = self.packed(rel_path)
+        if packed is None:
+            yield self.directory + '/' + rel_path
+            return
+        temp_path = temp_path_for(self.pack.dir + '/export')
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(self.pack.read(packed))
+            os.utime(temp_path, ns=(packed.mtime_ns, packed.mtime_ns))
+            yield temp_path
+        finally:
+            remove_quietly(temp_path)
+
+    def pack_small_files(self) -> int:
+        # moves the small files already on the disk into the pack, a batch at a time
+        with self.scanning():
+            small = [
+                '/'.join(parts) for parts, entry, lasts in scan_files(self.directory)
+                if self.packed('/'.join(parts)) is None and self.pack.wants(entry.stat().st_size)
+            ]
+        for start in range(0, len(small), LIST_PAGE_SIZE):
+            rel_paths = small[start:start + LIST_PAGE_SIZE]
+            hashes = self.hash_files(rel_paths)
+            self.pack.add([(self.directory + '/' + rel_path, rel_path, hashes[rel_path], self.version(rel_path)) for rel_path in rel_paths])
+            for rel_path in rel_paths:
+                file_path = self.directory + '/' + rel_path
+                remove_quietly(file_path)
+                remove_quietly(self.cache.path(file_path))
+                self.remove_empty_dirs(file_path)
+        return len(small)
+
+    def unpack_files(self) -> int:
+        # puts every packed file back on the disk as it was, with its hash and version,
+        # and drops the packs
+        rel_paths = sorted(self.pack.files)
+        for start in range(0, len(rel_paths), LIST_PAGE_SIZE):
+            with WriteBatch(self.cache, executor=self.hashing_executor()) as batch:
+                for rel_path in rel_paths[start:start + LIST_PAGE_SIZE]:
+                    packed = self.pack.files[rel_path]
+                    file_path = self.directory + '/' + rel_path
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    temp_path = temp_path_for(file_path)
+                    with open(temp_path, 'wb') as f:
+                        f.write(self.pack.read(packed))
+                    os.utime(temp_path, ns=(packed.mtime_ns, packed.mtime_ns))
+                    batch.add(temp_path, file_path, packed.hash, packed.version)
+        self.pack.close()
+        import shutil
+        shutil.rmtree(self.pack.dir, ignore_errors=True)
+        self.pack = None
+        return len(rel_paths)
+
+    @contextlib.contextmanager
+    def scanning(self):
+        # shares on one host take turns walking the disk
+        if self.scan_slots is None:
+            yield
+        else:
+            with self.scan_slots:
+                yield
+
+    @contextlib.contextmanager
+    def reserve_memory(self):
+        # yields take(size) for the contents of one response, None without a budget
+        if self.memory is None:
+            yield None
+        else:
+            with self.memory.reserve() as take:
+                yield take
+
+    def contents_for(self, file_path: str, take=None) -> str:
+        full_path = self.directory + "/" + file_path
+        packed = self.packed(file_path)
+        size = packed.size if packed is not None else os.path.getsize(full_path)
+        # base64 makes it a third bigger, past the budget the client downloads it instead.
+        # A quarantined file goes that way too, the download says why it can't be had
+        if size > SIZE_LIMIT or (take is not None and not take((size + 2) // 3 * 4)) or self.quarantined(file_path):
+            return FILE_TOO_LARGE
+        if packed is not None:
+            import base64
+            return base64.b64encode(self.pack.read(packed)).decode('utf-8')
+        return self.content.get(full_path, encoded=True)
+
+    def client_bucket(self, client_ip: str, direction: str) -> TokenBucket:
+        return self.client_buckets.get(client_ip, direction)
+
+    @contextlib.contextmanager
+    def transfer_slot(self):
+        # waits for one of the --max-transfers slots, yields False if none came free in time
+        if self.transfer_slots is None:
+            yield True
+        elif self.transfer_slots.acquire(timeout=TRANSFER_WAIT_SECONDS):
+            try:
+                yield True
+            finally:
+                self.transfer_slots.release()
+        else:
+            METRICS.inc('file_server_transfers_rejected_total')
+            yield False
+
+    def manifest(self, client_manifest: dict[str, dict], rules: SyncRules = None) -> dict[str, dict]:
+        # The server's side for plan_sync. A file both sides have only gets hashed when
+        # the version vectors can't settle it, a file only here when it's the size of a
+        # file only the client has, in case it's a move.
+        with span('scan'), self.scanning():
+            stats = {os.sep.join(parts): entry.stat() for parts, entry, lasts in scan_files(self.directory, rules=rules, pack=self.pack)}
+        with span('version'):
+            versions = {file_path: self.version(file_path) for file_path in stats}
+        client_only_sizes = {info.get('size') for file_path, info in client_manifest.items() if file_path not in stats}
+
+        def needs_hash(file_path, stat):
+            if file_path not in client_manifest:
+                return stat.st_size in client_only_sizes
+            return hash_needed(client_manifest[file_path], versions[file_path])
+
+        with span('hash'):
+            hashes = self.hash_files([file_path for file_path, stat in stats.items() if needs_hash(file_path, stat)])
+
+        return {file_path: manifest_entry(stat, versions[file_path], hashes.get(file_path)) for file_path, stat in stats.items()}
+
+    def plan(self, client_manifest: dict[str, dict], rules: SyncRules = None, overwrite: bool = False):
+        # files outside the scope or ignored here are none of this sync's business
+        if rules is not None:
+            client_manifest = {file_path: info for file_path, info in client_manifest.items() if rules.wanted(file_path)}
+        server_manifest = self.manifest(client_manifest, rules)
+        with span('plan'):
+            return plan_sync(client_manifest, server_manifest, overwrite), server_manifest
+
+    def settle(self, file_path: str, mine: dict, theirs: dict) -> dict[str, int]:
+        # edits on both sides that came out the same, from here on both have seen both.
+        # The merged version vector, None for anything else
+        if theirs is None or not mine.get('version') or mine.get('hash') is None or mine['hash'] != theirs.get('hash'):
+            return None
+        if compare_versions(mine['version'], theirs['version']) is not None:
+            return None
+        merged = merge_versions(mine['version'], theirs['version'])
+        self.set_version(file_path, merged)
+        return merged
+
+    def PLAN(self, client_manifest: dict[str, dict], rules: SyncRules = None, overwrite: bool = False):
+        actions, server_manifest = self.plan(client_manifest, rules, overwrite)
+        return 200, {'actions': [action._asdict() for action in actions]}
+
+    def PLAN_STREAM(self, entries, rules: SyncRules = None, overwrite: bool = False, contents: bool = False):
+        # plan() a path at a time, while the client is still hashing and sending the
+        # rest of its manifest. A file both sides have is settled as soon as its entry
+        # is in, as is a file only the client has unless it could be a move. Files only
+        # here, and the moves, are worked out once the manifest is complete. Downloads
+        # come with the version, and small ones and conflicts with their contents if asked for.
+        with span('scan'), self.scanning():
+            stats = {os.sep.join(parts): entry.stat() for parts, entry, lasts in scan_files(self.directory, rules=rules, pack=self.pack)}
+        sizes = {stat.st_size for stat in stats.values()}
+        seen = set()
+        client_only = {}
+        sent = set()
+
+        def lines_for(actions, server_manifest):
+            for action in actions:
+                if action.path in sent:
+                    continue
+                sent.add(action.path)
+                line = action._asdict()
+                if action.kind == ACTION_DOWNLOAD or (action.kind == ACTION_MOVE and not overwrite):
+                    line['version'] = server_manifest[action.path]['version']
+                    if contents and action.kind == ACTION_DOWNLOAD:
+                        line['contents'] = self.contents_for(action.path)
+                elif contents and action.kind == ACTION_CONFLICT:
+                    # for the client's diff
+                    line['contents'] = self.contents_for(action.path)
+                elif contents and action.kind == ACTION_UPLOAD and action.path not in server_manifest:
+                    # new on the client or deleted here, the client asks like SYNC's 409 does
+                    line['contents'] = ''
+                yield line
+
+        for entry in entries:
+            file_path = entry.pop('path')
+            if rules is not None and not rules.wanted(file_path):
+                continue
+            seen.add(file_path)
+            if file_path in stats:
+                version = self.version(file_path)
+                file_hash = self.hash_files([file_path])[file_path] if hash_needed(entry, version) else None
+                theirs = manifest_entry(stats[file_path], version, file_hash)
+                yield from lines_for(plan_sync({file_path: entry}, {file_path: theirs}, overwrite), {file_path: theirs})
+                merged = self.settle(file_path, entry, theirs)
+                if merged is not None:
+                    yield {'path': file_path, 'version': merged}
+                continue
+            client_only[file_path] = entry
+            # a sync uploads whatever only the client has, overwriting it could be a move
+            # of a file here with the same size
+            if not overwrite or entry.get('hash') is None or entry.get('size') not in sizes:
+                yield from lines_for(plan_sync({file_path: entry}, {}, overwrite), {})
+                if overwrite:
+                    del client_only[file_path]
+
+        with span('version'):
+            versions = {file_path: self.version(file_path) for file_path in stats if file_path not in seen}
+        client_only_sizes = {info.get('size') for info in client_only.values()}
+        with span('hash'):
+            hashes = self.hash_files([file_path for file_path in versions if stats[file_path].st_size in client_only_sizes])
+        server_only = {file_path: manifest_entry(stats[file_path], version, hashes.get(file_path)) for file_path, version in versions.items()}
+        with span('plan'):
+            yield from lines_for(plan_sync(client_only, server_only, overwrite), server_only)
+
+    def SYNC(self, file_path_to_file_hash: dict[str, dict[str, str]], rules: SyncRules = None, take=None, moves: bool = False, versions: bool = False):
+        actions, server_manifest = self.plan(file_path_to_file_hash, rules)
+
+        # the client decides about anything it would upload or that changed on both sides,
+        # for a file the server has too it gets the server's version to compare
+        new_user_files = {
+            action.path: self.contents_for(action.path, take) if action.path in server_manifest else ''
+            for action in actions if action.kind in (ACTION_UPLOAD, ACTION_CONFLICT)
         }
-        return 409, content
-    
-    
+        if len(new_user_files) > 0:
+            content = {
+                "error": "You have a newer file version",
+                "file_path_to_file_contents": new_user_files
+            }
+            return 409, content
+
+        # only files going back are read. A client that knows moves copies its own file,
+        # older ones get the content
+        file_path_to_file = {
+            action.path: {'move': action.source} if moves and action.kind == ACTION_MOVE else self.contents_for(action.path, take)
+            for action in actions if action.kind in (ACTION_DOWNLOAD, ACTION_MOVE)
+        }
+        # and one that keeps version vectors gets them along with each file
+        if versions:
+            file_path_to_file = {
+                file_path: dict(contents if isinstance(contents, dict) else {'contents': contents}, version=server_manifest[file_path]['version'])
+                for file_path, contents in file_path_to_file.items()
+            }
+            for file_path, mine in file_path_to_file_hash.items():
+                merged = self.settle(file_path, mine, server_manifest.get(file_path))
+                if merged is not None:
+                    file_path_to_file[file_path] = {'version': merged}
+
+        self.cache.cleanup()
+        return 200, file_path_to_file
+
+    def PING(self):
+        return 200, 'up'
+
+    def PIECES(self, file_path: str, piece_size: int = PIECE_SIZE):
+        # the hash of every piece_size slice of the file besides the whole file's, so a
+        # swarm download can check each range it gets from whichever server
+        if self.quarantined(file_path):
+            return 500, {"error": QUARANTINED}
+        full_path = self.directory + "/" + file_path
+        packed = self.packed(file_path)
+        if packed is not None:
+            # small enough to just hash again
+            import hashlib
+            data = self.pack.read(packed)
+            pieces = [hashlib.sha256(data[i:i + piece_size]).hexdigest() for i in range(0, len(data), piece_size)]
+            return 200, {'size': packed.size, 'hash': packed.hash, 'piece_size': piece_size, 'pieces': pieces, 'version': packed.version}
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            return 404, {"error": "File not found"}
+        signature = (stat.st_mtime_ns, stat.st_size)
+        key = (full_path, piece_size)
+        with self.piece_lists_lock:
+            cached = self.piece_lists.get(key)
+        if cached is not None and cached[0] == signature:
+            return 200, dict(cached[1], version=self.cached_version(full_path))
+
+        import hashlib
+        hash_func = hashlib.sha256()
+        pieces = []
+        with span('hash'), open(full_path, 'rb') as f:
+            while True:
+                piece = f.read(piece_size)
+                if not piece:
+                    break
+                hash_func.update(piece)
+                pieces.append(hashlib.sha256(piece).hexdigest())
+                throttle(HASH_LIMIT, len(piece), 'hash')
+        response = {'size': stat.st_size, 'hash': hash_func.hexdigest(), 'piece_size': piece_size, 'pieces': pieces}
+
+        # only worth keeping if the file held still while it was read
+        stat = os.stat(full_path)
+        if (stat.st_mtime_ns, stat.st_size) == signature:
+            self.cache.store(full_path, response['hash'])
+            with self.piece_lists_lock:
+                self.piece_lists.pop(key, None)
+                self.piece_lists[key] = (signature, response)
+                while len(self.piece_lists) > PIECE_CACHE_SIZE:
+                    del self.piece_lists[next(iter(self.piece_lists))]
+        return 200, dict(response, version=self.cached_version(full_path))
+
+    def get_upload_batch(self, batch_id: str) -> WriteBatch:
+        with self.upload_batches_lock:
+            # throw away batches from clients that died before committing
+            now = time.time()
+            for stale_id, stale_batch in list(self.upload_batches.items()):
+                if now - stale_batch.created > BATCH_TIMEOUT:
+                    stale_batch.abort()
+                    del self.upload_batches[stale_id]
+
+            if batch_id not in self.upload_batches:
+                self.upload_batches[batch_id] = self.new_batch()
+            return self.upload_batches[batch_id]
+
+    def COMMIT(self, batch_id: str, origin: str = None):
+        with self.upload_batches_lock:
+            batch = self.upload_batches.pop(batch_id, None)
+        if batch is None:
+            return 404, 'unknown batch'
+
+        committed = batch.commit()
+        for file_path, file_hash in committed:
+            self.journal.record(self.relative_path(file_path), 'upload', file_hash, origin)
+        return 200, len(committed)
+
+    def relative_path(self, file_path: str) -> str:
+        return os.path.relpath(file_path, self.directory).replace(os.sep, '/')
+
+    def CHANGES(self, query: dict[str, list[str]], origin: str = None):
+        generation = int(query.get('since', ['-1'])[0])
+        if generation < 0:
+            # just asking where the journal is at
+            return 200, {'epoch': self.journal.epoch, 'generation': self.journal.generation, 'reset': False, 'changes': [], 'node_id': self.node_id}
+
+        timeout = min(float(query.get('timeout', ['0'])[0]), LONG_POLL_SECONDS)
+        return 200, self.journal.since(generation, query.get('epoch', [''])[0], origin, timeout)
+
+    def watch(self, interval: float = WATCH_INTERVAL):
+        self.start_watching()
+        while True:
+            time.sleep(interval)
+            self.poll_directory()
+
+    def start_watching(self):
+        with self.scanning():
+            self.journal.watcher = DirectoryWatcher(self.directory)
+
+    def poll_directory(self):
+        # edits made straight into the server's directory get announced like uploads
+        with self.scanning():
+            changed, deleted = self.journal.watcher.poll()
+        for rel_path in changed:
+            # written straight onto the disk, that copy is newer than a packed one
+            if self.packed(rel_path) is not None:
+                self.pack.remove([rel_path])
+            self.journal.record(rel_path, 'upload', self.cache.hash(self.directory + '/' + rel_path))
+        for rel_path in deleted:
+            self.journal.record(rel_path, 'delete')
+
+    def etag(self, *parts: str) -> str:
+        # A strong ETag for a response that only depends on parts and what's in the
+        # directory. Only a watched directory has every change in the journal, so only
+        # there does an unchanged generation mean nothing changed, None elsewhere.
+        if self.journal.watcher is None:
+            return None
+        import hashlib
+        key = '\0'.join((self.journal.epoch, str(self.journal.generation)) + parts)
+        return '"' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:32] + '"'
+
+    def LIST_FILES(self, query: dict[str, list[str]] = {}):
+        with self.scanning():
+            if not query:
+                files = get_all_files_relative(self.directory, pack=self.pack)
+            else:
+                files = [os.sep.join(parts) for parts, entry, lasts in scan_files(self.directory, pack=self.pack, **list_files_query(query))]
+
+        return 200, files
+
+    def LIST_FILES_STREAM(self, query: dict[str, list[str]]):
+        # yields one dict per file and a final {'cursor': ...} that's set when the
+        # page limit was hit, pass it back as ?cursor= to get the next page
+        limit = int(query.get('limit', [0])[0]) or None
+        fields = set(query.get('fields', [''])[0].split(','))
+        with_tree = query.get('tree', ['0'])[0] == '1'
+
+        count = 0
+        last_path = None
+        for parts, entry, lasts in scan_files(self.directory, pack=self.pack, **list_files_query(query)):
+            if limit is not None and count >= limit:
+                yield {'cursor': last_path}
+                return
 
-    # get any files on the server that are out of date on the client
-    file_path_to_file = {}
-    for file_path in files:
-        file_contents = None
-        if os.path.getsize(DIRECTORY + "/" + file_path) > SIZE_LIMIT:
-            file_contents = FILE_TOO_LARGE
+            last_path = '/'.join(parts)
+            item = {'path': last_path}
+            if 'size' in fields or 'mtime' in fields:
+                stat = entry.stat()
+                if 'size' in fields:
+                    item['size'] = stat.st_size
+                if 'mtime' in fields:
+                    item['mtime'] = stat.st_mtime
+            if 'hash' in fields:
+                item['hash'] = entry.packed.hash if isinstance(entry, PackedEntry) else self.cache.hash(entry.path)
+            if with_tree:
+                item['last'] = lasts
+            yield item
+            count += 1
+
+        yield {'cursor': None}
+
+    def DELETE(self, file_path, origin: str = None, via: list[str] = ()):
+
+        rel_path = file_path.replace('\\', '/')
+        file_path = self.directory + "/" + file_path
+
+        # Delete the file
+        if self.packed(rel_path) is not None:
+            self.pack.remove([rel_path])
         else:
-            file_contents = read(DIRECTORY + "/" + file_path)
-
-        if file_path in file_path_to_file_hash:
-            file_hash = hash(DIRECTORY + "/" + file_path)
-            
-            
-            client_modified_date = datetime.strptime(
-                file_path_to_file_hash[file_path]['date'], 
-                DATE_FORMAT
-            )
-            modified_date = get_file_last_modified(DIRECTORY + "/" + file_path)
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                return 404, 'File not found'
+            self.remove_empty_dirs(file_path)
+        self.journal.record(rel_path, 'delete', origin=origin, via=via)
+        return 204, ''
+
+    def MOVE(self, source: str, dest: str, origin: str = None):
+        # a rename the planner spotted, the content is already here under another name
+        source_path = safe_join(self.directory, source)
+        dest_path = safe_join(self.directory, dest)
+        if source_path is None or dest_path is None:
+            return 400, 'bad path'
+        source, dest = source.replace('\\', '/'), dest.replace('\\', '/')
+        packed = self.packed(source)
+        if packed is not None:
+            self.pack.move(source, dest)
+            remove_quietly(dest_path)
+            file_hash = packed.hash
+        elif not os.path.isfile(source_path):
+            return 404, 'File not found'
+        else:
+            file_hash = self.cache.load(source_path)
+            version = self.cached_version(source_path)
+
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            os.replace(source_path, dest_path)
+            # the mtime comes along, so the hash and version still hold
+            self.cache.store(dest_path, file_hash or '', version)
+            self.remove_empty_dirs(source_path)
+            if self.pack is not None:
+                self.pack.remove([dest])
+
+        self.journal.record(source, 'delete', origin=origin)
+        self.journal.record(dest, 'upload', file_hash, origin)
+        return 200, ''
+
+    def remove_empty_dirs(self, file_path: str):
+        # Recursively delete empty parent directories
+        parent_dir = os.path.dirname(file_path)
+        while parent_dir and os.path.normpath(parent_dir) != os.path.normpath(self.directory):
+            # Check if directory exists and is empty
+            if os.path.isdir(parent_dir) and not os.listdir(parent_dir):
+                os.rmdir(parent_dir)
+                parent_dir = os.path.dirname(parent_dir)
+            else:
+                break
 
-            if file_hash != file_path_to_file_hash[file_path]['hash']:
-                file_path_to_file[file_path] = file_contents
+class Relay:
+    # Forwards a server's changes to a peer server through the same /upload and /delete
+    # a client uses, so laptops syncing against different nodes still end up the same.
+    # Changed paths are appended to a queue file in META_DIR and only leave it once the
+    # peer has them, so nothing is lost while the peer is down or this server restarts.
+    # The file is sent as it is when its turn comes, so a path queued ten times goes once.
+    # Each change carries the node ids it has been through and never goes back to one.
+    # A file the peer changed too is kept on both as a conflict file, see conflict().
+
+    def __init__(self, share: SyncServer, url: str, password: str = ''):
+        self.share = share
+        self.url = url
+        self.password = password
+        self.pool = ConnectionPool()
+        self.queue_path = share.directory + META_DIR + '/relay_' + re.sub(r'[^A-Za-z0-9.-]+', '_', url) + '.jsonl'
+        self.pending = {} # path -> (sequence, via), sequence tells if it was queued again while being sent
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.peer_id = None
+        self.load()
+
+    def load(self):
+        # a later line for a path replaces an earlier one
+        try:
+            with open(self.queue_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # half written when the process died
+                        continue
+                    self.sequence += 1
+                    self.pending[entry['path']] = (self.sequence, entry['via'])
+        except FileNotFoundError:
+            pass
+        self.update_metric()
+
+    def enqueue(self, change: dict):
+        self.queue([change['path']], change['via'])
+
+    def queue(self, paths: list[str], via: list[str] = ()):
+        if not paths:
+            return
+        lines = ''.join(json.dumps({'path': path, 'via': list(via)}) + '\n' for path in paths)
+        with self.lock:
+            os.makedirs(os.path.dirname(self.queue_path), exist_ok=True)
+            with open(self.queue_path, 'a') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            for path in paths:
+                self.sequence += 1
+                self.pending[path] = (self.sequence, list(via))
+        self.update_metric()
+        self.wake.set()
+
+    def compact(self):
+        # rewrites the queue with only what's still pending
+        with self.lock:
+            if not self.pending:
+                remove_quietly(self.queue_path)
+                return
+            temp_path = temp_path_for(self.queue_path)
+            with open(temp_path, 'w') as f:
+                for path, (sequence, via) in self.pending.items():
+                    f.write(json.dumps({'path': path, 'via': via}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.queue_path)
+
+    def update_metric(self):
+        METRICS.set('file_server_relay_pending', len(self.pending), peer=self.url)
+
+    def headers(self, **extra) -> dict:
+        headers = {'password': self.password, 'client_id': self.share.node_id}
+        headers.update(extra)
+        return headers
+
+    def ok(self, status: int, response: any) -> bool:
+        # a bad password still comes back as a 200, with an error in it
+        return status < 300 and not (isinstance(response, dict) and 'error' in response)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        delay = RELAY_RETRY_SECONDS
+        while True:
+            try:
+                self.forward()
+                delay = RELAY_RETRY_SECONDS
+                self.wake.wait()
+            except Exception as e:
+                # the peer is down or turned us away, everything stays queued for next time
+                METRICS.inc('file_server_relay_errors_total', peer=self.url)
+                if VERBOSE:
+                    print(RED + 'relay to ' + self.url + ' failed, trying again in ' + str(delay) + 's: ' + str(e) + ANSII_RESET)
+                self.peer_id = None
+                time.sleep(delay)
+                delay = min(delay * 2, RELAY_MAX_BACKOFF)
+            self.wake.clear()
+
+    def connect(self):
+        status, response = get(self.url + '/changes', headers=self.headers(), pool=self.pool)
+        if not self.ok(status, response):
+            raise Exception(str(response))
+        self.peer_id = response.get('node_id')
+        self.reconcile()
+
+    def reconcile(self):
+        # queues what the peer is missing or has an older version of, for changes made
+        # while nothing was relaying. A file the peer has and we don't could be one we
+        # deleted or one it never sent, so deletes from then aren't passed on.
+        remote = {item['path']: item for item in list_remote_files(self.url, headers=self.headers(), pool=self.pool, fields='hash,mtime')}
+        with self.share.scanning():
+            entries = {'/'.join(parts): entry for parts, entry, lasts in scan_files(self.share.directory, pack=self.share.pack)}
+        hashes = self.share.hash_files(list(entries))
+        missing = []
+        for path, entry in entries.items():
+            theirs = remote.get(path)
+            if theirs is None or (theirs.get('hash') != hashes[path] and entry.stat().st_mtime > theirs.get('mtime', 0)):
+                missing.append(path)
+        self.queue(missing)
+
+    def forward(self):
+        if self.peer_id is None:
+            self.connect()
+        with self.lock:
+            batch = list(self.pending.items())
+
+        removed = 0
+        try:
+            for path, (sequence, via) in batch:
+                # no sending a change back where it came from
+                if self.peer_id not in via:
+                    self.send(path, via)
+                with self.lock:
+                    if self.pending.get(path, (None,))[0] == sequence:
+                        del self.pending[path]
+                        removed += 1
+        finally:
+            if removed:
+                self.compact()
+            self.update_metric()
+
+    def send(self, path: str, via: list[str], settled: bool = False):
+        headers = self.headers(file_path=path, via=','.join(via + [self.share.node_id]))
+        if self.share.quarantined(path):
+            # queued again once it's repaired
+            return
+        if self.share.exists(path):
+            # our vector is the base too, the peer only takes the file over a copy whose
+            # edits we've all seen and answers 409 to one with edits of its own
+            version = self.share.version(path)
+            headers['version'] = headers['base_version'] = json.dumps(version)
+            with self.share.on_disk(path) as source:
+                status, response = chunked_file_upload(self.url + '/upload', source, 'POST', headers=headers, pool=self.pool)
+            if status == 409 and not settled:
+                self.conflict(path, version)
+                return self.send(path, via, settled=True)
+        else:
+            status, response = delete(self.url + '/delete', path, headers=headers, pool=self.pool)
+            # already gone over there is just as good
+            if status == 404:
+                return
+        if not self.ok(status, response):
+            raise Exception(path + ': ' + str(response))
+        METRICS.inc('file_server_relay_sent_total', peer=self.url)
+
+    def conflict(self, path: str, version: dict[str, int]):
+        # Both sides edited path. The peer's copy is kept here next to ours under
+        # conflict_path(), from where it goes around like any other new file, and ours
+        # then counts the peer's edits too so it can go over the peer's copy.
+        import shutil
+        scratch = os.path.splitext(self.queue_path)[0]
+        try:
+            chunked_file_download(self.url + '/download', self.headers(file_path=path), dest_file=path, pool=self.pool, root=scratch)
+            fetched = scratch + '/' + path
+            cache = HashCache(scratch)
+            theirs = cache.base_version(fetched)
+            file_hash = cache.load(fetched)
+            if file_hash != self.share.hash_files([path])[path]:
+                copy_path = conflict_path(path, self.peer_id)
+                batch = self.share.new_batch()
+                batch.add(fetched, self.share.directory + '/' + copy_path, file_hash, theirs)
+                batch.commit()
+                self.share.journal.record(copy_path, 'upload', file_hash, self.peer_id)
+                METRICS.inc('file_server_relay_conflicts_total', peer=self.url)
+                if VERBOSE:
+                    print(VIOLET + 'relay: ' + path + ' was also changed on ' + self.url + ', its copy is ' + copy_path + ANSII_RESET)
+            self.share.set_version(path, merge_versions(version, theirs))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+def conflict_path(rel_path: str, node_id: str) -> str:
+    # notes/a.txt -> notes/a.conflict-1a2b3c4d.txt, next to the file it conflicted with
+    root, ext = os.path.splitext(rel_path)
+    return root + '.conflict-' + (node_id or 'peer')[:8] + ext
+
+class Scrubber:
+    # Re-reads a slice of the share's files every interval and checks each against the
+    # hash the cache or pack has for it. A cached hash is trusted for as long as the
+    # mtime matches, so rot on the disk or an edit that kept the mtime would otherwise
+    # never be noticed. The reads go through their own TokenBucket so scrubbing stays
+    # inside its I/O budget, and the cursor walks the share in sorted order, picking up
+    # where it left off after a restart. A mismatch is kept in META_DIR/scrub.json and
+    # on /scrub, and the file is fetched again from the first peer that still has the
+    # content the hash says. Until then the share won't hand the file out, see
+    # SyncServer.quarantined(), so no client or peer gets the bad bytes.
+
+    def __init__(self, share: SyncServer, rate: float = None, interval: float = SCRUB_INTERVAL, slice_size: int = SCRUB_SLICE, peers: list[tuple] = ()):
+        self.share = share
+        self.limit = TokenBucket(rate) if rate else None
+        self.interval = interval
+        self.slice_size = slice_size
+        self.peers = list(peers) # (url, password)
+        self.state_path = share.directory + META_DIR + '/scrub.json'
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.rounds = 0
+        self.mismatches = {} # path -> {'expected', 'actual', 'time', 'repaired'}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.cursor = state.get('cursor')
+        self.rounds = state.get('rounds', 0)
+        self.mismatches = state.get('mismatches', {})
+        self.update_metric()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        temp_path = temp_path_for(self.state_path)
+        with open(temp_path, 'w') as f:
+            json.dump({'cursor': self.cursor, 'rounds': self.rounds, 'mismatches': self.mismatches}, f)
+        os.replace(temp_path, self.state_path)
+
+    def update_metric(self):
+        METRICS.set('file_server_scrub_unrepaired', sum(1 for mismatch in self.mismatches.values() if not mismatch.get('repaired')))
+
+    def unrepaired(self, rel_path: str) -> bool:
+        mismatch = self.mismatches.get(rel_path)
+        return mismatch is not None and not mismatch.get('repaired')
+
+    def release(self, rel_path: str):
+        # new content puts a bad file back in service, repairs stay on record
+        if self.unrepaired(rel_path):
+            self.mismatches.pop(rel_path, None)
+            self.update_metric()
+
+    def changed(self, change: dict):
+        self.release(change['path'])
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.scrub_slice()
+            except Exception as e:
+                if VERBOSE:
+                    print(RED + 'scrub of ' + self.share.directory + ' failed: ' + str(e) + ANSII_RESET)
+
+    def scrub_slice(self) -> int:
+        # the next slice_size files after the cursor, starting over once it's been round
+        import itertools
+        with self.share.scanning():
+            files = list(itertools.islice(scan_files(self.share.directory, after=self.cursor, pack=self.share.pack), self.slice_size))
+        with self.lock:
+            for parts, entry, lasts in files:
+                self.verify('/'.join(parts), entry)
+            if len(files) < self.slice_size:
+                self.cursor = None
+                self.rounds += 1
+            else:
+                self.cursor = '/'.join(files[-1][0])
+            self.update_metric()
+            self.save()
+        return len(files)
+
+    def verify(self, rel_path: str, entry) -> bool:
+        packed = entry.packed if isinstance(entry, PackedEntry) else None
+        if packed is not None:
+            expected = packed.hash
+            actual = self.hash_bytes(self.share.pack.read(packed))
         else:
-            file_path_to_file[file_path] = file_contents
+            # a file with no cached hash, or a stale one, gets hashed by the next sync anyway
+            try:
+                before = os.stat(entry.path)
+                expected = self.share.cache.load(entry.path)
+                if expected is None:
+                    # written since it was last hashed, whatever was wrong with it is gone
+                    self.release(rel_path)
+                    return True
+                with open(entry.path, 'rb') as f:
+                    actual = self.hash_bytes(f)
+                after = os.stat(entry.path)
+            except OSError:
+                return True
+            # written to while it was read, the next round can look again
+            if (after.st_mtime_ns, after.st_size) != (before.st_mtime_ns, before.st_size):
+                return True
+        METRICS.inc('file_server_scrub_files_total')
+
+        if actual == expected:
+            # repairs stay on record, anything else that reads fine again was put right some other way
+            if not self.mismatches.get(rel_path, {}).get('repaired'):
+                self.mismatches.pop(rel_path, None)
+            return True
+        # one that's still bad is tried again, but only counted once
+        if self.mismatches.get(rel_path, {}).get('actual') != actual:
+            METRICS.inc('file_server_scrub_mismatches_total')
+        if VERBOSE:
+            print(RED + 'SCRUB: ' + rel_path + ' reads as ' + actual[:12] + ' but was stored as ' + expected[:12] + ANSII_RESET)
+        repaired = self.repair(rel_path, expected)
+        if repaired:
+            METRICS.inc('file_server_scrub_repaired_total')
+        self.mismatches[rel_path] = {'expected': expected, 'actual': actual, 'time': time.time(), 'repaired': repaired}
+        return False
+
+    def hash_bytes(self, source) -> str:
+        # bytes or an open file, read at the scrub's own pace
+        import hashlib
+        import io
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        hash_func = hashlib.sha256()
+        chunk_size = chunk_size_for(self.limit)
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            hash_func.update(chunk)
+            METRICS.inc('file_server_scrub_bytes_total', len(chunk))
+            throttle(self.limit, len(chunk), 'scrub')
+        return hash_func.hexdigest()
+
+    def repair(self, rel_path: str, expected: str) -> bool:
+        for url, password in self.peers:
+            try:
+                headers = {'password': password, 'client_id': self.share.node_id}
+                # read to the end so the listing isn't left half sent
+                found = list(list_remote_files(url, headers=headers, path=rel_path, fields='hash'))
+                theirs = found[0].get('hash') if found else None
+                if theirs == expected:
+                    self.fetch(url, dict(headers, file_path=rel_path), rel_path, expected)
+                    if VERBOSE:
+                        print(GREEN + 'SCRUB: ' + rel_path + ' repaired from ' + url + ANSII_RESET)
+                    return True
+            except Exception as e:
+                if VERBOSE:
+                    print(RED + 'SCRUB: ' + rel_path + ' could not be fetched from ' + url + ': ' + str(e) + ANSII_RESET)
+        return False
 
-    cleanup_hash_cache()
-    return 200, file_path_to_file
+    def fetch(self, url: str, headers: dict, rel_path: str, expected: str):
+        # downloaded next to the share so the hash trailer is checked before the copy
+        # here is replaced, with the version it had since the content is the same
+        import shutil
+        scratch = self.share.directory + META_DIR + '/scrub'
+        try:
+            chunked_file_download(url + '/download', headers, dest_file=rel_path, root=scratch)
+            fetched = scratch + '/' + rel_path
+            if HashCache(scratch).load(fetched) != expected:
+                raise Exception('peer sent other content')
+            batch = self.share.new_batch()
+            batch.add(fetched, self.share.directory + '/' + rel_path, expected, self.share.version(rel_path))
+            batch.commit()
+            self.share.journal.record(rel_path, 'upload', expected, self.share.node_id)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {'cursor': self.cursor, 'rounds': self.rounds, 'mismatches': dict(self.mismatches)}
+
+class SyncHost(Listener):
+    # Several shares behind one port, picked by the first part of the path so a client
+    # syncs against host:8000/docs. Each share is a SyncServer with its own cache and
+    # journal, but they all hash on one pool of threads, take turns walking the disk,
+    # hold file contents within one memory budget and count transfers and client rates
+    # together. That way 15 folders on a NAS don't mean 15 processes scanning at once,
+    # or 15 times the transfers --max-transfers allows:
+    #   host = SyncHost(port=8000)
+    #   host.add('docs', '/srv/docs')
+    #   host.add('photos', '/srv/photos', password='...')
+    #   host.serve_forever()
+    # A share named '' answers the paths without a share name.
+
+    def __init__(self, password: str = '', port: int = PORT, host: str = '', client_rates: dict = None, max_transfers: int = None, workers: int = HASH_WORKERS, scans: int = SCAN_SLOTS, memory_budget: int = MEMORY_BUDGET, content_cache: int = CONTENT_CACHE_SIZE, pack: bool = False):
+        self.password = password
+        self.address = (host, port)
+        self.client_buckets = ClientBuckets(client_rates)
+        self.transfer_slots = threading.BoundedSemaphore(max_transfers) if max_transfers else None
+        self.workers = workers
+        self.executor = make_executor(workers)
+        self.scan_slots = threading.BoundedSemaphore(scans)
+        self.memory = MemoryBudget(memory_budget)
+        self.content = ContentCache(content_cache)
+        self.pack = pack
+        self.shares: dict[str, SyncServer] = {}
+        self.httpd = None
+
+    def add(self, name: str, directory: str, password: str = None, client_rates: dict = None, max_transfers: int = None) -> SyncServer:
+        # limits and password left out are the host's, and those limits are counted
+        # across all the shares that use them, a share given its own counts its own
+        if '/' in name or '/' + name in ROUTES:
+            raise ValueError('bad share name: ' + name)
+        share = SyncServer(
+            directory,
+            self.password if password is None else password,
+            client_rates=client_rates,
+            max_transfers=max_transfers,
+            workers=self.workers,
+            executor=self.executor,
+            scan_slots=self.scan_slots,
+            memory=self.memory,
+            content=self.content,
+            pack=self.pack,
+            transfer_slots=None if max_transfers else self.transfer_slots,
+            client_buckets=None if client_rates is not None else self.client_buckets,
+        )
+        # the executor is the host's even when make_executor() had no use for one
+        share.owns_executor = False
+        self.shares[name] = share
+        return share
+
+    def route(self, path: str):
+        # '/docs/sync?x=1' goes to the docs share as '/sync?x=1'
+        name, slash, rest = path[1:].partition('/')
+        if slash and name in self.shares:
+            return self.shares[name], '/' + rest
+        return self.shares.get(''), path
+
+    def watch(self, interval: float = WATCH_INTERVAL):
+        # one thread polls the shares in turn rather than one each
+        for share in self.shares.values():
+            share.start_watching()
+        while True:
+            time.sleep(interval)
+            for share in self.shares.values():
+                share.poll_directory()
+
+    def shutdown(self):
+        self.stop_listening()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+DEFAULT_SERVER = None
+DEFAULT_SERVER_LOCK = threading.Lock()
+
+def default_server() -> SyncServer:
+    # what the module level endpoints and a Server handler outside of a SyncServer act on,
+    # it follows DIRECTORY and PASSWORD for code that sets those and calls in directly
+    global DEFAULT_SERVER
+    with DEFAULT_SERVER_LOCK:
+        server = DEFAULT_SERVER
+        if server is None or server.directory != os.path.expanduser(DIRECTORY) or server.password != PASSWORD:
+            server = DEFAULT_SERVER = SyncServer(DIRECTORY, PASSWORD)
+        return server
+
+def SYNC(file_path_to_file_hash: dict[str, dict[str, str]], rules: SyncRules = None):
+    return default_server().SYNC(file_path_to_file_hash, rules)
 
 def PING():
     return 200, 'up'
 
-def LIST_FILES():
-    files = get_all_files_relative(DIRECTORY)
-
-    return 200, files
+def COMMIT(batch_id: str, origin: str = None):
+    return default_server().COMMIT(batch_id, origin)
 
-def DELETE(file_path):
+def CHANGES(query: dict[str, list[str]], origin: str = None):
+    return default_server().CHANGES(query, origin)
 
-    file_path = DIRECTORY + "/" + file_path
+def SERVER_WATCH(interval: float):
+    default_server().watch(interval)
 
-    # Delete the file
-    os.remove(file_path)
+def LIST_FILES(query: dict[str, list[str]] = {}):
+    return default_server().LIST_FILES(query)
 
-    # Recursively delete empty parent directories
-    parent_dir = os.path.dirname(file_path)
-    while parent_dir:
-        # Check if directory exists and is empty
-        if os.path.isdir(parent_dir) and not os.listdir(parent_dir):
-            os.rmdir(parent_dir)
-            parent_dir = os.path.dirname(parent_dir)
-        else:
-            break
+def LIST_FILES_STREAM(query: dict[str, list[str]]):
+    return default_server().LIST_FILES_STREAM(query)
 
-    return 204, ''
+def DELETE(file_path, origin: str = None, via: list[str] = ()):
+    return default_server().DELETE(file_path, origin, via)
 
 
-write_file_with_dirs
-class Server(BaseHTTPRequestHandler):
+class ServerMixin:
+    # the sync server's request handling, handler_class() mixes it into BaseHTTPRequestHandler
+    # keep-alive so syncing and watching clients don't reconnect for every request
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_SECONDS
+    # responses go out as headers then body, with nagle the body waits on the client's delayed ack
+    disable_nagle_algorithm = True
 
     def password_check(self):
         headers = self.headers
         password = headers['password']
 
-        if password != PASSWORD:
+        # scrapers can't always set headers, so /metrics also takes ?password=
+        url = urlparse(self.path)
+        if password is None and url.path == '/metrics':
+            password = parse_qs(url.query, keep_blank_values=True).get('password', [None])[0]
+
+        if password != self.share.password:
             raise Exception('bad password')
 
-    def DOWNLOAD(self, file_path):
+    def setup(self):
+        super().setup()
+        # the SyncServer or SyncHost this connection came in on
+        self.service = getattr(self.server, 'sync_server', None) or default_server()
+        self.share = None
+        self.rfile = CountingStream(self.rfile, 'file_server_received_bytes_total')
+        self.wfile = CountingStream(self.wfile, 'file_server_sent_bytes_total')
+
+    def handle_one_request(self):
+        self.request_start = None
+        self.status_code = None
+        self.headers_sent = False
+        TRACE_LOCAL.trace = None
         try:
-            file_size = os.path.getsize(DIRECTORY + "/" + file_path)
+            super().handle_one_request()
+        finally:
+            if self.request_start is not None:
+                self.finish_metrics()
+            TRACE_LOCAL.trace = None
+
+    def parse_request(self):
+        # starts once the request line is in, not while a kept-alive connection idles
+        self.request_start = time.perf_counter()
+        if TRACE_REQUESTS:
+            TRACE_LOCAL.trace = Trace()
+        if not super().parse_request():
+            return False
+
+        # the rest of the handler sees the path with the share name taken off
+        self.share, self.path = self.service.route(self.path)
+        if self.share is None:
+            self.send_json(404, {"error": "unknown share"}, close=True)
+            return False
+        return True
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        self.headers_sent = True
+        super().end_headers()
+
+    def send_failure(self, status, error: str):
+        # once a response is on the wire a second one would only land inside its body,
+        # so the connection is dropped and the client sees the stream cut short
+        if self.headers_sent:
+            self.close_connection = True
+            return
+        self._headers_buffer = []
+        self.send_json(status, {"error": error}, close=True)
+
+    def finish_metrics(self):
+        duration = time.perf_counter() - self.request_start
+        route = urlparse(self.path).path if self.command else 'unknown'
+        if route not in ROUTES:
+            route = 'other'
+        METRICS.inc('file_server_requests_total', method=self.command or 'unknown', route=route, status=str(self.status_code))
+        METRICS.observe('file_server_request_duration_seconds', duration, route=route)
+
+        trace = TRACE_LOCAL.trace
+        if trace is not None:
+            for phase, seconds in trace.phases.items():
+                METRICS.inc('file_server_phase_seconds_total', seconds, phase=phase)
+            print(f"{self.command} {route} {self.status_code} {duration * 1000:.1f}ms {trace.summary()}")
+
+    def log_message(self, format, *args):
+        if VERBOSE:
+            super().log_message(format, *args)
+
+    def DOWNLOAD(self, file_path):
+        # a client that already has this exact content only gets the version vector
+        if 'If-None-Match' in self.headers and 'Range' not in self.headers:
+            if self.share.exists(file_path):
+                version = self.share.version(file_path)
+                if self.not_modified('"' + self.share.hash_files([file_path])[file_path] + '"', {'version': json.dumps(version)}):
+                    return
+        if self.share.quarantined(file_path):
+            self.send_json(500, {"error": QUARANTINED})
+            return
+        with self.share.transfer_slot() as free:
+            if not free:
+                self.send_busy()
+                return
+            with METRICS.transfer(), span('send'):
+                if 'Range' in self.headers:
+                    self.send_range(file_path, self.headers['Range'])
+                else:
+                    self.send_file(file_path)
+
+    def send_busy(self):
+        self.send_json(503, {"error": "too many transfers, try again later"}, close=True, headers={'Retry-After': '5'})
 
-            # Check if file exists
-            with open(DIRECTORY + '/' + file_path, 'rb') as f:
+    def send_file(self, file_path):
+        try:
+            full_path = self.share.directory + "/" + file_path
+            packed = self.share.packed(file_path)
+            if packed is not None:
+                file_size, mtime, cached_hash = packed.size, None, packed.hash
+            else:
+                file_size = os.path.getsize(full_path)
+                mtime = os.path.getmtime(full_path)
+                cached_hash = self.share.cache.load(full_path)
+            version = self.share.version(file_path)
+
+            # small files come out of the pack or the content cache, big ones straight off the disk
+            import io
+            if packed is not None:
+                source = io.BytesIO(self.share.pack.read(packed))
+            elif file_size <= SIZE_LIMIT:
+                source = io.BytesIO(self.share.content.get(full_path))
+            else:
+                source = open(full_path, 'rb')
+            with source as f:
                 self.send_response(200)
                 # Send headers
                 self.send_header('Transfer-Encoding', 'chunked')
                 self.send_header('Content-Type', 'application/octet-stream')
                 self.send_header('file_path', file_path)
                 self.send_header('file_size', file_size)
+                if cached_hash:
+                    self.send_header(HASH_TRAILER, cached_hash)
+                    self.send_header('ETag', '"' + cached_hash + '"')
+                self.send_header('version', json.dumps(version))
                 self.end_headers()
 
                 # Read and send file in chunks
+                import hashlib
+                hash_func = hashlib.sha256()
+                limit = self.share.client_bucket(self.client_address[0], 'send')
+                chunk_size = chunk_size_for(limit)
                 while True:
-                    chunk = f.read(1024*1024)  # 1MB chunks
+                    chunk = f.read(chunk_size)
                     if not chunk:
                         break
-                    # Send chunk size in hex + CRLF
-                    self.wfile.write(f"{len(chunk):X}\r\n".encode('utf-8'))
-                    # Send chunk data
-                    self.wfile.write(chunk)
-                    # Send CRLF after chunk
-                    self.wfile.write(b"\r\n")
+                    hash_func.update(chunk)
+                    # chunk size in hex, data and CRLF in one write
+                    self.wfile.write(f"{len(chunk):X}\r\n".encode('utf-8') + chunk + b"\r\n")
+                    throttle(limit, len(chunk), 'send')
 
                 # Send zero-length chunk to indicate end
-                self.wfile.write(b"0\r\n\r\n")
+                file_hash = hash_func.hexdigest()
+                self.wfile.write(last_chunk(file_hash))
+
+            # we just read the whole file, so remember its hash if it held still
+            if cached_hash is None and os.path.getmtime(full_path) == mtime:
+                self.share.cache.store(full_path, file_hash)
         except FileNotFoundError:
-            self.send_response(404)
+            self.send_json(404, {"error": "File not found"})
+
+    def send_range(self, file_path, byte_range: str):
+        # a single 'bytes=start-end' range, what a swarm download asks each server for.
+        # Sent with a Content-Length and no hash trailer, the client has the piece hashes.
+        full_path = self.share.directory + "/" + file_path
+        packed = self.share.packed(file_path)
+        try:
+            file_size = packed.size if packed is not None else os.path.getsize(full_path)
+        except FileNotFoundError:
+            self.send_json(404, {"error": "File not found"})
+            return
+
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', byte_range.strip())
+        if match and match[1]:
+            start = int(match[1])
+            end = min(int(match[2]), file_size - 1) if match[2] else file_size - 1
+        elif match and match[2]:
+            # the last n bytes
+            start = max(file_size - int(match[2]), 0)
+            end = file_size - 1
+        else:
+            start, end = 0, -1
+        if start > end:
+            self.send_json(416, {"error": "bad range " + byte_range}, headers={'Content-Range': 'bytes */' + str(file_size)})
+            return
+
+        import io
+        with io.BytesIO(self.share.pack.read(packed)) if packed is not None else open(full_path, 'rb') as f:
+            f.seek(start)
+            self.send_response(206)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(file_size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('file_path', file_path)
             self.end_headers()
-            self.wfile.write(b"File not found")
 
+            limit = self.share.client_bucket(self.client_address[0], 'send')
+            chunk_size = chunk_size_for(limit)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    # the file shrank under us, the client sees a short body
+                    self.close_connection = True
+                    break
+                self.wfile.write(chunk)
+                throttle(limit, len(chunk), 'send')
+                remaining -= len(chunk)
+
+    def send_json(self, status, body, close=False, headers={}, etag=None):
+        # etag is the response's ETag, or True to make one from the body. That one only
+        # saves sending the body again, the scan and hashing behind it still happen, but
+        # without --watch there's no journal to say nothing changed without looking
+        with span('encode'):
+            json_bytes = json.dumps(body).encode('utf-8')
+        if etag and status == 200:
+            if etag is True:
+                etag = body_etag(json_bytes)
+            if self.not_modified(etag):
+                return
+            headers = dict(headers, ETag=etag)
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        for key, value in headers.items():
+            self.send_header(key, value)
+        trace = TRACE_LOCAL.trace
+        if trace is not None:
+            self.send_header('Server-Timing', trace.header())
+        # a 204 can't have a body, anything sent would be read as the next response
+        if status == 204:
+            json_bytes = b''
+        self.send_header('Content-Length', str(len(json_bytes)))
+        if close:
+            # the request body may not have been read, so this connection is done
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        with span('write'):
+            self.wfile.write(json_bytes)
+
+    def not_modified(self, etag: str, headers: dict = {}) -> bool:
+        # answers with a bodyless 304 when the client's If-None-Match has etag
+        if not etag:
+            return False
+        wanted = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+        if etag not in wanted and '*' not in wanted:
+            return False
+        METRICS.inc('file_server_not_modified_total')
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        return True
+
+    def send_text(self, status, text: str, content_type: str):
+        text_bytes = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(text_bytes)))
+        self.end_headers()
+        self.wfile.write(text_bytes)
+
+    def send_stream(self, items, etag: str = None, flush_seconds: float = STREAM_FLUSH_SECONDS):
+        # newline delimited json in chunks, flushed often enough that the
+        # client can start working on the first lines straight away
+        if self.not_modified(etag):
+            return
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Content-type', NDJSON)
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+
+        buffer = []
+        buffered = 0
+        last_flush = time.time()
+        while True:
+            # headers are gone already so errors have to travel in the stream
+            try:
+                item = next(items, None)
+            except Exception as e:
+                item = {'error': str(e)}
+                items = iter(())
+            if item is None:
+                break
+
+            line = (json.dumps(item) + '\n').encode('utf-8')
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= STREAM_FLUSH_BYTES or time.time() - last_flush >= flush_seconds:
+                self.write_chunk(b''.join(buffer))
+                buffer = []
+                buffered = 0
+                last_flush = time.time()
+
+        if buffer:
+            self.write_chunk(b''.join(buffer))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):X}\r\n".encode('utf-8'))
+        self.wfile.write(data)
+        self.wfile.write(b"\r\n")
+        self.wfile.flush()
 
     def do_GET(self):
-        json_str = None
         status = 200
         try:
             self.password_check()
 
             response_body = None
 
-            if self.path == '/ping':
-                status, response_body = PING()
-            elif self.path == '/download':
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+
+            if url.path == '/ping':
+                status, response_body = self.share.PING()
+            elif url.path == '/download':
                 file_path = self.headers.get('file_path')
                 self.DOWNLOAD(file_path)
                 return
-            elif self.path == '/list_files':
-                status, response_body = LIST_FILES()
-                
-            json_str = json.dumps(response_body)
+            elif url.path == '/pieces':
+                # a piece is held in memory while it's hashed, so it can't be just anything
+                piece_size = min(max(int(query.get('piece_size', [PIECE_SIZE])[0]), 64 * 1024), 64 * 1024 * 1024)
+                status, response_body = self.share.PIECES(self.headers.get('file_path'), piece_size)
+            elif url.path == '/list_files':
+                # nothing changed since the journal's generation, nothing to list again
+                etag = self.share.etag('list_files', url.query, self.headers.get('Accept', ''))
+                if NDJSON in self.headers.get('Accept', ''):
+                    self.send_stream(self.share.LIST_FILES_STREAM(query), etag)
+                    return
+                if self.not_modified(etag):
+                    return
+                status, response_body = self.share.LIST_FILES(query)
+                self.send_json(status, response_body, etag=etag or True)
+                return
+            elif url.path == '/changes':
+                status, response_body = self.share.CHANGES(query, self.headers.get('client_id'))
+            elif url.path == '/scrub':
+                status, response_body = self.share.SCRUB()
+            elif url.path == '/metrics':
+                self.send_text(200, METRICS.render(), 'text/plain; version=0.0.4')
+                return
 
         except Exception as e:
-            response_obj = {
-                "error": str(e)
-            }
-            json_str = json.dumps(response_obj)
+            self.send_failure(status, str(e))
+            return
 
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json_str.encode('utf-8'))
+        self.send_json(status, response_body)
 
     def do_POST(self):
-        json_str = None
         status = 200
         try:
             self.password_check()
@@ -915,33 +4983,48 @@ class Server(BaseHTTPRequestHandler):
             if 'chunked' in transfer_encoding:
                 if self.path == '/upload':
                     self.handle_chunked()
+                elif urlparse(self.path).path == '/plan_stream':
+                    self.handle_plan_stream()
+                else:
+                    self.send_json(404, {"error": "unknown path"}, close=True)
                 return
             else:
                 content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                req_json = post_data.decode('utf-8')
-                body = json.loads(req_json)
+                with span('receive'):
+                    post_data = self.rfile.read(content_length)
+                with span('parse'):
+                    req_json = post_data.decode('utf-8')
+                    body = json.loads(req_json)
 
             response_body = None
 
-            if self.path == '/sync':
-                status, response_body = SYNC(body)
-
-            json_str = json.dumps(response_body)
+            url = urlparse(self.path)
+            if url.path == '/plan':
+                overwrite = parse_qs(url.query).get('overwrite', ['0'])[0] == '1'
+                status, response_body = self.share.PLAN(body, sync_rules_from_headers(self.headers, self.share.directory), overwrite)
+            elif url.path == '/move':
+                status, response_body = self.share.MOVE(body['from'], body['to'], self.headers.get('client_id'))
+            elif self.path == '/sync':
+                # the same manifest against an unchanged directory gets the same answer
+                import hashlib
+                etag = self.share.etag('sync', hashlib.sha256(post_data).hexdigest(), *(self.headers.get(key, '') for key in ('sync_rules', 'moves', 'versions')))
+                if self.not_modified(etag):
+                    return
+                # the file contents count against the memory budget until they're sent
+                with self.share.reserve_memory() as take:
+                    status, response_body = self.share.SYNC(body, sync_rules_from_headers(self.headers, self.share.directory), take, self.headers.get('moves') == '1', self.headers.get('versions') == '1')
+                    self.send_json(status, response_body, etag=etag or True)
+                return
+            elif self.path == '/commit':
+                status, response_body = self.share.COMMIT(body, self.headers.get('client_id'))
 
         except Exception as e:
-            response_obj = {
-                "error": str(e)
-            }
-            json_str = json.dumps(response_obj)
+            self.send_failure(status, str(e))
+            return
 
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json_str.encode('utf-8'))
+        self.send_json(status, response_body)
         
     def do_DELETE(self):
-        json_str = None
         status = 204
         try:
             self.password_check()
@@ -954,64 +5037,244 @@ class Server(BaseHTTPRequestHandler):
             response_body = None
 
             if self.path == '/delete':
-                status, response_body = DELETE(body)
-
-            json_str = json.dumps(response_body)
+                via = self.via()
+                if self.share.seen(via):
+                    status, response_body = 204, ''
+                elif self.base_conflicts(body):
+                    status, response_body = 409, {"error": "changed on the server since the sender's copy", "path": body}
+                else:
+                    status, response_body = self.share.DELETE(body, self.headers.get('client_id'), via)
 
         except Exception as e:
-            response_obj = {
-                "error": str(e)
-            }
-            json_str = json.dumps(response_obj)
+            self.send_failure(400, str(e))
+            return
 
-        self.send_response(status)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json_str.encode('utf-8'))
+        self.send_json(status, response_body)
 
     
+    def base_conflicts(self, rel_path: str) -> bool:
+        # An upload or delete built on base_version would lose any edit here the sender
+        # hasn't seen, it has to sync instead. Without a base the sender has already chosen.
+        base = self.headers.get('base_version')
+        if not base or not self.share.exists(rel_path):
+            return False
+        return compare_versions(json.loads(base), self.share.version(rel_path)) not in (0, 1)
+
+    def via(self) -> list[str]:
+        # set by a relay, the servers a change has been through
+        return [node_id for node_id in self.headers.get('via', '').split(',') if node_id]
+
+    def upload_version(self, rel_path: str) -> dict[str, int]:
+        # An upload's version vector also covers whatever edits this copy had, so one
+        # chosen over a conflict wins on both sides. None for senders without one.
+        sent = self.headers.get('version')
+        if not sent:
+            return None
+        if not self.share.exists(rel_path):
+            return json.loads(sent)
+        return merge_versions(json.loads(sent), self.share.version(rel_path))
+
+    def handle_plan_stream(self):
+        # the manifest comes in as json lines while the actions go out the same way, each
+        # one sent on its own as the client is waiting to start on it
+        query = parse_qs(urlparse(self.path).query)
+        reader = ChunkedReader(self.rfile)
+        entries = (json.loads(line) for line in reader.lines() if line.strip())
+        rules = sync_rules_from_headers(self.headers, self.share.directory)
+        self.send_stream(self.share.PLAN_STREAM(entries, rules, query.get('overwrite', ['0'])[0] == '1', query.get('contents', ['0'])[0] == '1'), flush_seconds=0)
+        # a stream that broke off left part of the manifest unread
+        if not reader.done:
+            self.close_connection = True
+
     def handle_chunked(self):
-        file_path = DIRECTORY + '/' + self.headers.get('file_path')
-        if read_chunked_upload(self, file_path):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(json.dumps("File uploaded successfully.").encode('utf-8'))
+        rel_path = self.headers.get('file_path')
+        file_path = self.share.directory + '/' + rel_path
+        batch_id = self.headers.get('batch')
+        via = self.via()
+        if self.share.seen(via):
+            # the body isn't read, so the connection can't be used again
+            self.send_json(200, "Already have it.", close=True)
+            return
+        if self.base_conflicts(rel_path):
+            # read and dropped so the sender gets the answer rather than a reset connection
+            reader = ChunkedReader(self.rfile)
+            while reader.read(STREAM_BUFFER):
+                pass
+            self.send_json(409, {"error": "changed on the server since the sender's copy", "path": rel_path})
+            return
+        # a single upload is a batch of one, committed as soon as it's in
+        batch = self.share.get_upload_batch(batch_id) if batch_id else self.share.new_batch()
+        version = self.upload_version(rel_path)
+        with self.share.transfer_slot() as free:
+            if not free:
+                self.send_busy()
+                return
+            with METRICS.transfer(), span('receive'):
+                file_hash = read_chunked_upload(self, file_path, batch, self.share.client_bucket(self.client_address[0], 'receive'), self.share.cache, version)
+                if file_hash and not batch_id:
+                    batch.commit()
+        if file_hash:
+            # batched uploads are announced when they're committed
+            if not batch_id:
+                self.share.journal.record(rel_path.replace('\\', '/'), 'upload', file_hash, self.headers.get('client_id'), via)
+            # the sender keeps the version it's stored under, so the file isn't sent back
+            self.send_json(200, {'version': version} if version is not None else "File uploaded successfully.")
         else:
-            self.send_response(400)
-            self.end_headers()
-            self.wfile.write(b"Invalid chunk size")
+            self.send_json(400, "Invalid or incomplete upload", close=True)
 
-class DropHandler(BaseHTTPRequestHandler):
+class DropHandlerMixin:
+    # Receives drops, either a file per /upload or whole folders as tar streams on
+    # /drop_archive, several at once on their own connections. /drop_start hands out a
+    # drop id, the archives record what they brought under it and /drop_done checks
+    # that against the sender's list.
     DROP_DIR = '.'
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_SECONDS
+    disable_nagle_algorithm = True
+    drops = {} # drop id -> {'created': time, 'files': {path: hash}}
+    drops_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        if VERBOSE:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, close=False):
+        json_bytes = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(json_bytes)))
+        if close:
+            # the request body wasn't read
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(json_bytes)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
 
     def do_GET(self):
         if self.path == '/ping':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps('up').encode('utf-8'))
+            self.send_json(200, 'up')
+        else:
+            self.send_json(404, {"error": "unknown path"})
 
     def do_POST(self):
-        if self.path == '/upload':
-            transfer_encoding = self.headers.get('Transfer-Encoding', '').lower()
-            if 'chunked' in transfer_encoding:
-                file_path = self.headers.get('file_path')
-                full_path = os.path.join(self.DROP_DIR, file_path)
-                if read_chunked_upload(self, full_path):
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps("File received.").encode('utf-8'))
+        try:
+            if self.path == '/upload' and 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+                full_path = safe_join(self.DROP_DIR, self.headers.get('file_path', ''))
+                if full_path is None:
+                    self.send_json(400, {"error": "bad file path"}, close=True)
+                    return
+                # a drop target is never synced, so no hash cache goes next to the files
+                batch = WriteBatch(cache=None)
+                if read_chunked_upload(self, full_path, batch):
+                    batch.commit()
+                    self.send_json(200, "File received.")
                 else:
-                    self.send_response(400)
-                    self.end_headers()
-                    self.wfile.write(b"Invalid chunk size")
-                return
+                    self.send_json(400, "Invalid or incomplete upload", close=True)
+            elif self.path == '/drop_start':
+                self.read_json()
+                self.send_json(200, {'drop': self.start_drop()})
+            elif self.path == '/drop_archive':
+                self.receive_archive()
+            elif self.path == '/drop_done':
+                self.finish_drop(self.read_json())
+            else:
+                self.send_json(404, {"error": "unknown path"}, close=True)
+        except Exception as e:
+            self.send_json(400, {"error": str(e)}, close=True)
+
+    def start_drop(self) -> str:
+        drop_id = os.urandom(16).hex()
+        with self.drops_lock:
+            # forget drops whose sender never finished
+            for stale_id, drop in list(self.drops.items()):
+                if time.time() - drop['created'] > BATCH_TIMEOUT:
+                    del self.drops[stale_id]
+            self.drops[drop_id] = {'created': time.time(), 'files': {}}
+        return drop_id
+
+    def receive_archive(self):
+        # unpacks the tar as it streams in. Files land in place together once the stream
+        # ended cleanly, a stream that breaks off leaves nothing of itself behind.
+        import hashlib
+        import tarfile
+        with self.drops_lock:
+            drop = self.drops.get(self.headers.get('drop'))
+        if drop is None:
+            self.send_json(404, {"error": "unknown drop"}, close=True)
+            return
+
+        reader = ChunkedReader(self.rfile)
+        stream = reader
+        if 'gzip' in self.headers.get('Content-Encoding', ''):
+            import gzip
+            stream = gzip.GzipFile(fileobj=reader, mode='rb')
+        received = {}
+        skipped = []
+        with WriteBatch(cache=None) as batch:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    full_path = safe_join(self.DROP_DIR, member.name)
+                    # only plain files, links and devices could point anywhere
+                    if full_path is None or not member.isfile():
+                        if not member.isdir():
+                            skipped.append(member.name)
+                        continue
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    temp_path = temp_path_for(full_path)
+                    source = tar.extractfile(member)
+                    hash_func = hashlib.sha256()
+                    with open(temp_path, 'wb') as f:
+                        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                            f.write(chunk)
+                            hash_func.update(chunk)
+                    batch.add(temp_path, full_path, hash_func.hexdigest())
+                    received[member.name] = hash_func.hexdigest()
+            # tar stops at its end of archive blocks, the rest of the body has to go too
+            while stream.read(STREAM_BUFFER):
+                pass
+            while reader.read(STREAM_BUFFER):
+                pass
 
-        self.send_response(404)
-        self.end_headers()
+        with self.drops_lock:
+            drop['files'].update(received)
+        self.send_json(200, {'files': len(received), 'skipped': skipped})
+
+    def finish_drop(self, body: dict):
+        # one pass over the sender's list, by the end every file has to be here with its hash
+        with self.drops_lock:
+            drop = self.drops.pop(body.get('drop'), None)
+        if drop is None:
+            self.send_json(404, {"error": "unknown drop"})
+            return
+        received = drop['files']
+        missing = [path for path in body['files'] if path not in received]
+        mismatched = [path for path, file_hash in body['files'].items() if path in received and received[path] != file_hash]
+        status = 200 if not missing and not mismatched else 409
+        self.send_json(status, {'files': len(received), 'missing': missing, 'mismatched': mismatched})
+
+HANDLER_MIXINS = {'Server': ServerMixin, 'DropHandler': DropHandlerMixin}
+HANDLER_CLASSES = {}
+
+def handler_class(name: str):
+    # http.server (and the email package behind it) is the slowest import here, so the
+    # handlers only become real BaseHTTPRequestHandlers when something serves with them
+    if name not in HANDLER_CLASSES:
+        from http.server import BaseHTTPRequestHandler
+        HANDLER_CLASSES[name] = type(name, (HANDLER_MIXINS[name], BaseHTTPRequestHandler), {})
+    return HANDLER_CLASSES[name]
+
+def __getattr__(name: str):
+    # file_server.Server and file_server.DropHandler for code importing this as a module
+    if name in HANDLER_MIXINS:
+        return handler_class(name)
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 def find_server_for_client(args):
+    import concurrent.futures
+    import ipaddress
     global URL
     port = PORT if not args.drop else DROP_PORT
     def check_ip(ip):
@@ -1025,7 +5288,7 @@ def find_server_for_client(args):
     print(RED + "Searching for server on local network " + network + " ..." + ANSII_RESET)
     print()
     subnet = ipaddress.IPv4Network(network, strict=False)
-    with ThreadPoolExecutor(max_workers=255) as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=255) as executor:
         futures = [executor.submit(check_ip, str(ip)) for ip in subnet.hosts()]
 
         for future in concurrent.futures.as_completed(futures):
@@ -1044,7 +5307,7 @@ def find_server_for_client(args):
                     RUN_CLIENT(args)
                     exit(0)
 
-            except Exception as e:
+            except Exception:
                 pass
 
         done, not_done = concurrent.futures.wait(futures)
@@ -1054,32 +5317,83 @@ def find_server_for_client(args):
             print()
 
 if __name__ == "__main__":
-
+    import argparse
 
     parser = argparse.ArgumentParser(description="A file server for syncing folders across devices")
     
     parser.add_argument('--server', action='store_true', help='Start the server on this machine. If ommited you\'re running as a client.')
     parser.add_argument('--dir', type=str, help='directory to be synced with server (or clients if running as server), or path to file/directory to be dropped')
-    parser.add_argument('--url', type=str, help='Server url if running as client. Otherwise the local network is scanned for a server')
+    parser.add_argument('--url', type=str, help="Server url if running as client, with the share name on the end for a server with --share, like 'nas:8000/docs'. Otherwise the local network is scanned for a server")
+    parser.add_argument('--peer', action='append', default=[], help="As client, another server holding the same files, like 'lab2:8000'. Big downloads are split into pieces fetched from every server that has the same version, can be repeated")
+    parser.add_argument('--share', action='append', default=[], help="As server, also serve this directory under a name, like 'docs=/srv/docs', can be repeated. Shares get their own cache and limits but one hashing pool and --memory-budget. --dir, if given, answers urls without a share name")
+    parser.add_argument('--relay', action='append', default=[], help="As server, forward every change to another server, like 'nas:8000'. Changes are queued on disk until it's reachable. With --share use 'NAME=URL' to pick the share. Add --watch to also forward edits made directly on this machine, can be repeated")
+    parser.add_argument('--memory-budget', type=str, help="With --share, how much file content sync responses can hold at once across all shares, like '512M' (default " + str(MEMORY_BUDGET // (1024 * 1024)) + "M). Files past it are downloaded separately")
+    parser.add_argument('--content-cache', type=str, help="As server, how much memory small files just sent are kept in for the next client, like '128M' or '0' to turn it off (default " + str(CONTENT_CACHE_SIZE // (1024 * 1024)) + "M)")
+    parser.add_argument('--pack', action='store_true', help='As server, keep files up to ' + str(PACK_FILE_LIMIT // 1024) + 'K together in a few big pack files in the synced directory instead of one file each, for shares of many small files. Small files already there are packed on startup, and starting without --pack puts them back')
+    parser.add_argument('--scrub', nargs='?', const=str(SCRUB_RATE // (1024 * 1024)) + 'M', help="As server, re-read a slice of the files every --scrub-interval seconds at up to this many bytes per second (default " + str(SCRUB_RATE // (1024 * 1024)) + "M) and check them against their cached hashes. Mismatches show up on /scrub and /metrics")
+    parser.add_argument('--scrub-interval', type=float, help='Seconds between the slices --scrub checks (default ' + str(SCRUB_INTERVAL) + ')')
+    parser.add_argument('--repair-from', action='append', default=[], help="With --scrub, a server holding the same files, like 'nas:8000'. A file that doesn't match its hash is replaced with its copy if that one does. With --share use 'NAME=URL' to pick the share. --relay peers are always asked, can be repeated")
+    parser.add_argument('--port', type=int, help='Port to serve on, or to look for the server on when scanning the network (default ' + str(PORT) + ')')
     parser.add_argument('--password', type=str, help='Password used either as server or client. Otherwise no password is used.')
     parser.add_argument('--la', action='store_true', help='Whether to just list the files on the server instead of syncing')
+    parser.add_argument('--path', type=str, help='Only sync this file or folder (relative to --dir)')
+    parser.add_argument('--exclude', action='append', default=[], help='Gitignore style pattern to leave out of the sync, can be repeated. Added after the rules in ' + SYNC_IGNORE)
+    parser.add_argument('--include', action='append', default=[], help='Gitignore style pattern to sync even if excluded, can be repeated')
+    parser.add_argument('--prefix', type=str, help='With --la, only list paths starting with this prefix')
+    parser.add_argument('--glob', type=str, help='With --la, only list files matching this glob (matched against the file name if it has no /)')
+    parser.add_argument('--depth', type=int, help='With --la, only list this many levels deep')
+    parser.add_argument('--fields', type=str, help='With --la, comma separated extra fields to show: size,mtime,hash')
     parser.add_argument('--overwrite', action='store_true', help='Instead of syncing the client will push all their files to the server leaving the server in the same state as the client')
+    parser.add_argument('--dry-run', action='store_true', help='Show what a sync (or --overwrite) would upload, download, move and delete and roughly how long it would take, without changing anything')
+    parser.add_argument('--phased', action='store_true', help='Sync (or --overwrite) one stage after another, hashing everything before the server plans and planning everything before any transfer, instead of overlapping them')
+    parser.add_argument('--watch', action='store_true', help='Keep running and sync changes both ways as they happen. As server also watch the directory for edits made directly on this machine, which lets unchanged listings and syncs be answered with a 304 without scanning')
+    parser.add_argument('--watch-interval', type=float, help='Seconds between checks of the local directory in --watch mode (default ' + str(WATCH_INTERVAL) + ')')
+    parser.add_argument('--debounce', type=float, help='Seconds a burst of edits has to settle before it gets pushed in --watch mode (default ' + str(DEBOUNCE_SECONDS) + ')')
+    parser.add_argument('--quiet', '-q', action='store_true', help='Skip the per file and per request console output, it slows down big syncs')
+    parser.add_argument('--trace', action='store_true', help='As server, time the phases of every request (scan, hash, encode, write...), print them and send them back in a Server-Timing header. Totals show up on /metrics')
+    parser.add_argument('--profile', nargs='?', const='sync_profile.json', help='As client, time every phase and every file hashed or transferred and write a JSON report (default sync_profile.json)')
+    parser.add_argument('--profile-top', type=int, default=10, help='How many of the slowest files to show with --profile')
+    parser.add_argument('--cprofile', action='store_true', help='With --profile, also run cProfile and save it next to the report as .prof')
+    parser.add_argument('--tracemalloc', action='store_true', help='With --profile, also track memory with tracemalloc')
+    parser.add_argument('--upload-limit', type=str, help="As client, cap upload speed in bytes per second, like '500K' or '5M'")
+    parser.add_argument('--download-limit', type=str, help="As client, cap download speed in bytes per second, like '500K' or '5M'")
+    parser.add_argument('--client-limit', action='append', default=[], help="As server, cap each client's speed each way, like '5M'. Use 'IP=RATE' for one client, can be repeated")
+    parser.add_argument('--max-transfers', type=int, help='As server, how many uploads and downloads can run at once. Others wait up to ' + str(TRANSFER_WAIT_SECONDS) + 's and then get a 503')
+    parser.add_argument('--hash-limit', type=str, help="Cap how fast files are read for hashing, like '20M'")
+    parser.add_argument('--low-priority', action='store_true', help='Run with the lowest cpu and disk priority so a background sync stays out of the way')
     parser.add_argument('--drop', '-d', action='store_true', help='Drop mode: send/receive files without syncing')
+    parser.add_argument('--compress', action='store_true', help='With --drop, gzip the stream. Worth it for source code and text, not for photos or video')
     args = parser.parse_args()
 
 
     if args.password:
         PASSWORD = args.password
+    VERBOSE = not args.quiet
+    TRACE_REQUESTS = args.trace
+    if args.low_priority:
+        set_low_priority()
+    if args.hash_limit:
+        HASH_LIMIT = TokenBucket(parse_rate(args.hash_limit))
+    if args.upload_limit:
+        UPLOAD_LIMIT = TokenBucket(parse_rate(args.upload_limit))
+    if args.download_limit:
+        DOWNLOAD_LIMIT = TokenBucket(parse_rate(args.download_limit))
+    if args.port:
+        PORT = args.port
+    PEERS = args.peer
 
     if args.drop:
         if args.server:
             drop_dir = os.path.expanduser(args.dir) if args.dir else os.getcwd()
             os.makedirs(drop_dir, exist_ok=True)
+            from http.server import ThreadingHTTPServer
+            DropHandler = handler_class('DropHandler')
             DropHandler.DROP_DIR = drop_dir
             print("Drop serving on port " + str(DROP_PORT) + " ...")
             print_rainbow(get_local_ip())
             server_address = ('', DROP_PORT)
-            httpd = HTTPServer(server_address, DropHandler)
+            # threaded so the lanes of a drop come in side by side
+            httpd = ThreadingHTTPServer(server_address, DropHandler)
             httpd.serve_forever()
         else:
             if not args.dir:
@@ -1093,18 +5407,64 @@ if __name__ == "__main__":
             else:
                 RUN_CLIENT(args)
     else:
-        if not args.dir:
+        if not args.dir and not (args.server and args.share):
             parser.error('--dir is required')
         if args.server:
-            DIRECTORY = os.path.expanduser(args.dir)
-            server_address = ('', PORT)
-            httpd = HTTPServer(server_address, Server)
-            print("Serving on port " + str(PORT) + " ...")
+            client_rates = {}
+            for limit in args.client_limit:
+                client_ip, _, rate = limit.rpartition('=')
+                client_rates[client_ip] = parse_rate(rate)
+            content_cache = int(parse_rate(args.content_cache)) if args.content_cache else CONTENT_CACHE_SIZE
+            if args.share:
+                memory_budget = int(parse_rate(args.memory_budget)) if args.memory_budget else MEMORY_BUDGET
+                server = SyncHost(PASSWORD, PORT, client_rates=client_rates, max_transfers=args.max_transfers, memory_budget=memory_budget, content_cache=content_cache, pack=args.pack)
+                if args.dir:
+                    server.add('', args.dir)
+                for share in args.share:
+                    name, _, directory = share.partition('=')
+                    if not os.path.isdir(os.path.expanduser(directory)):
+                        parser.error('--share ' + share + ' is not a directory')
+                    try:
+                        server.add(name, directory)
+                    except ValueError as e:
+                        parser.error(str(e))
+                    print("Sharing " + directory + " as /" + name)
+            else:
+                DIRECTORY = os.path.expanduser(args.dir)
+                server = SyncServer(DIRECTORY, PASSWORD, PORT, client_rates=client_rates, max_transfers=args.max_transfers, content=ContentCache(content_cache), pack=args.pack)
+            for share in (server.shares.values() if args.share else [server]):
+                if args.pack:
+                    print("Packed " + str(share.pack_small_files()) + " small files in " + share.directory)
+                elif share.pack is not None:
+                    print("Unpacked " + str(share.unpack_files()) + " files in " + share.directory)
+            for relay in args.relay:
+                name, _, url = relay.rpartition('=')
+                share = server.shares.get(name) if args.share else server if not name else None
+                if share is None:
+                    parser.error('--relay ' + relay + ' names no share being served')
+                share.add_relay(url)
+                print("Relaying " + share.directory + " to " + url)
+            if args.scrub:
+                repair_from = {}
+                for peer in args.repair_from:
+                    name, _, url = peer.rpartition('=')
+                    repair_from.setdefault(name, []).append((url, PASSWORD))
+                for name, share in (server.shares.items() if args.share else [('', server)]):
+                    share.start_scrubbing(parse_rate(args.scrub), args.scrub_interval or SCRUB_INTERVAL, repair_from.get(name, []))
+            if args.watch:
+                threading.Thread(target=server.watch, args=(args.watch_interval or WATCH_INTERVAL,), daemon=True).start()
+            server.listen()
+            print("Serving on port " + str(server.port) + " ...")
             print_rainbow(get_local_ip())
-            httpd.serve_forever()
+            server.serve_forever()
         else:
             URL = args.url
             DIRECTORY = os.path.expanduser(args.dir)
+            SYNC_RULES = load_sync_rules(
+                DIRECTORY,
+                args.exclude + ['!' + pattern for pattern in args.include],
+                args.path,
+            )
             if not URL:
                find_server_for_client(args)
             else:
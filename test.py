@@ -8,20 +8,18 @@ START_OF_LINE_AND_CLEAR = '\r\033[K'
 
 def test_hashing_big_dir():
 
-    DIR = '~/Documents'
+    # point this at a big folder of your own, bench.py does the same on generated files
+    DIR = os.path.expanduser(os.environ.get('HASH_TEST_DIR', '~/Documents'))
 
 
     files = file_server.get_all_files_relative(DIR)
 
     print()
     start = time.time()
-    one_percent = int(len(files) / 100)
+    one_percent = max(1, int(len(files) / 100))
     for i, file in enumerate(files):
         file_path = DIR + "/" + file
-        file_contents = file_server.read(file_path)
-        file_hash = file_server.hash(file_contents)
-        # file_server.print_rainbow(file, end='')
-        # print(' -> ' + file_hash)
+        file_server.hash(file_path)
         if i % one_percent == 0:
             percent = i / one_percent
             print(START_OF_LINE_AND_CLEAR + str(percent) + '%', end='')
@@ -56,4 +54,11 @@ def make_large_file():
 
 
 
-make_large_file()
\ No newline at end of file
+if __name__ == "__main__":
+    # make_large_file writes about 3GB, so it only runs when asked for by name
+    if len(sys.argv) > 1 and sys.argv[1] == 'hash':
+        test_hashing_big_dir()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'large':
+        make_large_file()
+    else:
+        print('usage: python test.py hash|large')
\ No newline at end of file
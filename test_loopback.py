@@ -0,0 +1,441 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+from unittest import mock
+
+import file_server
+
+# Syncs between a SyncServer and SyncClients on a free local port, no prompts and no
+# network. Run with python -m unittest test_loopback
+
+
+def write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def edit(path: str, data: bytes):
+    # moves the mtime on even on coarse filesystems
+    write(path, data)
+    later = time.time() + 2
+    os.utime(path, (later, later))
+
+def read_tree(root: str) -> dict[str, bytes]:
+    internal = {file_server.HASH_CACHE.strip('/'), file_server.META_DIR.strip('/')}
+    tree = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        if dir_path == root:
+            dir_names[:] = [name for name in dir_names if name not in internal]
+        for name in file_names:
+            full_path = os.path.join(dir_path, name)
+            with open(full_path, 'rb') as f:
+                tree[os.path.relpath(full_path, root).replace(os.sep, '/')] = f.read()
+    return tree
+
+def make_files(root: str) -> dict[str, bytes]:
+    files = {
+        'a.txt': b'first file\n',
+        'notes/b.md': b'# notes\n' * 50,
+        'notes/deep/c.bin': os.urandom(5000),
+        'big.bin': os.urandom(file_server.PACK_FILE_LIMIT * 2),
+    }
+    for rel_path, data in files.items():
+        write(os.path.join(root, rel_path), data)
+    return files
+
+
+class LoopbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.verbose = file_server.VERBOSE
+        file_server.VERBOSE = False
+        self.root = tempfile.mkdtemp()
+        self.servers = []
+        self.clients = []
+        quiet = contextlib.redirect_stdout(io.StringIO())
+        quiet.__enter__()
+        self.addCleanup(quiet.__exit__, None, None, None)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for server in self.servers:
+            server.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+        file_server.VERBOSE = self.verbose
+
+    def dir(self, name: str) -> str:
+        path = os.path.join(self.root, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def server(self, name: str, **kwargs) -> file_server.SyncServer:
+        server = file_server.SyncServer(self.dir(name), port=0, **kwargs).start()
+        self.servers.append(server)
+        return server
+
+    def client(self, server: file_server.SyncServer, name: str, **kwargs) -> file_server.SyncClient:
+        client = file_server.SyncClient('127.0.0.1:' + str(server.port), self.dir(name), **kwargs)
+        self.clients.append(client)
+        return client
+
+    def test_pack_round_trip(self):
+        server = self.server('server', pack=True)
+        files = make_files(self.dir('a'))
+        self.client(server, 'a').OVERWRITE()
+
+        # the small files went into the pack, the big one stays a file of its own
+        self.assertEqual(set(server.pack.files), {'a.txt', 'notes/b.md', 'notes/deep/c.bin'})
+        self.assertEqual(read_tree(server.directory), {'big.bin': files['big.bin']})
+
+        self.client(server, 'b').SYNC()
+        self.assertEqual(read_tree(self.dir('b')), files)
+
+        self.assertEqual(server.unpack_files(), 3)
+        self.assertIsNone(server.pack)
+        self.assertEqual(read_tree(server.directory), files)
+
+    def test_content_cache(self):
+        root = self.dir('files')
+        paths = [os.path.join(root, name) for name in ('one', 'two', 'three')]
+        for path in paths:
+            write(path, b'x' * 100)
+        cache = file_server.ContentCache(250)
+
+        def hits() -> float:
+            return file_server.METRICS.get('file_server_content_cache_hits_total')
+
+        count = hits()
+        self.assertEqual(cache.get(paths[0]), b'x' * 100)
+        self.assertEqual(cache.get(paths[0]), b'x' * 100)
+        self.assertEqual(hits(), count + 1)
+
+        # a file changed behind the cache's back is read again
+        edit(paths[0], b'y' * 100)
+        self.assertEqual(cache.get(paths[0]), b'y' * 100)
+        self.assertEqual(hits(), count + 1)
+
+        # the least recently used goes to keep it within its bytes
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+        self.assertEqual(list(cache.entries), [paths[0], paths[2]])
+        self.assertLessEqual(cache.used, 250)
+
+    def test_dry_run_changes_nothing(self):
+        server = self.server('server')
+        make_files(self.dir('a'))
+        a = self.client(server, 'a')
+        a.OVERWRITE()
+        b = self.client(server, 'b')
+        b.SYNC()
+
+        edit(os.path.join(a.directory, 'a.txt'), b'newer on a\n')
+        write(os.path.join(a.directory, 'only on the server.txt'), b'a\n')
+        a.OVERWRITE()
+        edit(os.path.join(b.directory, 'notes/b.md'), b'newer on b\n')
+        write(os.path.join(b.directory, 'new.txt'), b'b\n')
+        before = read_tree(b.directory), read_tree(server.directory)
+
+        kinds = {action.path: action.kind for action in b.DRY_RUN()}
+        self.assertEqual(kinds, {
+            'a.txt': file_server.ACTION_DOWNLOAD,
+            'only on the server.txt': file_server.ACTION_DOWNLOAD,
+            'notes/b.md': file_server.ACTION_UPLOAD,
+            'new.txt': file_server.ACTION_UPLOAD,
+        })
+        # overwriting, b's copies win and what only the server has goes
+        kinds = {action.path: action.kind for action in b.DRY_RUN(overwrite=True)}
+        self.assertEqual(kinds, {
+            'a.txt': file_server.ACTION_UPLOAD,
+            'only on the server.txt': file_server.ACTION_DELETE,
+            'notes/b.md': file_server.ACTION_UPLOAD,
+            'new.txt': file_server.ACTION_UPLOAD,
+        })
+        self.assertEqual((read_tree(b.directory), read_tree(server.directory)), before)
+
+    def test_rules_and_path_limit_the_sync(self):
+        rules = file_server.SyncRules(['*.bin', '!keep.bin', 'build/'])
+        self.assertFalse(rules.wanted('notes/deep/c.bin'))
+        self.assertTrue(rules.wanted('notes/keep.bin'))
+        self.assertFalse(rules.wanted('build/out.txt'))
+        self.assertTrue(rules.wanted('src/build.txt'))
+
+        server = self.server('server')
+        files = make_files(self.dir('a'))
+        self.client(server, 'a').OVERWRITE()
+
+        b = self.client(server, 'b', rules=file_server.SyncRules(['*.bin'], path='notes'))
+        b.SYNC()
+        self.assertEqual(read_tree(b.directory), {'notes/b.md': files['notes/b.md']})
+
+        # an overwrite from b leaves everything it doesn't cover alone
+        edit(os.path.join(b.directory, 'notes/b.md'), b'scoped\n')
+        b.OVERWRITE()
+        self.assertEqual(read_tree(server.directory), dict(files, **{'notes/b.md': b'scoped\n'}))
+
+    def test_concurrent_edits_conflict(self):
+        server = self.server('server')
+        make_files(self.dir('a'))
+        a = self.client(server, 'a')
+        a.OVERWRITE()
+        b = self.client(server, 'b')
+        b.SYNC()
+
+        # both sides change a.txt from the same version, only a gets it to the server
+        edit(os.path.join(a.directory, 'a.txt'), b'edited on a\n')
+        edit(os.path.join(b.directory, 'a.txt'), b'edited on b\n')
+        edit(os.path.join(b.directory, 'notes/b.md'), b'only b touched this\n')
+        a.OVERWRITE()
+
+        file_path_to_file_hash, actions = b.plan()
+        kinds = {action.path: action.kind for action in actions}
+        self.assertEqual(kinds.get('a.txt'), file_server.ACTION_CONFLICT)
+        self.assertEqual(kinds.get('notes/b.md'), file_server.ACTION_UPLOAD)
+
+        # and an upload made from b's old base is turned away
+        status, response = b.upload('a.txt', base=b.cache.base_version(os.path.join(b.directory, 'a.txt')))
+        self.assertEqual(status, 409)
+
+        # and so is a delete
+        base = b.cache.base_version(os.path.join(b.directory, 'a.txt'))
+        status, response = b.delete('/delete', 'a.txt', b.headers(base_version=json.dumps(base)))
+        self.assertEqual(status, 409)
+        self.assertIn('a.txt', read_tree(server.directory))
+
+    def test_same_edits_settle_without_conflict(self):
+        server = self.server('server')
+        make_files(self.dir('a'))
+        a = self.client(server, 'a')
+        a.OVERWRITE()
+        b = self.client(server, 'b')
+        b.SYNC()
+
+        # b's edit isn't hashed before the sync, it's still found to be a's
+        edit(os.path.join(a.directory, 'a.txt'), b'the same edit\n')
+        edit(os.path.join(b.directory, 'a.txt'), b'the same edit\n')
+        a.OVERWRITE()
+        with mock.patch('builtins.input') as prompt:
+            b.SYNC()
+        prompt.assert_not_called()
+        self.assertEqual(b.cache.base_version(os.path.join(b.directory, 'a.txt')), server.version('a.txt'))
+
+    def test_relay_keeps_both_edits(self):
+        x = self.server('x')
+        y = self.server('y')
+        # forwarded by hand rather than on the relay's thread
+        relay = file_server.Relay(x, '127.0.0.1:' + str(y.port))
+        x.journal.listeners.append(relay.enqueue)
+        self.addCleanup(relay.pool.close)
+
+        make_files(self.dir('a'))
+        a = self.client(x, 'a')
+        a.OVERWRITE()
+        relay.forward()
+        self.assertEqual(read_tree(y.directory), read_tree(x.directory))
+
+        # y's copy of a.txt gets an edit x never saw, then x's edit is relayed over it
+        b = self.client(y, 'b')
+        b.SYNC()
+        edit(os.path.join(b.directory, 'a.txt'), b'edited on b\n')
+        b.OVERWRITE()
+        edit(os.path.join(a.directory, 'a.txt'), b'edited on a\n')
+        a.OVERWRITE()
+        relay.forward()
+        relay.forward()
+
+        copy_path = file_server.conflict_path('a.txt', y.node_id)
+        for server in (x, y):
+            tree = read_tree(server.directory)
+            self.assertEqual(tree['a.txt'], b'edited on a\n')
+            self.assertEqual(tree[copy_path], b'edited on b\n')
+        self.assertEqual(read_tree(y.directory), read_tree(x.directory))
+        self.assertEqual(y.version('a.txt'), x.version('a.txt'))
+
+    def test_relay_forwards_changes(self):
+        x = self.server('x')
+        y = self.server('y')
+        # forwarded by hand rather than on the relay's thread
+        relay = file_server.Relay(x, '127.0.0.1:' + str(y.port))
+        x.journal.listeners.append(relay.enqueue)
+        self.addCleanup(relay.pool.close)
+
+        files = make_files(self.dir('a'))
+        a = self.client(x, 'a')
+        a.OVERWRITE()
+        relay.forward()
+        self.assertEqual(read_tree(y.directory), files)
+
+        # a delete goes over too, and nothing is left queued
+        os.remove(os.path.join(a.directory, 'a.txt'))
+        a.OVERWRITE()
+        relay.forward()
+        self.assertNotIn('a.txt', read_tree(y.directory))
+        self.assertEqual(read_tree(y.directory), read_tree(x.directory))
+        self.assertEqual(relay.pending, {})
+
+    def test_scrub_quarantines_until_repaired(self):
+        x = self.server('x')
+        y = self.server('y')
+        files = make_files(self.dir('a'))
+        a = self.client(x, 'a')
+        a.OVERWRITE()
+        self.client(y, 'a').OVERWRITE()
+
+        # rot on x's disk, the mtime still says the cached hash is good
+        full_path = os.path.join(x.directory, 'notes/b.md')
+        stat = os.stat(full_path)
+        write(full_path, b'rotten\n')
+        os.utime(full_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        scrubber = x.start_scrubbing(interval=3600)
+        scrubber.scrub_slice()
+        self.assertTrue(x.quarantined('notes/b.md'))
+        with self.assertRaises(Exception):
+            self.client(x, 'b').SYNC()
+        self.assertNotIn('notes/b.md', read_tree(self.dir('b')))
+
+        # y still has it as it was, the next slice puts it back and says so on the journal
+        generation = x.journal.generation
+        scrubber.peers.append(('127.0.0.1:' + str(y.port), ''))
+        scrubber.scrub_slice()
+        self.assertFalse(x.quarantined('notes/b.md'))
+        self.assertTrue(scrubber.status()['mismatches']['notes/b.md']['repaired'])
+        self.assertGreater(x.journal.generation, generation)
+        self.client(x, 'b').SYNC()
+        self.assertEqual(read_tree(self.dir('b')), files)
+
+    def test_unchanged_answers_are_not_modified(self):
+        server = self.server('server')
+        server.start_watching()
+        make_files(self.dir('a'))
+        a = self.client(server, 'a')
+        a.OVERWRITE()
+
+        def not_modified() -> float:
+            return file_server.METRICS.get('file_server_not_modified_total')
+
+        def listing() -> dict:
+            items = file_server.list_remote_files(a.url, headers=a.headers(), pool=a.pool, fields='hash')
+            return {item['path']: item['hash'] for item in items}
+
+        # the same listing twice is a 304 the second time, answered from the pool
+        first = listing()
+        count = not_modified()
+        self.assertEqual(listing(), first)
+        self.assertEqual(not_modified(), count + 1)
+
+        # so is a download of what's already here
+        status, rel_path = a.download('a.txt')
+        self.assertEqual(status, 304)
+        self.assertEqual(not_modified(), count + 2)
+
+        # a change moves the journal on and the listing is sent again
+        edit(os.path.join(a.directory, 'a.txt'), b'edited\n')
+        a.OVERWRITE()
+        count = not_modified()
+        self.assertNotEqual(listing()['a.txt'], first['a.txt'])
+        self.assertEqual(not_modified(), count)
+
+        # the pool holds its bodies within VALIDATOR_CACHE_SIZE bytes
+        pool = file_server.ConnectionPool()
+        pool.remember('/small', '"small"', ['x'], 10)
+        pool.remember('/big', '"big"', ['y'], file_server.VALIDATOR_CACHE_SIZE)
+        self.assertIsNotNone(pool.validator('/small'))
+        self.assertIsNone(pool.validator('/big'))
+        self.assertEqual(pool.validator_bytes, 10)
+
+    def test_swarm_download_checks_every_piece(self):
+        x = self.server('x')
+        y = self.server('y')
+        data = os.urandom(5 * 64 * 1024 + 123)
+        write(os.path.join(self.dir('a'), 'swarm.bin'), data)
+        self.client(x, 'a').OVERWRITE()
+        self.client(y, 'a').OVERWRITE()
+        peers = ['127.0.0.1:' + str(y.port)]
+
+        # the smallest pieces a server hands out, so the file comes in six from both servers
+        with mock.patch.object(file_server, 'PIECE_SIZE', 64 * 1024):
+            b = self.client(x, 'b', peers=peers)
+            self.assertEqual(b.download('swarm.bin')[0], 200)
+            self.assertEqual(read_tree(b.directory), {'swarm.bin': data})
+
+            # y's disk goes bad behind its piece list, its pieces are fetched again from x
+            full_path = os.path.join(y.directory, 'swarm.bin')
+            stat = os.stat(full_path)
+            write(full_path, bytes(len(data)))
+            os.utime(full_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            c = self.client(x, 'c', peers=peers)
+            self.assertEqual(c.download('swarm.bin')[0], 200)
+            self.assertEqual(read_tree(c.directory), {'swarm.bin': data})
+
+    def test_drop_over_lanes(self):
+        # biggest first onto the emptiest lane, each lane in path order
+        files = [('/x/' + name, name, size) for name, size in (('a', 50), ('b', 40), ('c', 30), ('d', 20), ('e', 10))]
+        with mock.patch.object(file_server, 'DROP_LANE_SIZE', 1):
+            lanes = file_server.split_lanes(files, 2)
+        self.assertEqual([[file[1] for file in lane] for lane in lanes], [['a', 'd', 'e'], ['b', 'c']])
+
+        handler = type('TestDropHandler', (file_server.DropHandler,), {'DROP_DIR': self.dir('dropped')})
+        receiver = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=receiver.serve_forever, daemon=True).start()
+        self.addCleanup(receiver.server_close)
+        self.addCleanup(receiver.shutdown)
+
+        sent = make_files(self.dir('folder'))
+        for compress in (False, True):
+            with mock.patch.object(file_server, 'DROP_LANE_SIZE', 1024):
+                client = file_server.SyncClient('127.0.0.1:' + str(receiver.server_address[1]), self.dir('folder'))
+                self.clients.append(client)
+                client.DROP(compress, lanes=3)
+            self.assertEqual(read_tree(self.dir('dropped/folder')), sent)
+            shutil.rmtree(self.dir('dropped/folder'))
+        # a drop target is never synced, so it gets no hash cache
+        self.assertEqual(os.listdir(self.dir('dropped')), [])
+
+
+    def test_pipelined_matches_phased(self):
+        server = self.server('server')
+        files = make_files(self.dir('source'))
+        self.client(server, 'source').OVERWRITE()
+
+        self.client(server, 'phased').SYNC()
+        # a list of actions, not a fallback to the phased SYNC
+        self.assertIsInstance(self.client(server, 'pipelined').PIPELINED(), list)
+        self.assertEqual(read_tree(self.dir('phased')), files)
+        self.assertEqual(read_tree(self.dir('pipelined')), files)
+
+        # and pushing with it leaves the server as OVERWRITE would
+        pusher = self.client(server, 'pipelined')
+        edit(os.path.join(pusher.directory, 'notes/b.md'), b'pushed\n')
+        os.remove(os.path.join(pusher.directory, 'notes/deep/c.bin'))
+        write(os.path.join(pusher.directory, 'new.txt'), b'new\n')
+        pusher.PIPELINED(overwrite=True)
+        self.assertEqual(read_tree(server.directory), read_tree(pusher.directory))
+
+        fresh = self.client(server, 'fresh')
+        fresh.PIPELINED()
+        self.assertEqual(read_tree(fresh.directory), read_tree(pusher.directory))
+
+        # a file deleted on the server isn't put back, both ways ask about it first
+        self.client(server, 'phased again').SYNC()
+        os.remove(os.path.join(pusher.directory, 'a.txt'))
+        pusher.PIPELINED(overwrite=True)
+        for name, sync in (('phased again', 'SYNC'), ('fresh', 'PIPELINED')):
+            client = self.client(server, name)
+            with mock.patch('builtins.input', return_value='del') as prompt:
+                getattr(client, sync)()
+            self.assertEqual(prompt.call_count, 1)
+            self.assertNotIn('a.txt', read_tree(server.directory))
+            self.assertEqual(read_tree(client.directory), read_tree(pusher.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()